@@ -1,23 +1,132 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
 import requests
+from requests.adapters import HTTPAdapter
 from utils import get_headers
+import metrics
 from requests import exceptions
 
+def cache_key(forward_headers):
+    #the auth headers are hashed so the cache doesn't hold on to tokens
+    key = "\n".join(f"{header}:{forward_headers[header]}" for header in sorted(forward_headers))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
 class AccessClient():
-    def __init__(self, connection_string: str, dev_mode: bool):
+    """
+    Looks up the logged-in user in Access. Lookups are cached (keyed by a hash of the forwarded auth headers) for
+    cache_ttl seconds, concurrent lookups for the same user share one call to Access, and misses go over a pooled session.
+    With a shared state, users looked up by one worker are also cached for the other workers on the host.
+        connection_string - the protocol, host and port of Access
+        dev_mode - return a fixed test user instead of calling Access
+        cache_ttl - how long a user's details are cached for, in seconds (0 disables the cache)
+        cache_size - the most users held in the cache
+        pool_size - the number of pooled connections to Access
+        timeout - the timeout for calls to Access, in seconds
+        shared_state - a SharedState to share cached users through, or None
+    """
+    def __init__(self, connection_string: str, dev_mode: bool, cache_ttl: float = 60, cache_size: int = 1024, pool_size: int = 20, timeout: float = 10, shared_state = None):
         self.connection_string = connection_string
         self.dev = dev_mode
-        
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self.shared_state = shared_state
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.cache = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def cached_user_details(self, headers):
+        """
+        Returns the user's details if they are cached, otherwise None - this never calls Access, so it is safe to use
+        on the event loop before falling back to get_user_details
+        """
+        if self.dev:
+            return self.get_user_details(headers)
+        key = cache_key(get_headers(headers))
+        with self.lock:
+            return self.get_cached(key)
+
+    def get_cached(self, key):
+        entry = self.cache.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.cache.move_to_end(key)
+                self.hits += 1
+                metrics.access_cache.labels("hit").inc()
+                return entry[1]
+            del self.cache[key]
+        return None
+
     def get_user_details(self, headers):
 
         if self.dev:
             return {"username": "Test User1", "user_id": "1234-5678-99ab-cdef"}
-        res = requests.get(f"{self.connection_string}/user-info/self", headers=get_headers(headers))
+        forward_headers = get_headers(headers)
+        key = cache_key(forward_headers)
+        with self.lock:
+            user = self.get_cached(key)
+            if user is not None:
+                return user
+            future = self.in_flight.get(key)
+            if future is None:
+                future = Future()
+                self.in_flight[key] = future
+                self.misses += 1
+                metrics.access_cache.labels("miss").inc()
+                leader = True
+            else:
+                self.coalesced += 1
+                metrics.access_cache.labels("coalesced").inc()
+                leader = False
+        if not leader:
+            #another request is already asking Access about this user - wait for its answer (or its error)
+            return future.result()
+        try:
+            user = self.fetch_shared_user_details(key, forward_headers)
+        except BaseException as e:
+            with self.lock:
+                del self.in_flight[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.in_flight[key]
+            if user is not None and self.cache_ttl > 0:
+                self.cache[key] = (time.monotonic() + self.cache_ttl, user)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        future.set_result(user)
+        return user
+
+    def fetch_shared_user_details(self, key, forward_headers):
+        if self.shared_state is None or self.cache_ttl <= 0:
+            return self.fetch_user_details(forward_headers)
+        #another worker on this host may already have looked this user up
+        user = self.shared_state.cache_get("access_users", key)
+        if user is not None:
+            metrics.access_cache.labels("shared").inc()
+            return user
+        user = self.fetch_user_details(forward_headers)
+        if user is not None:
+            self.shared_state.cache_put("access_users", key, user, self.cache_ttl)
+        return user
+
+    def fetch_user_details(self, forward_headers):
+        with metrics.timed(metrics.access_latency):
+            res = self.session.get(f"{self.connection_string}/user-info/self", headers=forward_headers, timeout=self.timeout)
 
         res.raise_for_status()
-        if res.status_code == 200: 
+        if res.status_code == 200:
             return res.json()
-        
-     
-
-        
 
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "size": len(self.cache)}
@@ -1,46 +1,86 @@
 from enum import Enum
 from typing import Union, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
 from datetime import datetime, date
 from typing import List, Dict
 
 from fastapi import FastAPI, Request, Response, Query, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-import uvicorn
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
+from functools import lru_cache
 import os
-import requests
+import time
+import re
+import base64
+from bisect import bisect_right
+import asyncio
+import contextvars
+import httpx
 from requests import exceptions
 import uuid
-import pygeohash as pgh
-from access import AccessClient
+from access import AccessClient, cache_key
+from sparql_client import SparqlClient
+from ontology import OntologyIndex, hierarchy_query
+from geohash_index import GeohashIndex, location_query, geohash_stub, covering_cells, minimal_cells
+from prefixes import PrefixCodec
+from uprn_index import UprnIndex, uprn_query, uprn_buildings
+from ntriples import TripleBuilder, format_iri
+from producer import BatchingProducer, ProducerFull
+from known_persons import KnownPersons
+from idempotency import IdempotencyStore, IdempotencyConflict, IdempotencyInProgress, request_key, fingerprint
+from shared_state import SharedState, SharedStateMiddleware
+from response_cache import ResponseCache
+from serialization import FastRenderer, json_type, negotiate, compress, dump
+from read_model import ReadModel, FileTopic, KafkaTopic, build_columns, index_columns, read_snapshot, write_snapshot
+import orjson
+import metrics
 import configparser
-from maplib.access import SecurityLabelBuilder, EDHSecurityLabelsV2
 from utils import get_headers as get_forwarding_headers
 
-from rdflib import Graph, plugin, URIRef, BNode, Literal
-from rdflib.namespace import DC, DCAT, DCTERMS, OWL, RDF, RDFS, XMLNS, XSD
-from rdflib.serializer import Serializer
-
 class ClassificationEmum(str, Enum):
     official = "O"
     official_sensitive = "OS"
     secret = "S"
     top_secret= "TS"
 
+#Nearly every write uses one of a handful of labels, so each is only rendered (and its headers built) once
+label_cache_size = 1024
+
 class EDH(BaseModel):
     permitted_organisations: List[str] = []
     permitted_nationalities: List[str] = []
     classification: ClassificationEmum = 'O'
 
+    def key(self):
+        """
+        The label in a canonical, hashable form - the permitted organisations and nationalities are sets, so labels
+        that only differ in their order or repeats have the same key (and render to the same string)
+        """
+        return canonical_label_key(tuple(self.permitted_organisations), tuple(self.permitted_nationalities), self.classification)
+
     def to_string(self):
-        builder = SecurityLabelBuilder()
-        if len(self.permitted_organisations) > 0:
-            builder.add_multiple(EDHSecurityLabelsV2.PERMITTED_ORGANISATIONS.value, *self.permitted_organisations)
-        if len(self.permitted_nationalities) > 0:
-            builder.add_multiple(EDHSecurityLabelsV2.PERMITTED_NATIONALITIES.value, *self.permitted_nationalities)
-        if self.classification:
-            builder.add(EDHSecurityLabelsV2.CLASSIFICATION.value, self.classification.value)
-        return builder.build()
+        return render_security_label(self.key())
+
+@lru_cache(maxsize=label_cache_size)
+def canonical_label_key(permitted_organisations:tuple, permitted_nationalities:tuple, classification):
+    classification = ClassificationEmum(classification).value if classification else None
+    return (tuple(sorted(set(permitted_organisations))), tuple(sorted(set(permitted_nationalities))), classification)
+
+@lru_cache(maxsize=label_cache_size)
+def render_security_label(label_key:tuple):
+    #maplib is only imported once it is needed, so it doesn't slow down starting the API
+    from maplib.access import SecurityLabelBuilder, EDHSecurityLabelsV2
+    permitted_organisations, permitted_nationalities, classification = label_key
+    builder = SecurityLabelBuilder()
+    if len(permitted_organisations) > 0:
+        builder.add_multiple(EDHSecurityLabelsV2.PERMITTED_ORGANISATIONS.value, *permitted_organisations)
+    if len(permitted_nationalities) > 0:
+        builder.add_multiple(EDHSecurityLabelsV2.PERMITTED_NATIONALITIES.value, *permitted_nationalities)
+    if classification:
+        builder.add(EDHSecurityLabelsV2.CLASSIFICATION.value, classification)
+    return builder.build()
 
 #If you're running this yourself, and the Jena instance you're using is not local, you can used environment variables to override
 jenaURL = os.getenv("JENA_URL", "localhost")
@@ -56,20 +96,117 @@ access_host = os.getenv("ACCESS_URL", "localhost")
 access_port = os.getenv("ACCESS_PORT", "8091")
 dev_mode = os.getenv("DEV", "False")
 port = os.getenv("PORT", "5021")
+max_flag_batch = int(os.getenv("MAX_FLAG_BATCH", "1000"))
+access_cache_ttl = float(os.getenv("ACCESS_CACHE_TTL", "60"))
+access_cache_size = int(os.getenv("ACCESS_CACHE_SIZE", "1024"))
+access_pool_size = int(os.getenv("ACCESS_POOL_SIZE", "20"))
+access_timeout = float(os.getenv("ACCESS_TIMEOUT", "10"))
+known_persons_enabled = os.getenv("KNOWN_PERSONS", "True").lower() == "true"
+known_persons_db = os.getenv("KNOWN_PERSONS_DB", "known_persons.db")
+known_persons_ttl = float(os.getenv("KNOWN_PERSONS_TTL", str(30*24*3600)))
+known_persons_size = int(os.getenv("KNOWN_PERSONS_SIZE", "100000"))
+idempotency_enabled = os.getenv("IDEMPOTENCY", "True").lower() == "true"
+idempotency_db = os.getenv("IDEMPOTENCY_DB", "idempotency.db")
+idempotency_ttl = float(os.getenv("IDEMPOTENCY_TTL", str(24*3600)))
+idempotency_size = int(os.getenv("IDEMPOTENCY_SIZE", "100000"))
+idempotency_wait = float(os.getenv("IDEMPOTENCY_WAIT", "10"))
+shared_state_enabled = os.getenv("SHARED_STATE", "True").lower() == "true"
+shared_state_db = os.getenv("SHARED_STATE_DB", "shared_state.db")
+jena_pool_size = int(os.getenv("JENA_POOL_SIZE", "100"))
+jena_keepalive = int(os.getenv("JENA_KEEPALIVE", "20"))
+jena_timeout = float(os.getenv("JENA_TIMEOUT", "30"))
+jena_connect_timeout = float(os.getenv("JENA_CONNECT_TIMEOUT", "5"))
+jena_http2 = os.getenv("JENA_HTTP2", "True").lower() == "true"
+ontology_source = os.getenv("ONTOLOGY_SOURCE", "JENA")
+ontology_files = os.getenv("ONTOLOGY_FILES", "ies4.ttl,iesExtensions.ttl,ndt_retrofit_buildings_extensions.ttl").split(",")
+ontology_refresh_seconds = int(os.getenv("ONTOLOGY_REFRESH_SECONDS", "3600"))
+ontology_artefact = os.getenv("ONTOLOGY_ARTEFACT", "ontology_index.pickle")
+#the Authorization header the geohash index is loaded with - behind label filtering, a service identity that can see every building
+geohash_index_auth = os.getenv("GEOHASH_INDEX_AUTH", "")
+#without that identity, the index would only hold the buildings an anonymous caller can see, so it is off unless asked for
+geohash_index_enabled = os.getenv("GEOHASH_INDEX", "True" if geohash_index_auth else "False").lower() == "true"
+geohash_index_refresh_seconds = int(os.getenv("GEOHASH_INDEX_REFRESH_SECONDS", "600"))
+buildings_query_mode = os.getenv("BUILDINGS_QUERY_MODE", "JOINED")
+buildings_cache_enabled = os.getenv("BUILDINGS_CACHE", "True").lower() == "true"
+buildings_cache_db = os.getenv("BUILDINGS_CACHE_DB", "buildings_cache.db")
+buildings_cache_bytes = int(os.getenv("BUILDINGS_CACHE_BYTES", str(64*1024*1024)))
+buildings_cache_ttl = float(os.getenv("BUILDINGS_CACHE_TTL", "60"))
+buildings_cache_write_grace = float(os.getenv("BUILDINGS_CACHE_WRITE_GRACE", "5"))
+buildings_cache_write_timeout = float(os.getenv("BUILDINGS_CACHE_WRITE_TIMEOUT", "300"))
+fast_serialization = os.getenv("FAST_SERIALIZATION", "False").lower() == "true"
+max_buildings_page_size = int(os.getenv("MAX_BUILDINGS_PAGE_SIZE", "5000"))
+viewport_max_cells = int(os.getenv("VIEWPORT_MAX_CELLS", "64"))
+viewport_concurrency = int(os.getenv("VIEWPORT_CONCURRENCY", "8"))
+uprn_index_enabled = os.getenv("UPRN_INDEX", "True").lower() == "true"
+uprn_index_size = int(os.getenv("UPRN_INDEX_SIZE", "200000"))
+uprn_index_ttl = float(os.getenv("UPRN_INDEX_TTL", "3600"))
+max_uprn_batch = int(os.getenv("MAX_UPRN_BATCH", "50000"))
+uprn_chunk_size = int(os.getenv("UPRN_CHUNK_SIZE", "500"))
+uprn_concurrency = int(os.getenv("UPRN_CONCURRENCY", "8"))
+read_model_enabled = os.getenv("READ_MODEL", "False").lower() == "true"
+read_model_file = os.getenv("READ_MODEL_FILE", "read_model.pickle")
+#in KAFKA mode the read model follows the knowledge topic, otherwise the workers share their writes through this file
+read_model_topic_file = os.getenv("READ_MODEL_TOPIC_FILE", "" if update_mode == "KAFKA" else "read_model_writes.jsonl")
+read_model_refresh_seconds = int(os.getenv("READ_MODEL_REFRESH_SECONDS", "3600"))
+read_model_save_seconds = int(os.getenv("READ_MODEL_SAVE_SECONDS", "60"))
+#the read model serves every building to every caller whatever its security label, so it has to be turned on knowingly
+read_model_unlabelled = os.getenv("READ_MODEL_UNLABELLED", "False").lower() == "true"
+if read_model_enabled and not read_model_unlabelled:
+    raise Exception("READ_MODEL ignores security labels and serves all the buildings to every caller - set READ_MODEL_UNLABELLED=True as well to turn it on")
 
 broker = os.getenv("BOOTSTRAP_SERVERS","localhost:9092")
 fpTopic = os.getenv("IES_TOPIC","knowledge")
-
-
-if update_mode == "KAFKA":
+kafka_batching = os.getenv("KAFKA_BATCHING", "True").lower() == "true"
+kafka_linger_ms = int(os.getenv("KAFKA_LINGER_MS", "20"))
+kafka_batch_bytes = int(os.getenv("KAFKA_BATCH_BYTES", "900000"))
+kafka_queue_size = int(os.getenv("KAFKA_QUEUE_SIZE", "10000"))
+kafka_enqueue_timeout = float(os.getenv("KAFKA_ENQUEUE_TIMEOUT", "1"))
+kafka_retries = int(os.getenv("KAFKA_RETRIES", "3"))
+kafka_retry_backoff = float(os.getenv("KAFKA_RETRY_BACKOFF", "0.5"))
+jena_warm_connections = int(os.getenv("JENA_WARM_CONNECTIONS", "4"))
+
+#In KAFKA mode the sink is created when the API starts (by start_kafka), so importing the API doesn't connect to the broker
+knowledgeSink = None
+knowledgeAdapter = None
+
+def start_kafka():
+    global knowledgeSink, knowledgeAdapter
     from maplib.sinks import KafkaSink
-    from maplib import Adapter, Record,RecordUtils
-
+    from maplib import Adapter
     knowledgeSink = KafkaSink(topic=fpTopic, broker=broker)
     knowledgeAdapter = Adapter(knowledgeSink, name="IoW Write-Back API",source_name="local data")
 
+#In KAFKA mode writes are queued and sent in batches (per security label) by a background task, rather than in the request
+producer = None
+#What to undo if the writes a request makes are dropped by the producer after it has returned - the known persons it
+#claimed and its Idempotency-Key - so they are made again when the request is retried
+dropped_write_undos = contextvars.ContextVar("dropped_write_undos", default=())
+
+def undo_if_dropped(undo):
+    dropped_write_undos.set((*dropped_write_undos.get(), undo))
+
 def get_headers(security_labels):
-    return RecordUtils.to_headers({"Security-Label":security_labels, "Content-Type": "application/n-triples"})
+    #a copy, so the cached headers can't be changed by whatever the record is passed to
+    return list(build_kafka_headers(security_labels))
+
+@lru_cache(maxsize=label_cache_size)
+def build_kafka_headers(security_labels):
+    from maplib import RecordUtils
+    return tuple(RecordUtils.to_headers({"Security-Label":security_labels, "Content-Type": "application/n-triples"}))
+
+@lru_cache(maxsize=label_cache_size)
+def build_scg_headers(security_labels):
+    return {
+        'Accept': '*/*',
+        'Security-Label':security_labels,
+        'Content-Type': 'application/sparql-update',
+    }
+
+def clear_label_caches():
+    canonical_label_key.cache_clear()
+    render_security_label.cache_clear()
+    build_scg_headers.cache_clear()
+    build_kafka_headers.cache_clear()
 
 config = configparser.ConfigParser()
 config.read('setup.cfg')
@@ -83,12 +220,19 @@ ndt_ont="http://nationaldigitaltwin.gov.uk/ontology#"
 
 access_url = f"{access_protocol}://{access_host}:{access_port}"
 jena_url = f"{jenaProtocol}://{jenaURL}:{jenaPort}"
+sparql_client = SparqlClient(jena_url, pool_size=jena_pool_size, keepalive=jena_keepalive, timeout=jena_timeout, connect_timeout=jena_connect_timeout, http2=jena_http2)
 def add_prefix(prefix,uri):
+    global prefix_codec
     prefix_dict[prefix] = uri
+    prefix_codec = PrefixCodec(prefix_dict)
+
 
 
+#Settings and warm caches shared by all the workers on this host, so they agree on settings changed through the API
+#and only one of them needs to ask Jena or Access for the same thing
+shared_state = SharedState(shared_state_db) if shared_state_enabled else None
 
-access_client = AccessClient(access_url, dev_mode)
+access_client = AccessClient(access_url, dev_mode, cache_ttl=access_cache_ttl, cache_size=access_cache_size, pool_size=access_pool_size, timeout=access_timeout, shared_state=shared_state)
 prefix_dict = {}
 add_prefix("xsd","http://www.w3.org/2001/XMLSchema#")
 add_prefix("dc","http://purl.org/dc/elements/1.1/")
@@ -110,19 +254,18 @@ def format_prefixes():
     return prefixes
 
 def shorten(uri):
-    for prefix in prefix_dict:
-        stub = prefix_dict[prefix]
-        uri = uri.replace(stub,prefix+":")
-    return uri
+    return prefix_codec.shorten(uri)
 
 def lengthen(uri):
-    for prefix in prefix_dict:
-        stub = prefix_dict[prefix]
-        uri = uri.replace(prefix+":",stub)
-    return uri
+    return prefix_codec.lengthen(uri)
 
 prefixes = format_prefixes()
 
+#People whose person triples have already been written, shared by all the workers on this host
+known_persons = KnownPersons(known_persons_db, ttl=known_persons_ttl, max_size=known_persons_size) if known_persons_enabled else None
+#The URIs minted by writes made with an Idempotency-Key, so retries of them don't write again
+idempotency_store = IdempotencyStore(idempotency_db, ttl=idempotency_ttl, max_size=idempotency_size, wait=idempotency_wait, pending_timeout=jena_timeout*2) if idempotency_enabled else None
+
 #Test person is created so we can assign assessments to someone. Once access to user info is available, this will be replaced with the logged in user. i.e. this is just a temporary fix for testing purposes.
 test_person_uri = data_uri_stub+"TestUser"
 
@@ -204,6 +347,18 @@ class Building(IesThing):
     flags:Dict = {}
 
 
+class FlagTypeEnum(str, Enum):
+    visit = "ndt:InterestedInVisiting"
+    investigate = "ndt:InterestedInInvestigating"
+
+class BatchFlag(BaseModel):
+    """
+    One flag in a batch - the URI of the flagged entity, the type of flag and (optionally) its security label
+    """
+    uri: str
+    flagType: FlagTypeEnum
+    securityLabel: EDH = None
+
 class IesEntityAndStates(BaseModel):
     entity:IesEntity
     states:List[IesState]
@@ -225,12 +380,88 @@ def mint_uri(item:IesThing):
         item.securityLabel = default_security_label
     return item
 
-with open('README.md', 'r') as file:
-    description = file.read()
 
+async def refresh_periodically(refresh, interval:int):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await refresh()
+        except Exception as e:
+            print(e)
+
+#What the background warm-up has done, for /ready
+warm_up_status = {"ready":False, "seconds":None}
+
+async def warm_up():
+    """
+    Loads what the first requests would otherwise have to wait for, after the worker has started accepting them -
+    the ontology class hierarchy, the connections to Jena, and the modules that are only imported when first used
+    """
+    started = time.perf_counter()
+    try:
+        await refresh_ontology_index(initial=True)
+    except Exception as e:
+        print(f"Could not load the ontology ({e})")
+    try:
+        #opening the connections now saves the first requests waiting for them
+        await asyncio.gather(*[sparql_client.query("ASK {}", {}, dataset) for _ in range(jena_warm_connections)])
+    except (httpx.HTTPError, ValueError) as e:
+        print(f"Could not open connections to Jena ({e})")
+    try:
+        #maplib is imported the first time a label is rendered
+        label_string = await run_in_threadpool(default_security_label.to_string)
+        if update_mode == "KAFKA":
+            get_headers(label_string)
+    except Exception as e:
+        print(f"Could not render the default security label ({e})")
+    warm_up_status["seconds"] = round(time.perf_counter() - started, 3)
+    warm_up_status["ready"] = True
+
+async def wait_for_ontology():
+    #requests that check classes against the ontology wait for the warm-up to load it, rather than failing the check
+    deadline = time.monotonic() + jena_timeout
+    while not ontology_index.is_loaded():
+        if time.monotonic() > deadline:
+            raise HTTPException(503, "The ontology is still loading, please retry")
+        await asyncio.sleep(0.05)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global producer
+    if update_mode == "KAFKA":
+        #connecting to the broker is blocking, so keep it off the event loop
+        await run_in_threadpool(start_kafka)
+    if update_mode == "KAFKA" and kafka_batching:
+        producer = BatchingProducer(send_to_kafka, linger_ms=kafka_linger_ms, max_batch_bytes=kafka_batch_bytes, max_queue=kafka_queue_size, enqueue_timeout=kafka_enqueue_timeout,
+                                     retries=kafka_retries, retry_backoff=kafka_retry_backoff)
+        producer.start()
+    if shared_state is not None:
+        shared_state.watch("default_security_label", apply_default_security_label)
+        shared_state.watch("data_uri_stub", apply_data_uri_stub)
+        shared_state.watch("ontology_index", ontology_index.load_from_artefact)
+        #pick up the settings changed, and the ontology loaded, by workers that started before this one
+        await run_in_threadpool(shared_state.sync)
+    refresh_tasks = [asyncio.create_task(warm_up()), asyncio.create_task(metrics.sample_periodically(lambda: producer))]
+    if ontology_refresh_seconds > 0:
+        refresh_tasks.append(asyncio.create_task(refresh_periodically(refresh_ontology_index, ontology_refresh_seconds)))
+    if read_model is not None:
+        refresh_tasks.extend(start_read_model())
+    if geohash_index_enabled:
+        #the first load of the geohash index can take a while on a big dataset, so /buildings falls back to querying Jena until it is ready
+        refresh_tasks.append(asyncio.create_task(refresh_geohash_index()))
+        if geohash_index_refresh_seconds > 0:
+            refresh_tasks.append(asyncio.create_task(refresh_periodically(refresh_geohash_index, geohash_index_refresh_seconds)))
+    yield
+    for task in refresh_tasks:
+        task.cancel()
+    if producer is not None:
+        #send anything still queued before the worker exits
+        await producer.stop()
+    await sparql_client.close()
+    metrics.mark_process_dead()
 
 app = FastAPI(title="NDT Assessment Write-Back API",
-              description=description,
+              lifespan=lifespan,
               docs_url="/api-docs",
               openapi_url="/api-docs/openapi.json",
               license_info={
@@ -238,124 +469,381 @@ app = FastAPI(title="NDT Assessment Write-Back API",
                     "url": "https://www.apache.org/licenses/LICENSE-2.0.html"
             })
 
+def openapi():
+    #the description is the README, which is only read when the docs are first asked for rather than when the API is imported
+    if app.openapi_schema is None:
+        with open('README.md', 'r') as file:
+            app.description = file.read()
+    return FastAPI.openapi(app)
+
+app.openapi = openapi
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True, 
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
+if shared_state is not None:
+    app.add_middleware(SharedStateMiddleware, state=shared_state)
+
+
+#Local copy of the ontology class hierarchy that is used to check that certain classes exist before posting references to them
+ontology_index = OntologyIndex()
+#Local index of building locations, used to find the buildings in a geohash without a full scan in Jena
+geohash_index = GeohashIndex()
+#The buildings UPRNs have been looked up for, so looking them up again doesn't need Jena to find them
+uprn_index = UprnIndex(max_size=uprn_index_size, ttl=uprn_index_ttl) if uprn_index_enabled else None
+#Rendered /buildings responses, per geohash and security context, evicted when something in them is written to
+buildings_cache = ResponseCache(buildings_cache_db or None, max_bytes=buildings_cache_bytes, ttl=buildings_cache_ttl, write_grace=buildings_cache_write_grace, write_timeout=buildings_cache_write_timeout) if buildings_cache_enabled else None
+#Local copy of the buildings, kept current with the writes, that /buildings is answered from (without Jena) once it is loaded
+read_model = ReadModel(shorten, lengthen) if read_model_enabled else None
+#Where the read model reads the writes from - the knowledge topic, or the file standing in for it
+knowledge_topic = None
+
+async def run_sparql_query(query:str,headers:dict[str,str], query_dataset=dataset):
+    try: 
+        return await sparql_client.query(prefixes + query, headers, query_dataset)
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(e.response.status_code)
 
-
-#Local dictionaries that are used to check that certain classes exist before posting references to them
-assessment_classes = {}
-building_state_classes = {}
-
-def run_sparql_query(query:str,headers:dict[str,str], query_dataset=dataset):
-    global jena_url
-    get_uri = jena_url+"/"+ query_dataset +"/query"
+def send_to_kafka(security_label:str, outData:str):
+    from maplib import Record
     try: 
-        response = requests.get(get_uri,params={'query':prefixes + query}, headers=headers)
-        response.raise_for_status()
-        return response.json()
-    except exceptions.HTTPError as e:
+        record = Record(get_headers(security_label),None,outData)
+        with metrics.timed(metrics.kafka_latency):
+            knowledgeAdapter.send(record)
+        metrics.kafka_bytes.inc(len(outData))
+    except Exception as e: 
+        print(e)
+        raise e
+
+async def send_knowledge(outData:str, sec_label:EDH):
+    if producer is None:
+        #sending to Kafka is blocking, so keep it off the event loop
+        await run_in_threadpool(send_to_kafka, sec_label.to_string(), outData)
+        return
+    try:
+        await producer.submit(sec_label.to_string(), outData, dropped_write_undos.get())
+    except ProducerFull:
+        raise HTTPException(503, "Too many writes waiting to be sent, please retry")
+
+def sparql_update_to_ntriples(query:str):
+    #rdflib's SPARQL engine is only needed (and only imported) for writes that aren't built with a TripleBuilder
+    from rdflib import Graph
+    g = Graph()
+    g.update(prefixes+query)
+    return g.serialize(format='nt')
+
+async def send_scg_update(query:str, forwarding_headers:dict[str,str], sec_label:EDH):
+    headers = {**build_scg_headers(sec_label.to_string()), **forwarding_headers}
+    try:
+        await sparql_client.update(query, headers, dataset)
+    except httpx.HTTPStatusError as e: 
         raise HTTPException(e.response.status_code)
 
-def run_sparql_update(query:str,forwarding_headers:dict[str,str]={}, securityLabel=None):
-    global jena_url, default_security_label
+async def run_triples_update(triples:TripleBuilder, forwarding_headers:dict[str,str]={}, securityLabel=None):
     sec_label = securityLabel
-
     if sec_label is None:
         sec_label = default_security_label
     if update_mode == "SCG":
-    
-        post_uri =  jena_url+"/"+ dataset +"/update"
-        headers = {
-            'Accept': '*/*',
-            'Security-Label':sec_label.to_string(),
-            'Content-Type': 'application/sparql-update',
-            **forwarding_headers
-        }
-        try:
-            requests.post(post_uri,headers=headers,data=prefixes+query)
-        except exceptions.HTTPError as e: 
-            raise HTTPException(e.response.status_code)
+        await send_scg_update(triples.to_sparql_insert(), forwarding_headers, sec_label)
     elif update_mode == "KAFKA":
-        g = Graph()
-        g.update(query)
-        outData = g.serialize(format='nt')
-        try: 
-            record = Record(get_headers(sec_label.to_string()),None,outData)
-            knowledgeAdapter.send(record)
-        except Exception as e: 
-            print(e)
-            raise e
+        await send_knowledge(triples.to_ntriples(), sec_label)
     else:
         raise Exception("unknown update mode: "+update_mode)
+    if read_model is not None:
+        apply_own_write(triples.to_ntriples(), sec_label)
 
+async def run_sparql_update(query:str,forwarding_headers:dict[str,str]={}, securityLabel=None):
+    sec_label = securityLabel
 
-def get_subtypes(super_class,headers:dict[str,str], exclude_super = None):
-    sub_classes = {}
-    sub_list = []
-    if exclude_super != None and exclude_super != "":
-        filter_clause = f"""FILTER NOT EXISTS {{ ?sub rdfs:subClassOf* <{exclude_super}>  }}  """
+    if sec_label is None:
+        sec_label = default_security_label
+    if update_mode == "SCG":
+        await send_scg_update(prefixes+query, forwarding_headers, sec_label)
+    elif update_mode == "KAFKA":
+        #parsing the update is blocking, so keep it off the event loop
+        outData = await run_in_threadpool(sparql_update_to_ntriples, query)
+        await send_knowledge(outData, sec_label)
     else:
-        filter_clause = """"""
-    results = run_sparql_query(f"""
-        SELECT ?sub ?parent ?comment WHERE 
-            {{
-                ?sub rdfs:subClassOf* <{super_class}> . 
-                ?sub rdfs:subClassOf ?parent .
-                OPTIONAL {{ ?sub rdfs:comment ?comment}}
-                {filter_clause}
-            }}""",headers,  query_dataset=ontoDataset)
+        raise Exception("unknown update mode: "+update_mode)
 
-    if results and results['results'] and results['results']['bindings']:
-        for sub in results['results']['bindings']:
-            sub_uri=sub['sub']['value']
-            if sub_uri not in sub_classes:
-                #create a new empty(ish) item
-                my_obj = {"uri":sub_uri,"shortName":shorten(sub_uri),"superClasses":[],"description":[]}
-                sub_classes[sub_uri]= my_obj
-            else:
-                my_obj = sub_classes[sub_uri]
-            #If there are any comments, append them
-            if "comment" in sub and sub['comment']['value'] not in sub_classes[sub['sub']['value']]["description"]:
-                sub_classes[sub_uri]["description"].append(sub['comment']['value'])
-            #There may be more than one parent, so append them as we find them
-            if sub['parent']['value'] not in my_obj["superClasses"]:
-                    my_obj["superClasses"].append(sub['parent']['value'])
 
+def share_ontology_index():
+    if shared_state is not None:
+        shared_state.set("ontology_index", ontology_index.to_artefact())
+
+async def refresh_ontology_index(initial=False, force=False):
+    if initial and ontology_index.is_loaded():
+        #another worker on this host has already loaded it and shared it
+        return
+    if not initial and not force and shared_state is not None and not await run_in_threadpool(shared_state.claim, "ontology_refresh", ontology_refresh_seconds / 2):
+        #another worker on this host is refreshing it, and will share what it loads
+        return
+    if initial and ontology_artefact and os.path.exists(ontology_artefact):
+        #the precompiled hierarchy written by ontology_loader.py saves querying Jena on startup - the periodic refresh picks up any changes
+        try:
+            await run_in_threadpool(ontology_index.load_artefact, ontology_artefact)
+            return
+        except Exception as e:
+            print(f"Could not load the ontology artefact {ontology_artefact} ({e})")
+    if ontology_source == "JENA":
+        try:
+            results = await run_sparql_query(hierarchy_query, {}, query_dataset=ontoDataset)
+            if results and results['results'] and results['results']['bindings']:
+                ontology_index.load_sparql_results(results, jena_url+"/"+ontoDataset)
+                await run_in_threadpool(share_ontology_index)
+                return
+            print("No ontology found in Jena, falling back to the bundled ontology files")
+        except (HTTPException, httpx.HTTPError) as e:
+            print(f"Could not load the ontology from Jena ({e}), falling back to the bundled ontology files")
+    #parsing the turtle files is blocking, so keep it off the event loop
+    await run_in_threadpool(ontology_index.load_files, ontology_files)
+    await run_in_threadpool(share_ontology_index)
+
+async def refresh_geohash_index():
+    headers = {"Authorization":geohash_index_auth} if geohash_index_auth else {}
+    try:
+        results = await run_sparql_query(location_query, headers)
+    except (HTTPException, httpx.HTTPError) as e:
+        print(f"Could not load the geohash index from Jena ({e})")
+        return
+    if results and results['results'] and results['results']['bindings']:
+        #sorting every location is blocking, so keep it off the event loop - the new arrays are swapped in once sorted
+        await run_in_threadpool(geohash_index.load_sparql_results, results)
+
+def read_model_ready():
+    return read_model is not None and read_model.is_loaded()
+
+def apply_own_write(payload:str, sec_label:EDH):
+    #so the worker's own writes can be read straight back, rather than once they have come round the topic
+    read_model.apply_ntriples(payload)
+    if update_mode != "KAFKA" and isinstance(knowledge_topic, FileTopic):
+        #and so the other workers see them
+        knowledge_topic.send(sec_label.to_string(), payload)
+
+read_model_states_query = """
+    SELECT ?building ?state ?stateType WHERE {
+        ?building ies:inLocation ?geopoint .
+        ?state ies:isStateOf ?building .
+        ?state rdf:type ?stateType .
+    }"""
+
+async def load_read_model_from_jena():
+    #the offset is taken first, so writes made while Jena is being queried are read from the topic again afterwards
+    offset = await run_in_threadpool(knowledge_topic.end_offset) if knowledge_topic is not None else None
+    read_model.start_loading()
+    try:
+        queries = [location_query, *split_buildings_queries("?building ies:inLocation ?geopoint ."), read_model_states_query]
+        locations, types, ratings, identifiers, flags, states = await asyncio.gather(*[run_sparql_query(query, {}) for query in queries])
+        columns = await run_in_threadpool(build_read_model_columns, locations, types, ratings, identifiers, flags, states)
+    except BaseException:
+        read_model.loading = False
+        raise
+    read_model.swap(columns, offset)
+    print(f"Loaded {len(read_model)} buildings into the read model from Jena")
+
+def build_read_model_columns(locations, types, ratings, identifiers, flags, states):
+    pairs = [(row["geopoint"]["value"][len(geohash_stub):], row["building"]["value"]) for row in result_rows(locations)]
+    buildings = sorted({building for _, building in pairs})
+    building_states = {}
+    for row in result_rows(states):
+        states_of_building = building_states.setdefault(row["building"]["value"], {})
+        state_types = states_of_building.setdefault(row["state"]["value"], [])
+        if row["stateType"]["value"] not in state_types:
+            state_types.append(row["stateType"]["value"])
+    building_states = {building: list(states_of_building.items()) for building, states_of_building in building_states.items()}
+    columns = build_columns(join_buildings(buildings, types, ratings, identifiers, flags), pairs, building_states, lengthen)
+    return index_columns(columns)
+
+async def save_read_model():
+    await run_in_threadpool(write_snapshot, read_model.snapshot(), read_model_file)
+
+async def load_read_model_snapshot():
+    snapshot = await run_in_threadpool(read_snapshot, read_model_file)
+    read_model.swap(snapshot["columns"], snapshot["offset"])
+    print(f"Loaded {len(read_model)} buildings into the read model from {read_model_file}")
+
+async def wait_for_read_model_snapshot(timeout:float):
+    started = os.path.getmtime(read_model_file) if os.path.exists(read_model_file) else 0
+    deadline = asyncio.get_running_loop().time() + timeout
+    while asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(5)
+        if os.path.exists(read_model_file) and os.path.getmtime(read_model_file) > started:
+            await load_read_model_snapshot()
+            return
+
+async def refresh_read_model(initial=False):
+    if initial and read_model_file and os.path.exists(read_model_file):
+        #the snapshot saves querying Jena on startup - the topic is read on from where it was saved, and the periodic refresh picks up anything else
+        try:
+            await load_read_model_snapshot()
+            return
+        except Exception as e:
+            print(f"Could not load the read model from {read_model_file} ({e})")
+    if shared_state is not None and not await run_in_threadpool(shared_state.claim, "read_model_refresh", max(read_model_refresh_seconds / 2, 60)):
+        #another worker on this host is loading it from Jena, and will save it for the others
+        if initial and read_model_file:
+            await wait_for_read_model_snapshot(jena_timeout * 2)
+        return
+    try:
+        await load_read_model_from_jena()
+    except (HTTPException, httpx.HTTPError) as e:
+        print(f"Could not load the read model from Jena ({e})")
+        return
+    if read_model_file:
+        await save_read_model()
+
+async def save_read_model_periodically():
+    while True:
+        await asyncio.sleep(read_model_save_seconds)
+        if not read_model.is_loaded() or read_model.changes == 0 or not read_model_file:
+            continue
+        #the workers all apply the same writes, so only one of them needs to save them
+        if shared_state is not None and not await run_in_threadpool(shared_state.claim, "read_model_save", read_model_save_seconds / 2):
+            continue
+        try:
+            await save_read_model()
+        except Exception as e:
+            print(f"Could not save the read model to {read_model_file} ({e})")
+
+async def follow_knowledge_topic():
+    while True:
+        if not read_model.is_loaded():
+            await asyncio.sleep(1)
+            continue
+        loaded_at = read_model.loaded_at
+        try:
+            payloads, offset = await run_in_threadpool(knowledge_topic.poll, read_model.offset)
+        except Exception as e:
+            print(f"Could not read the writes for the read model ({e})")
+            await asyncio.sleep(5)
+            continue
+        changed = set()
+        for payload in payloads:
+            changed.update(read_model.apply_ntriples(payload))
+        if changed and buildings_cache is not None:
+            #this worker's cache, as each worker reads the topic itself
+            buildings_cache.evict_local(changed)
+        if read_model.loaded_at is loaded_at:
+            #unless a new copy was swapped in while polling, which has its own offset
+            read_model.offset = offset
+        if not payloads:
+            await asyncio.sleep(0.1)
+
+def start_read_model():
+    global knowledge_topic
+    if read_model_topic_file:
+        knowledge_topic = FileTopic(read_model_topic_file)
+    elif update_mode == "KAFKA":
+        try:
+            knowledge_topic = KafkaTopic(fpTopic, broker)
+        except Exception as e:
+            print(f"Could not read the knowledge topic for the read model ({e}), so it only picks up this worker's writes")
+    tasks = [asyncio.create_task(refresh_read_model(initial=True)), asyncio.create_task(save_read_model_periodically())]
+    if knowledge_topic is not None:
+        tasks.append(asyncio.create_task(follow_knowledge_topic()))
+    if read_model_refresh_seconds > 0:
+        tasks.append(asyncio.create_task(refresh_periodically(refresh_read_model, read_model_refresh_seconds)))
+    return tasks
+
+def get_subtypes(super_class, exclude_super = None):
+    sub_classes = {}
     sub_list = []
-    for key in sub_classes:
-        sub = sub_classes[key]
-        sub_list.append({"uri":key,"shortName":sub["shortName"],"superClasses":sub["superClasses"],description:sub["description"]})
+    for sub_uri in sorted(ontology_index.subclasses(super_class)):
+        if exclude_super != None and exclude_super != "" and ontology_index.is_subclass(sub_uri, exclude_super):
+            continue
+        my_obj = {"uri":sub_uri,"shortName":shorten(sub_uri),"superClasses":list(ontology_index.parents[sub_uri]),"description":list(ontology_index.comments[sub_uri])}
+        sub_classes[sub_uri] = my_obj
+        sub_list.append(my_obj)
     
     return sub_classes, sub_list
 
 
+async def get_user(request:Request):
+    #cached users are returned straight away, only a call to Access needs to go to the threadpool
+    user = access_client.cached_user_details(request.headers)
+    if user is not None:
+        return user
+    try:
+        return await run_in_threadpool(access_client.get_user_details, request.headers)
+    except exceptions.RequestException as e:
+        if e.response is not None:
+            raise HTTPException(e.response.status_code, f"Error calling Access:{e.response.reason}")
+        else: 
+            raise HTTPException(500, f"Error calling Access, Internal Server Error")
+
+def person_uri(user_id):
+    return data_uri_stub+user_id
+
 def create_person_insert(user_id, username):
     names = username.split(" ")
-    uri =  data_uri_stub+user_id
-    return uri, f'''
-        <{uri}> a ies:Person .
-        <{uri}> ies:hasName <{uri+"_NAME"}> .
-        <{uri+"_NAME"}> a ies:PersonName .
-        <{uri+"_SURNAME"}> a ies:Surname .
-        <{uri+"_SURNAME"}> ies:inRepresentation <{uri+"_NAME"}> .
-        <{uri+"_SURNAME"}> ies:representationValue "{names[1]}" .
-        <{uri+"_GIVENNAME"}> a ies:GivenName .
-        <{uri+"_GIVENNAME"}> ies:inRepresentation <{uri+"_NAME"}> .
-        <{uri+"_GIVENNAME"}> ies:representationValue "{names[0]}" .
-    '''
+    surname = names[1] if len(names) > 1 else ""
+    uri =  person_uri(user_id)
+    triples = TripleBuilder()
+    triples.add_type(uri, ies+"Person")
+    triples.add(uri, ies+"hasName", uri+"_NAME")
+    triples.add_type(uri+"_NAME", ies+"PersonName")
+    triples.add_type(uri+"_SURNAME", ies+"Surname")
+    triples.add(uri+"_SURNAME", ies+"inRepresentation", uri+"_NAME")
+    triples.add_literal(uri+"_SURNAME", ies+"representationValue", surname)
+    triples.add_type(uri+"_GIVENNAME", ies+"GivenName")
+    triples.add(uri+"_GIVENNAME", ies+"inRepresentation", uri+"_NAME")
+    triples.add_literal(uri+"_GIVENNAME", ies+"representationValue", names[0])
+    return uri, triples
+
+async def run_person_update(triples:TripleBuilder, user, forwarding_headers:dict[str,str]={}, securityLabel=None):
+    """
+    Writes the triples along with the person triples for the user - unless they have already been written under this label
+    """
+    sec_label = securityLabel
+    if sec_label is None:
+        sec_label = default_security_label
+    label_string = sec_label.to_string()
+    #the claim is a SQLite write that can wait on other workers, so keep it off the event loop
+    emit_person = known_persons is None or await run_in_threadpool(known_persons.claim, user['user_id'], user["username"], label_string)
+    if emit_person:
+        uri, person = create_person_insert(user['user_id'], user["username"])
+        triples.extend(person)
+        if known_persons is not None:
+            undo_if_dropped(lambda: known_persons.forget(user['user_id'], label_string))
+    try:
+        await run_triples_update(triples, forwarding_headers=forwarding_headers, securityLabel=sec_label)
+    except BaseException:
+        if emit_person and known_persons is not None:
+            await run_in_threadpool(known_persons.forget, user['user_id'], label_string)
+        raise
+
+async def run_idempotently(request:Request, user, body:str, write):
+    """
+    Runs write (which returns the URIs it mints) once per Idempotency-Key a user sends to an endpoint - retries with
+    the same key get the URIs minted the first time, without writing again
+    """
+    key = request.headers.get("idempotency-key")
+    if key is None or idempotency_store is None:
+        return await write()
+    if len(key) == 0 or len(key) > 255:
+        raise HTTPException(422, "Idempotency-Key must be between 1 and 255 characters")
+    store_key = request_key(user['user_id'], request.url.path, key)
+    undo_if_dropped(lambda: idempotency_store.forget(store_key))
+    try:
+        return await idempotency_store.run(store_key, fingerprint(body), write)
+    except IdempotencyConflict:
+        raise HTTPException(422, "Idempotency-Key has already been used for a different request")
+    except IdempotencyInProgress:
+        raise HTTPException(409, "A request with this Idempotency-Key is still being processed, please retry")
 
 @app.get("/test-user-passthrough")
-def test_user(request: Request):
+async def test_user(request: Request):
     try:
 
-        user = access_client.get_user_details(request.headers)
-        pi = create_person_insert(user['user_id'], user["username"])
-        return [user, pi]
+        user = await run_in_threadpool(access_client.get_user_details, request.headers)
+        uri, person = create_person_insert(user['user_id'], user["username"])
+        return [user, [uri, person.to_ntriples()]]
     except exceptions.HTTPError as e:
         raise HTTPException(e.response.status_code)
 
@@ -363,6 +851,11 @@ def test_user(request: Request):
 def version():
     return config["metadata"]
 
+@app.get("/metrics", description="Prometheus metrics for the API - request latencies by route, and the time spent in Jena, Kafka, Access and folding results. With PROMETHEUS_MULTIPROC_DIR set (as start.sh does) they are totalled over all the workers")
+def get_metrics():
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+
 @app.post("/test-post")
 def test_post(req: Request):
     print("testing post")
@@ -372,23 +865,32 @@ def test_post(req: Request):
 def read_root():
     return {"ok": True}
 
+@app.get("/ready", description="Readiness check - 503 until the worker has warmed up (loaded the ontology and opened its connections to Jena), then 200. The local indexes loaded in the background are listed as well, but aren't waited for")
+def get_ready(response:Response):
+    if not warm_up_status["ready"]:
+        response.status_code = 503
+    return {**warm_up_status, "ontology":ontology_index.is_loaded(), "geohashIndex":geohash_index.is_loaded(), "readModel":read_model_ready()}
+
 @app.get("/assessment-classes", response_model=List[IesClass],description="returns all the subclasses of ies:Assessment that are in the ontology")
-def get_assessments(req:Request):
-    sub_classes, sub_list = get_subtypes(ies+"Assessment", get_forwarding_headers(req.headers))
-    global assessment_classes
-    assessment_classes = sub_classes
+async def get_assessments():
+    await wait_for_ontology()
+    sub_classes, sub_list = get_subtypes(ies+"Assessment")
     return sub_list
 
 @app.get("/buildings/states/classes", response_model=List[IesClass],description="returns all the subclasses of BuildingState that are in the ontology")
-def get_building_state_classes(req: Request):
-    sub_classes, sub_list = get_subtypes(ndt_ont+"BuildingState", get_forwarding_headers(req.headers),exclude_super=ies+"Location")
-    global building_state_classes
-    building_state_classes = sub_classes
+async def get_building_state_classes():
+    await wait_for_ontology()
+    sub_classes, sub_list = get_subtypes(ndt_ont+"BuildingState", exclude_super=ies+"Location")
     return sub_list
 
+@app.post("/ontology/refresh", description="Reloads the local copy of the ontology class hierarchy from Jena (or the bundled ontology files)")
+async def post_ontology_refresh():
+    await refresh_ontology_index(force=True)
+    return {"source":ontology_index.source, "classes":len(ontology_index.parents), "loadedAt":ontology_index.loaded_at}
+
 
 # @app.post("/people",description="Creates a new Person")
-def post_person(per: IesPerson):
+async def post_person(per: IesPerson):
     mint_uri(per)
     query = f'''
     {format_prefixes()}
@@ -404,16 +906,29 @@ def post_person(per: IesPerson):
                 <{per.uri+"_GIVENNAME"}> ies:inRepresentation <{per.uri+"_NAME"}> .
                 <{per.uri+"_GIVENNAME"}> ies:representationValue "{per.givenName}" .
             }}'''
-    run_sparql_update(query=query,securityLabel=per.securityLabel)
+    await run_sparql_update(query=query,securityLabel=per.securityLabel)
     return per.uri
 
-@app.get("/buildings",response_model=List[Building],description="Gets all the buildings inside a geohash (min 5 digits) along with their types, TOIDs, UPRNs, and current energy ratings")
-def get_buildings_in_geohash(geohash:str, req: Request):
-    if len(geohash) < 5:
-        raise HTTPException(422,detail="Lat Lon range too wide, please provide at least five digits")  
-    gh = "http://geohash.org/"+geohash
+def buildings_query(geohash:str, order:bool=False, buildings:list[str]=None):
+    """
+    Builds the query for all the buildings in a geohash. If buildings is given, the query is for just those buildings
+    instead, or None if there are none.
+    If order is set, the rows are ordered by building so that each building's rows arrive together
+    """
+    if buildings is None:
+        buildings = index_candidates(geohash)
+    if buildings is not None:
+        if len(buildings) == 0:
+            return None
+        location_clause = "VALUES ?building { " + " ".join(f"<{building}>" for building in buildings) + " }"
+    else:
+        gh = "http://geohash.org/"+geohash
+        location_clause = f"""?building ies:inLocation ?geopoint .
+            BIND(str(?geopoint) as ?gh) .
+            FILTER (STRSTARTS(?gh,"{gh}") )"""
+    order_clause = "ORDER BY ?building" if order else ""
    
-    query = f"""
+    return f"""
         {format_prefixes()}
         SELECT
             ?building
@@ -431,9 +946,7 @@ def get_buildings_in_geohash(geohash:str, req: Request):
             ?flag_ass_date
             ?flag_assessor
         WHERE {{
-            ?building ies:inLocation ?geopoint .
-            BIND(str(?geopoint) as ?gh) .
-            FILTER (STRSTARTS(?gh,"{gh}") )
+            {location_clause}
             ?building a ?type .
 
             ?state ies:isStateOf ?building .
@@ -469,185 +982,621 @@ def get_buildings_in_geohash(geohash:str, req: Request):
             }}
     
         }}
+        {order_clause}
     """
 
-    out = {}
-    out_array = []
-    results = run_sparql_query(query, get_forwarding_headers(req.headers))
+def index_candidates(geohash:str):
+    """
+    The buildings the geohash index has in the geohash, to be fetched with the caller's headers (so Jena still only
+    returns what they can see). None if the index isn't loaded, or has nothing in the geohash - the buildings in it
+    may have been loaded since the index was, so Jena is asked to find them instead
+    """
+    if not geohash_index.is_loaded():
+        return None
+    buildings = geohash_index.buildings_in(geohash)
+    return buildings if buildings else None
+
+def new_building(building:str, result):
+    return {"uri":building,"uprn":result["uprn_id"]["value"],"currentEnergyRating":result["current_energy_rating"]["value"],"types":[],"flags":{},"invalidatedFlags":[]}
+
+#Folds one row of the buildings query into the building it belongs to - a building is spread over one row per type/flag/assessment combination
+def fold_building_row(building_obj, result):
+    typ = shorten(result["type"]["value"])
+    if typ not in building_obj["types"]:
+        building_obj["types"].append(typ)
+
+    if "flag" in result:
+        fold_flag_row(building_obj["flags"], result)
+
+    if "building_toid_id" in result:
+        building_obj["buildingTOID"] = result["building_toid_id"]["value"]
+    elif "parent_building_toid_id" in result:
+        building_obj["parentBuildingTOID"] = result["parent_building_toid_id"]["value"]
+
+def fold_flag_row(flags, result):
+    flag = shorten(result["flag"]["value"])
+    if not flag in flags:
+        flag_obj = {"flagType":shorten(result["flag_type"]["value"]),"flaggedBy":result["flag_person"]["value"],"date":result["flag_date"]["value"]}
+        flags[flag] = flag_obj
+    else:
+        flag_obj = flags[flag]
+    if "flag_assessment" in result:
+        flag_obj["invalidated"] = result["flag_ass_date"]["value"]
+        flag_obj["invalidatedBy"] = result["flag_assessor"]["value"]
 
+async def get_building_uris(geohash:str, headers:dict[str,str], after:str=None, limit:int=None):
+    """
+    The URIs of the buildings in a geohash, sorted - if after is given only those after it, and at most limit of them
+    """
+    buildings = read_model.building_uris(geohash) if read_model_ready() else index_candidates(geohash)
+    if buildings is not None:
+        start = bisect_right(buildings, after) if after is not None else 0
+        return buildings[start:start + limit] if limit is not None else buildings[start:]
+    after_clause = f'FILTER (STR(?building) > "{after}")' if after is not None else ""
+    limit_clause = f"ORDER BY ?building LIMIT {limit}" if limit is not None else ""
+    query = f"""
+        SELECT DISTINCT ?building WHERE {{
+            ?building ies:inLocation ?geopoint .
+            FILTER (STRSTARTS(STR(?geopoint),"http://geohash.org/{geohash}"))
+            {after_clause}
+        }}
+        {limit_clause}"""
+    results = await run_sparql_query(query, headers)
+    return sorted(row["building"]["value"] for row in result_rows(results))
+
+def result_rows(results):
     if results and results['results'] and results['results']['bindings']:
-        for result in results['results']['bindings']:
-            building = shorten(result["building"]["value"])
-            typ = shorten(result["type"]["value"])
-            if building in out:
-                building_obj = out[building]
-                if typ not in building_obj["types"]:
-                    building_obj["types"].append(typ)
-            else:
-                energy_rating = result["current_energy_rating"]["value"]
-                building_obj = {"uri":building,"uprn":result["uprn_id"]["value"],"currentEnergyRating":energy_rating,"types":[typ],"flags":{},"invalidatedFlags":[]}
-                out[building] = building_obj
-                out_array.append(building_obj)
-
-            if "flag" in result:
-                flag = shorten(result["flag"]["value"])
-                if not flag in building_obj["flags"]:
-                    flag_obj = {"flagType":shorten(result["flag_type"]["value"]),"flaggedBy":result["flag_person"]["value"],"date":result["flag_date"]["value"]}
-                    building_obj["flags"][flag] = flag_obj
+        return results['results']['bindings']
+    return []
+
+def split_buildings_queries(values_clause:str):
+    """
+    The narrow queries used to fetch the buildings in SPLIT mode - the types, energy ratings, identifiers and flags of
+    the buildings. Each returns about one row per fact, instead of one row per combination of facts like buildings_query
+    """
+    return [
+        f"""SELECT ?building ?type WHERE {{
+            {values_clause}
+            ?building a ?type .
+        }}""",
+        f"""SELECT ?building ?current_energy_rating WHERE {{
+            {values_clause}
+            ?state ies:isStateOf ?building .
+            ?state a ?energy_rating .
+            BIND(REPLACE(str(?energy_rating),"http://gov.uk/government/organisations/department-for-levelling-up-housing-and-communities/ontology/epc#BuildingWithEnergyRatingOf","","i") as ?current_energy_rating)
+        }}""",
+        f"""SELECT ?building ?uprn_id ?building_toid_id ?parent_building_toid_id WHERE {{
+            {values_clause}
+            {{
+                ?building ies:isIdentifiedBy ?uprn .
+                ?uprn ies:representationValue ?uprn_id .
+                ?uprn rdf:type gp:UniquePropertyReferenceNumber .
+            }} UNION {{
+                ?building ies:isIdentifiedBy ?building_toid .
+                ?building_toid rdf:type ies:TOID .
+                ?building_toid ies:representationValue ?building_toid_id .
+            }} UNION {{
+                ?building ies:isPartOf ?parent_building .
+                ?parent_building ies:isIdentifiedBy ?parent_building_toid .
+                ?parent_building_toid ies:representationValue ?parent_building_toid_id .
+                ?parent_building_toid rdf:type ies:TOID .
+            }}
+        }}""",
+        f"""SELECT ?building ?flag ?flag_type ?flag_person ?flag_date ?flag_assessment ?flag_ass_date ?flag_assessor WHERE {{
+            {values_clause}
+            ?flag ies:interestedIn ?building .
+            ?flag ies:isStateOf ?flag_person .
+            ?flag a ?flag_type .
+            ?flag ies:inPeriod ?flag_date .
+            OPTIONAL {{
+                ?flag_assessment ies:assessed ?flag .
+                ?flag_assessment ies:inPeriod ?flag_ass_date .
+                ?flag_assessment ies:assessor ?flag_assessor .
+            }}
+        }}""",
+    ]
+
+def join_buildings(buildings:list[str], types, ratings, identifiers, flags):
+    """
+    Hash joins the results of the split queries on ?building. As with buildings_query, only buildings with a type, an
+    energy rating and a UPRN are returned
+    """
+    building_types = {}
+    for row in result_rows(types):
+        typ = shorten(row["type"]["value"])
+        types_of_building = building_types.setdefault(row["building"]["value"], [])
+        if typ not in types_of_building:
+            types_of_building.append(typ)
+    building_ratings = {}
+    for row in result_rows(ratings):
+        building_ratings.setdefault(row["building"]["value"], row["current_energy_rating"]["value"])
+    uprns = {}
+    toids = {}
+    parent_toids = {}
+    for row in result_rows(identifiers):
+        building = row["building"]["value"]
+        if "uprn_id" in row:
+            uprns.setdefault(building, row["uprn_id"]["value"])
+        elif "building_toid_id" in row:
+            toids[building] = row["building_toid_id"]["value"]
+        elif "parent_building_toid_id" in row:
+            parent_toids[building] = row["parent_building_toid_id"]["value"]
+    building_flags = {}
+    for row in result_rows(flags):
+        fold_flag_row(building_flags.setdefault(row["building"]["value"], {}), row)
+
+    out_array = []
+    for building in buildings:
+        if building not in building_types or building not in building_ratings or building not in uprns:
+            continue
+        building_obj = {"uri":shorten(building),"uprn":uprns[building],"currentEnergyRating":building_ratings[building],"types":building_types[building],"flags":building_flags.get(building, {}),"invalidatedFlags":[]}
+        if building in toids:
+            building_obj["buildingTOID"] = toids[building]
+        elif building in parent_toids:
+            building_obj["parentBuildingTOID"] = parent_toids[building]
+        out_array.append(building_obj)
+    return out_array
+
+async def get_buildings_split(buildings:list[str], headers:dict[str,str]):
+    #the building set is resolved first (from the geohash index if it is loaded), then everything about those buildings
+    #is fetched with concurrent narrow queries, rather than one query whose rows multiply with every OPTIONAL
+    if len(buildings) == 0:
+        return []
+    values_clause = "VALUES ?building { " + " ".join(f"<{building}>" for building in buildings) + " }"
+    types, ratings, identifiers, flags = await asyncio.gather(*[run_sparql_query(query, headers) for query in split_buildings_queries(values_clause)])
+    with metrics.timed(metrics.fold_latency):
+        return join_buildings(buildings, types, ratings, identifiers, flags)
+
+async def fetch_buildings(geohash:str, headers:dict[str,str]):
+    if read_model_ready():
+        return read_model.buildings_in(geohash)
+    if buildings_query_mode == "SPLIT":
+        return await get_buildings_split(await get_building_uris(geohash, headers), headers)
+    return fold_buildings(await run_sparql_query(buildings_query(geohash), headers))
+
+async def fetch_listed_buildings(buildings:list[str], headers:dict[str,str]):
+    if len(buildings) == 0:
+        return []
+    if read_model_ready():
+        return read_model.buildings(buildings)
+    if buildings_query_mode == "SPLIT":
+        return await get_buildings_split(buildings, headers)
+    out_array = fold_buildings(await run_sparql_query(buildings_query(None, buildings=buildings), headers))
+    #the rows for a list of buildings come back in no particular order
+    positions = {shorten(building): i for i, building in enumerate(buildings)}
+    out_array.sort(key=lambda building_obj: positions[building_obj["uri"]])
+    return out_array
+
+def fold_buildings(results):
+    out = {}
+    out_array = []
+    with metrics.timed(metrics.fold_latency):
+        if results and results['results'] and results['results']['bindings']:
+            for result in results['results']['bindings']:
+                building = shorten(result["building"]["value"])
+                if building in out:
+                    building_obj = out[building]
                 else:
-                    flag_obj = building_obj["flags"][flag]
-                if "flag_assessment" in result:
-                    flag_obj["invalidated"] = result["flag_ass_date"]["value"]
-                    flag_obj["invalidatedBy"] = result["flag_assessor"]["value"]
-
-            if "building_toid_id" in result:
-                building_obj["buildingTOID"] = result["building_toid_id"]["value"]
-            elif "parent_building_toid_id" in result:
-                building_obj["parentBuildingTOID"] = result["parent_building_toid_id"]["value"]
-            
+                    building_obj = new_building(building, result)
+                    out[building] = building_obj
+                    out_array.append(building_obj)
+                fold_building_row(building_obj, result)
     return out_array
 
+buildings_adapter = TypeAdapter(List[Building])
+buildings_renderer = FastRenderer(Building)
+
+def negotiate_buildings(req:Request):
+    #without FAST_SERIALIZATION, buildings are always sent as uncompressed JSON rendered by pydantic, as before
+    if not fast_serialization:
+        return json_type, None
+    return negotiate(req.headers.get("accept"), req.headers.get("accept-encoding"))
+
+def render_buildings(out_array, media_type:str=json_type):
+    if fast_serialization:
+        #the dicts built by the folds are already in the shape of Building, so validating them into models is wasted work
+        return buildings_renderer.render(out_array, media_type)
+    return buildings_adapter.dump_json(buildings_adapter.validate_python(out_array))
+
+def buildings_response(body:bytes, media_type:str, encoding:str):
+    response = Response(body, media_type=media_type)
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    if fast_serialization:
+        response.headers["Vary"] = "Accept, Accept-Encoding"
+    return response
+
+def building_cache_uris(out_array):
+    #everything a write could change in a cached response - the buildings, and the flags that can be invalidated
+    uris = set()
+    for building_obj in out_array:
+        uris.add(lengthen(building_obj["uri"]))
+        for flag in building_obj["flags"]:
+            uris.add(lengthen(flag))
+    return uris
+
+def building_cache_shown(out_array):
+    #the writes a response shows - the flags on its buildings, and which of them have been invalidated
+    shown = set()
+    for building_obj in out_array:
+        for flag, flag_obj in building_obj["flags"].items():
+            shown.add(lengthen(flag))
+            if "invalidated" in flag_obj:
+                shown.add(invalidated(lengthen(flag)))
+    return shown
+
+def invalidated(flag:str):
+    return "invalidated " + flag
+
+async def evict_buildings_cache(uris, awaited=()):
+    #awaited are the writes responses must show before they are cached again - until then, they may be from before the write reached Jena
+    if buildings_cache is not None:
+        await buildings_cache.evict(uris, awaited)
+
+#a cursor is the URI of the last building on the previous page, which must be safe to put in a query
+cursor_uri = re.compile(r'[^\s"<>\\{}|^`]+')
+
+def encode_cursor(building:str):
+    return base64.urlsafe_b64encode(building.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor:str):
+    try:
+        building = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+    except ValueError:
+        building = ""
+    if not cursor_uri.fullmatch(building):
+        raise HTTPException(422,detail="Invalid cursor")
+    return building
+
+async def get_buildings_page(geohash:str, headers:dict[str,str], page_size:int, after:str, media_type:str, encoding:str):
+    #the page is a set of whole buildings, chosen before their rows are fetched, so a building's rows are never split
+    #between pages. One building more than the page size is asked for, to tell whether there is another page
+    buildings = await get_building_uris(geohash, headers, after=decode_cursor(after) if after else None, limit=page_size + 1)
+    out_array = await fetch_listed_buildings(buildings[:page_size], headers)
+    response = buildings_response(compress(render_buildings(out_array, media_type), encoding), media_type, encoding)
+    if len(buildings) > page_size:
+        response.headers["X-Next-Cursor"] = encode_cursor(buildings[page_size - 1])
+    return response
+
+@app.get("/buildings",response_model=List[Building],description="Gets all the buildings inside a geohash (min 5 digits) along with their types, TOIDs, UPRNs, and current energy ratings. If page_size is given, only that many buildings are returned, ordered by URI, and the X-Next-Cursor header holds the cursor to pass as after to get the next page (it is left out on the last page)")
+async def get_buildings_in_geohash(geohash:str, req: Request, page_size:int=None, after:str=None):
+    if len(geohash) < 5:
+        raise HTTPException(422,detail="Lat Lon range too wide, please provide at least five digits")  
+    headers = get_forwarding_headers(req.headers)
+    media_type, encoding = negotiate_buildings(req)
+    if page_size is not None or after is not None:
+        if page_size is None:
+            page_size = max_buildings_page_size
+        if page_size < 1 or page_size > max_buildings_page_size:
+            raise HTTPException(422,detail=f"page_size must be between 1 and {max_buildings_page_size}")
+        return await get_buildings_page(geohash, headers, page_size, after, media_type, encoding)
+    if buildings_cache is None:
+        if not fast_serialization:
+            return await fetch_buildings(geohash, headers)
+        body = compress(render_buildings(await fetch_buildings(geohash, headers), media_type), encoding)
+    else:
+        body = await get_cached_buildings(geohash, headers, media_type, encoding)
+    return buildings_response(body, media_type, encoding)
+
+async def get_cached_buildings(geohash:str, headers:dict[str,str], media_type:str=json_type, encoding:str=None):
+    #what a user can see depends on their security labels, so responses are only shared between identical auth headers.
+    #Each representation is cached separately, so a hit doesn't pay for compression again
+    key = (geohash, cache_key(headers), media_type, encoding)
+    await buildings_cache.sync()
+    body = buildings_cache.get(key)
+    if body is None:
+        generation = buildings_cache.get_generation()
+        out_array = await fetch_buildings(geohash, headers)
+        body = compress(render_buildings(out_array, media_type), encoding)
+        #so the evictions other workers made while it was being fetched stop it being cached
+        await buildings_cache.sync()
+        buildings_cache.put(key, body, building_cache_uris(out_array), generation, building_cache_shown(out_array))
+    return body
+
+@app.get("/buildings/viewport",response_model=List[Building],description="Gets all the buildings in a lat/lon bounding box, or in a list of geohashes (min 5 digits each), in one response. A bounding box is covered with geohashes of the given precision (min 5), which are queried concurrently and the buildings in them merged")
+async def get_buildings_in_viewport(req: Request, min_lat:float=None, min_lon:float=None, max_lat:float=None, max_lon:float=None, geohash:List[str]=Query(None), precision:int=5):
+    if geohash:
+        if any(len(gh) < 5 for gh in geohash):
+            raise HTTPException(422,detail="Lat Lon range too wide, please provide at least five digits for each geohash")
+        cells = minimal_cells(geohash)
+        if len(cells) > viewport_max_cells:
+            raise HTTPException(422,detail=f"Too many geohashes, the most allowed is {viewport_max_cells}")
+    elif None not in (min_lat, min_lon, max_lat, max_lon):
+        if precision < 5:
+            raise HTTPException(422,detail="Lat Lon range too wide, please provide a precision of at least five digits")
+        if not (-90 <= min_lat <= max_lat <= 90 and -180 <= min_lon <= max_lon <= 180):
+            raise HTTPException(422,detail="The bounding box must have min_lat <= max_lat and min_lon <= max_lon, within the range of lat/lon")
+        try:
+            cells = covering_cells(min_lat, min_lon, max_lat, max_lon, precision, max_cells=viewport_max_cells)
+        except ValueError as e:
+            raise HTTPException(422,detail=str(e))
+    else:
+        raise HTTPException(422,detail="Either a bounding box (min_lat, min_lon, max_lat, max_lon) or one or more geohashes must be provided")
+
+    headers = get_forwarding_headers(req.headers)
+    media_type, encoding = negotiate_buildings(req)
+    #bounded, so one big viewport can't take all the connections to Jena
+    semaphore = asyncio.Semaphore(viewport_concurrency)
+    async def get_cell(cell):
+        #each cell's buildings as they are rendered in a response, which (like /buildings) is what is cached
+        async with semaphore:
+            if buildings_cache is not None:
+                return orjson.loads(await get_cached_buildings(cell, headers))
+            out_array = await fetch_buildings(cell, headers)
+            if fast_serialization:
+                return [buildings_renderer.shape(building_obj) for building_obj in out_array]
+            return buildings_adapter.dump_python(buildings_adapter.validate_python(out_array), mode="json")
+    out = {}
+    for cell_buildings in await asyncio.gather(*[get_cell(cell) for cell in cells]):
+        for building_obj in cell_buildings:
+            #a building with locations in more than one cell comes back for each of them
+            if building_obj["uri"] not in out:
+                out[building_obj["uri"]] = building_obj
+    return buildings_response(compress(dump(list(out.values()), media_type), encoding), media_type, encoding)
+
+class StreamFormatEnum(str, Enum):
+    ndjson = "ndjson"
+    json = "json"
+
+async def stream_buildings(response, stream_format:StreamFormatEnum):
+    #the rows are ordered by building, so each building is complete (and can be sent) as soon as the next one starts
+    building_obj = None
+    count = 0
+    if stream_format == StreamFormatEnum.json:
+        yield "["
+    async for result in sparql_client.iter_bindings(response):
+        building = shorten(result["building"]["value"])
+        if building_obj is None or building_obj["uri"] != building:
+            if building_obj is not None:
+                yield render_streamed_building(building_obj, stream_format, count)
+                count = count + 1
+            building_obj = new_building(building, result)
+        fold_building_row(building_obj, result)
+    if building_obj is not None:
+        yield render_streamed_building(building_obj, stream_format, count)
+    if stream_format == StreamFormatEnum.json:
+        yield "]"
+
+def render_streamed_building(building_obj, stream_format:StreamFormatEnum, index:int):
+    return frame_streamed(Building.model_validate(building_obj).model_dump_json(), stream_format, index)
+
+def frame_streamed(rendered:str, stream_format:StreamFormatEnum, index:int):
+    if stream_format == StreamFormatEnum.ndjson:
+        return rendered + "\n"
+    if index > 0:
+        return "," + rendered
+    return rendered
+
+@app.get("/buildings/stream",response_model=List[Building],description="Streams all the buildings inside a geohash (min 5 digits) as they are read from the knowledge graph, either as newline-delimited JSON (the default) or as a chunked JSON array")
+async def stream_buildings_in_geohash(geohash:str, req: Request, format:StreamFormatEnum=StreamFormatEnum.ndjson):
+    if len(geohash) < 5:
+        raise HTTPException(422,detail="Lat Lon range too wide, please provide at least five digits")  
+    media_type = "application/x-ndjson" if format == StreamFormatEnum.ndjson else "application/json"
+    query = buildings_query(geohash, order=True)
+    try:
+        response = await sparql_client.query_stream(prefixes + query, get_forwarding_headers(req.headers), dataset)
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(e.response.status_code)
+    return StreamingResponse(stream_buildings(response, format), media_type=media_type)
+
 class InvalidateFlag(BaseModel):
     flagUri: str
     assessmentTypeOverride:str=prefix_dict["ndt_ont"]+"AssessToBeFalse"
     securityLabel: EDH = None
 @app.post("/invalidate-flag",description="Post to this endpoint to invalidate an existing flag.", response_model=str)
-def invalidate_flag(request:Request,invalid: InvalidateFlag):
-    try:
-        user = access_client.get_user_details(request.headers)
-    except exceptions.RequestException as e:
-        if e.response is not None:
-            raise HTTPException(e.response.status_code, f"Error calling Access:{e.response.reason}")
-        else: 
-            raise HTTPException(500, f"Error calling Access, Internal Server Error")
-    assessor, person = create_person_insert(user['user_id'], user["username"])
-    assessment_time = "http://iso.org/iso8601#"+datetime.now().isoformat()
-    assessment = data_uri_stub+str(uuid.uuid4())
-    (ass_subclasses,ass_list) = get_subtypes(prefix_dict["ndt_ont"]+"AssessToBeFalse", get_forwarding_headers(request.headers))
-    # print(ass_subclasses)
-    if invalid.assessmentTypeOverride != prefix_dict["ndt_ont"]+"AssessToBeFalse" and lengthen(invalid.assessmentTypeOverride) not in ass_subclasses:
+async def invalidate_flag(request:Request,invalid: InvalidateFlag):
+    user = await get_user(request)
+    await wait_for_ontology()
+    if invalid.assessmentTypeOverride != prefix_dict["ndt_ont"]+"AssessToBeFalse" and not ontology_index.is_subclass(lengthen(invalid.assessmentTypeOverride), prefix_dict["ndt_ont"]+"AssessToBeFalse"):
         raise HTTPException(422,"assessmentTypeOverride must be a subclass of ndt_ont:AssessToBeFalse")
-    query = f"""
-        {format_prefixes()}
-        INSERT DATA {{
-            <{assessment}> a <{lengthen(invalid.assessmentTypeOverride)}> .
-            <{assessment}> ies:assessor <{assessor}> .
-            {person}
-            <{assessment}> ies:assessed <{lengthen(invalid.flagUri)}> .
-            <{assessment}> ies:inPeriod <{assessment_time}> .
-        }}
+
+    async def write():
+        assessor = person_uri(user['user_id'])
+        assessment_time = "http://iso.org/iso8601#"+datetime.now().isoformat()
+        assessment = data_uri_stub+str(uuid.uuid4())
+        triples = TripleBuilder()
+        triples.add_type(assessment, lengthen(invalid.assessmentTypeOverride))
+        triples.add(assessment, ies+"assessor", assessor)
+        triples.add(assessment, ies+"assessed", lengthen(invalid.flagUri))
+        triples.add(assessment, ies+"inPeriod", assessment_time)
+        await run_person_update(triples, user, securityLabel=invalid.securityLabel)
+        await evict_buildings_cache([lengthen(invalid.flagUri)], [(lengthen(invalid.flagUri), invalidated(lengthen(invalid.flagUri)))])
+        return assessment
+    return await run_idempotently(request, user, invalid.model_dump_json(), write)
+
+def building_states_query(buildings:list[str]):
+    values = " ".join(format_iri(building) for building in buildings)
+    return f"""
+        SELECT ?building ?buildingType ?state ?stateType WHERE {{
+            VALUES ?building {{ {values} }}
+            ?building rdf:type ?buildingType .
+            OPTIONAL {{
+                ?state ies:isStateOf ?building .
+                ?state rdf:type ?stateType .
+            }}
+        }}"""
+
+def fold_building_states(results):
+    """
+    The building and its states, as /buildings/{uprn} returns them, for each building in the rows of building_states_query
+    """
+    buildings = {}
+    for result in result_rows(results):
+        uri = result["building"]["value"]
+        if uri not in buildings:
+            buildings[uri] = ({"uri":uri, "types":[]}, {})
+        building, states = buildings[uri]
+        if result["buildingType"]["value"] not in building["types"]:
+            building["types"].append(result["buildingType"]["value"])
+        #a building without any states has no ?state in its rows
+        if "state" in result:
+            state = result["state"]["value"]
+            if state not in states:
+                states[state] = {"uri":state,"types":[],"stateOf":uri}
+            if result["stateType"]["value"] not in states[state]["types"]:
+                states[state]["types"].append(result["stateType"]["value"])
+    return {uri: {"entity":building, "states":list(states.values())} for uri, (building, states) in buildings.items()}
+
+async def resolve_uprns(uprns:list[str], headers:dict[str,str]):
     """
-    run_sparql_update(query=query,securityLabel=invalid.securityLabel)
-    return assessment
+    The building URI for each of the UPRNs that has one, from the UPRN index or else from Jena
+    """
+    found = {}
+    missing = []
+    for uprn in uprns:
+        building = uprn_index.get(uprn) if uprn_index is not None else None
+        if building is None:
+            missing.append(uprn)
+        else:
+            found[uprn] = building
+    if missing:
+        looked_up = uprn_buildings(await run_sparql_query(uprn_query(missing), headers))
+        if uprn_index is not None:
+            #only the URI is shared between users - the building itself is always fetched with the user's own headers
+            for uprn, building in looked_up.items():
+                uprn_index.put(uprn, building)
+        found.update(looked_up)
+    return found
+
+async def get_buildings_by_uprn(uprns:list[str], headers:dict[str,str]):
+    """
+    The building and its states for each of the UPRNs, in order - None for those that aren't found
+    """
+    out = {}
+    remaining = list(dict.fromkeys(uprns))
+    if read_model_ready():
+        for uprn in remaining:
+            building = read_model.building_by_uprn(uprn)
+            if building is not None:
+                out[uprn] = building
+        remaining = [uprn for uprn in remaining if uprn not in out]
+    if remaining:
+        found = await resolve_uprns(remaining, headers)
+        if found:
+            buildings = fold_building_states(await run_sparql_query(building_states_query(sorted(set(found.values()))), headers))
+            for uprn, building in found.items():
+                if building in buildings:
+                    out[uprn] = buildings[building]
+    return [out.get(uprn) for uprn in uprns]
 
 @app.get("/buildings/{uprn}", response_model=IesEntityAndStates,description="returns the building that corresponds to the provided UPRN")
-def get_building_by_uprn(uprn:str, req:Request):
-    query = f'''SELECT ?building ?buildingType ?state ?stateType WHERE 
-                {{
-                    ?building ies:isIdentifiedBy ?uprnID .
-                    ?building rdf:type ?buildingType .
-                    ?uprnID ies:representationValue "{uprn}" .
-                    OPTIONAL {{
-                        ?state ies:isStateOf ?building .
-                        ?state rdf:type ?stateType .
-                    }}
-                }}
-            '''
-    results = run_sparql_query(query, get_forwarding_headers(req.headers))
-    building = {
-        "uri":"",
-        "types":[],
-    }
-    states = {}
-    if results and results['results'] and results['results']['bindings']:
-        for result in results['results']['bindings']:
-            building["uri"] = result["building"]["value"]
-            if result["buildingType"]["value"] not in building["types"]:
-                building["types"].append(result["buildingType"]["value"])
-            if result["state"]["value"]:
-                state = result["state"]["value"]
-                stateType = result["stateType"]["value"]
-                if state not in states:
-                    states[state] = {"uri":state,"types":[],"stateOf": building["uri"]}
-                if stateType not in states[state]["types"]:
-                    states[state]["types"].append(stateType)
-    out = {
-        "entity":building,
-        "states":[]
-    }
-    for state in states:
-        out["states"].append(states[state])
-    return out
-
-@app.post("/flag-to-visit",description="Add a flag to an Entity instance as being worth visiting - URI of Entity must be provided", response_model=str)
-def post_flag_visit(request:Request,visited:IesEntity):
+async def get_building_by_uprn(uprn:str, req:Request):
+    building = (await get_buildings_by_uprn([uprn], get_forwarding_headers(req.headers)))[0]
+    if building is None:
+        return {"entity":{"uri":"","types":[]}, "states":[]}
+    return building
+
+class UprnLookup(BaseModel):
+    uprn:str
+    entity:IesEntity = None
+    states:List[IesState] = []
+
+async def stream_uprn_lookups(chunks, tasks, stream_format:StreamFormatEnum):
+    #the chunks are queried concurrently, but sent in the order they were asked for
+    try:
+        count = 0
+        if stream_format == StreamFormatEnum.json:
+            yield "["
+        for chunk, task in zip(chunks, tasks):
+            for uprn, building in zip(chunk, await task):
+                yield frame_streamed(UprnLookup.model_validate({"uprn":uprn, **(building or {})}).model_dump_json(), stream_format, count)
+                count = count + 1
+        if stream_format == StreamFormatEnum.json:
+            yield "]"
+    finally:
+        for task in tasks:
+            task.cancel()
+
+@app.post("/buildings/by-uprn", response_model=List[UprnLookup],description="Looks up the buildings (and their states) for a list of UPRNs. The results are streamed back in the same order as the UPRNs, either as newline-delimited JSON (the default) or as a chunked JSON array, with just the UPRN for any that aren't found")
+async def post_buildings_by_uprn(uprns:List[str], req:Request, format:StreamFormatEnum=StreamFormatEnum.ndjson):
+    if len(uprns) > max_uprn_batch:
+        raise HTTPException(422,f"No more than {max_uprn_batch} UPRNs can be looked up in one request")
+    headers = get_forwarding_headers(req.headers)
+    media_type = "application/x-ndjson" if format == StreamFormatEnum.ndjson else "application/json"
+    chunks = [uprns[i:i + uprn_chunk_size] for i in range(0, len(uprns), uprn_chunk_size)]
+    #bounded, so one big lookup can't take all the connections to Jena
+    semaphore = asyncio.Semaphore(uprn_concurrency)
+    async def get_chunk(chunk):
+        async with semaphore:
+            return await get_buildings_by_uprn(chunk, headers)
+    tasks = [asyncio.create_task(get_chunk(chunk)) for chunk in chunks]
+    if tasks:
+        #the first chunk is waited for before the response starts, so an error from Jena is still sent as an error status
+        try:
+            await tasks[0]
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+    return StreamingResponse(stream_uprn_lookups(chunks, tasks, format), media_type=media_type)
+
+def create_flag_insert(triples:TripleBuilder, flag_state, flagged_uri, flagger, flag_type, flag_time):
+    triples.add(flag_state, ies+"interestedIn", lengthen(flagged_uri))
+    triples.add(flag_state, ies+"isStateOf", flagger)
+    triples.add(flag_state, ies+"inPeriod", flag_time)
+    triples.add_type(flag_state, lengthen(flag_type))
+
+async def post_flag(request:Request, visited:IesEntity, flag_type:str):
     if not visited or not visited.uri:
         raise HTTPException(422,"URI of flagged entity must be provided")
-    try:
-        user = access_client.get_user_details(request.headers)
-    except exceptions.RequestException as e:
+    user = await get_user(request)
+
+    async def write():
+        flagger = person_uri(user['user_id'])
+        flag_time = "http://iso.org/iso8601#"+datetime.now().isoformat()
+        flag_state = data_uri_stub+str(uuid.uuid4())
+        triples = TripleBuilder()
+        create_flag_insert(triples, flag_state, visited.uri, flagger, flag_type, flag_time)
+        await run_person_update(triples, user, forwarding_headers=get_forwarding_headers(request.headers),securityLabel=visited.securityLabel)
+        await evict_buildings_cache([lengthen(visited.uri)], [(lengthen(visited.uri), flag_state)])
+        return flag_state
+    return await run_idempotently(request, user, visited.model_dump_json(), write)
 
-        if e.response is not None:
-            raise HTTPException(e.response.status_code, f"Error calling Access:{e.response.reason}")
-        else: 
-            raise HTTPException(500, f"Error calling Access, Internal Server Error")
-    flagger, person = create_person_insert(user['user_id'], user["username"])
-    
-  
-    flag_time = "http://iso.org/iso8601#"+datetime.now().isoformat()
-    flag_state = data_uri_stub+str(uuid.uuid4())
-    query = f"""
-        {format_prefixes()}
-        INSERT DATA {{
-            <{flag_state}> ies:interestedIn <{lengthen(visited.uri)}> .
-            <{flag_state}> ies:isStateOf <{flagger}> .
-            {person}
-            <{flag_state}> ies:inPeriod <{flag_time}> .
-            <{flag_state}> a ndt:InterestedInVisiting .
-        }}
-    """
-    run_sparql_update(query=query, forwarding_headers=get_forwarding_headers(request.headers),securityLabel=visited.securityLabel)
-    return flag_state
+@app.post("/flag-to-visit",description="Add a flag to an Entity instance as being worth visiting - URI of Entity must be provided", response_model=str)
+async def post_flag_visit(request:Request,visited:IesEntity):
+    return await post_flag(request, visited, FlagTypeEnum.visit.value)
 
 @app.post("/flag-to-investigate",description="Add a flag to an Entity instance as being worth investigating- URI of Entity must be provided", response_model=str)
-def post_flag_visit(request:Request,visited:IesEntity):
-    if not visited or not visited.uri:
-        raise HTTPException(422,"URI of flagged entity must be provided")
-    try:
-        user = access_client.get_user_details(request.headers)
-    except exceptions.RequestException as e:
-
-        if e.response is not None:
-            raise HTTPException(e.response.status_code, f"Error calling Access:{e.response.reason}")
-        else: 
-            
-            raise HTTPException(500, f"Error calling Access, Internal Server Error")
-   
-    flagger, person = create_person_insert(user['user_id'], user["username"])
-        
-    
-    flag_time = "http://iso.org/iso8601#"+datetime.now().isoformat()
-    flag_state = data_uri_stub+str(uuid.uuid4())
-    query = f"""
-        {format_prefixes()}
-        INSERT DATA {{
-            <{flag_state}> ies:interestedIn <{lengthen(visited.uri)}> .
-            <{flag_state}> ies:isStateOf <{flagger}> .
-            {person} 
-            <{flag_state}> ies:inPeriod <{flag_time}> .
-            <{flag_state}> a ndt:InterestedInInvestigating .
-        }}
-    """
-    print(query)
-    run_sparql_update(query=query, forwarding_headers=get_forwarding_headers(request.headers),securityLabel=visited.securityLabel)
-    return flag_state
+async def post_flag_investigate(request:Request,visited:IesEntity):
+    return await post_flag(request, visited, FlagTypeEnum.investigate.value)
+
+@app.post("/flags/batch",description="Add many flags in one go - each entry needs the URI of the flagged Entity and the flag type. The flags are written in a single update per security label, and the URIs of the flags are returned in the same order", response_model=List[str])
+async def post_flags_batch(request:Request, flags:List[BatchFlag]):
+    if len(flags) > max_flag_batch:
+        raise HTTPException(422,f"No more than {max_flag_batch} flags can be posted in one batch")
+    for flag in flags:
+        if not flag.uri:
+            raise HTTPException(422,"URI of flagged entity must be provided")
+    user = await get_user(request)
+
+    async def write():
+        flagger = person_uri(user['user_id'])
+        flag_time = "http://iso.org/iso8601#"+datetime.now().isoformat()
+        flag_states = []
+        #one write per distinct security label, so the person only goes in once per label
+        label_groups = {}
+        for flag in flags:
+            label = flag.securityLabel if flag.securityLabel is not None else default_security_label
+            flag_state = data_uri_stub+str(uuid.uuid4())
+            flag_states.append(flag_state)
+            label_string = label.to_string()
+            if label_string not in label_groups:
+                label_groups[label_string] = (label, TripleBuilder())
+            create_flag_insert(label_groups[label_string][1], flag_state, flag.uri, flagger, flag.flagType.value, flag_time)
+        #each label's write is sent on its own, so dropping one only undoes what was recorded for it (and the Idempotency-Key)
+        undos = dropped_write_undos.get()
+        for label, triples in label_groups.values():
+            dropped_write_undos.set(undos)
+            await run_person_update(triples, user, forwarding_headers=get_forwarding_headers(request.headers),securityLabel=label)
+        await evict_buildings_cache([lengthen(flag.uri) for flag in flags], [(lengthen(flag.uri), flag_state) for flag, flag_state in zip(flags, flag_states)])
+        return flag_states
+    return await run_idempotently(request, user, "[" + ",".join(flag.model_dump_json() for flag in flags) + "]", write)
 
 #@app.post("/buildings/states",description="Add a new state to a building")
-def post_building_state(bs: IesState):
-    if bs.stateType not in building_state_classes:
-        # get_building_states()
-        if bs.stateType not in building_state_classes:
-            raise HTTPException(status_code=404, detail="Building State Class: " + bs.stateType + " not found")
+async def post_building_state(bs: IesState):
+    await wait_for_ontology()
+    if not ontology_index.is_subclass(bs.stateType, ndt_ont+"BuildingState"):
+        raise HTTPException(status_code=404, detail="Building State Class: " + bs.stateType + " not found")
     mint_uri(bs)
     if bs.startDateTime:
         start_date = "http://iso.org/iso8601#"+bs.startDateTime.isoformat().replace(" ","T")
@@ -677,11 +1626,11 @@ def post_building_state(bs: IesState):
                 {start_sparql}
                 {end_sparql}
             }}'''
-    run_sparql_update(query=query,securityLabel=bs.securityLabel)
+    await run_sparql_update(query=query,securityLabel=bs.securityLabel)
     return bs.uri
 
 #@app.post("/accounts")
-def post_account(acc: IesAccount):
+async def post_account(acc: IesAccount):
     if acc.uri == None:
         acc.uri = data_uri_stub+"Account-"+acc.id
     if acc.email != None:
@@ -711,10 +1660,10 @@ def post_account(acc: IesAccount):
             {email_sparql}
             {name_sparql}
         }}'''
-    run_sparql_update(query=query,securityLabel=acc.securityLabel)
+    await run_sparql_update(query=query,securityLabel=acc.securityLabel)
     return acc.uri
 
-def assess(ass:IesAssessment):
+async def assess(ass:IesAssessment):
     mint_uri(ass)
     if ass.inPeriod == None:
         ass.inPeriod = datetime.datetime.now().isoformat()
@@ -731,12 +1680,12 @@ def assess(ass:IesAssessment):
                 <{ass.uri}> ies:assessor <{ass.assessor}> .
                 <{ass.uri}> ies:inPeriod "{ass.inPeriod}"
             }}'''
-    run_sparql_update(query=query,securityLabel=ass.securityLabel)
+    await run_sparql_update(query=query,securityLabel=ass.securityLabel)
 
     return ass.uri
 
 #@app.post("/assessments/assess-to-be-true")
-def post_assess_to_be_true(ass:IesAssessToBeTrue):
+async def post_assess_to_be_true(ass:IesAssessToBeTrue):
     mint_uri(ass)
     if ass.inPeriod == None:
         ass.inPeriod = datetime.datetime.now().isoformat()
@@ -749,12 +1698,12 @@ def post_assess_to_be_true(ass:IesAssessToBeTrue):
                 <{ass.uri}> ies:assessor <{ass.assessor}> .
                 <{ass.uri}> ies:inPeriod "{ass.inPeriod}"
             }}'''
-    run_sparql_update(query=query,securityLabel=ass.securityLabel)
+    await run_sparql_update(query=query,securityLabel=ass.securityLabel)
 
     return ass.uri
  
 #@app.post("/assessments/assess-to-be-false")
-def post_assess_to_be_false(ass:IesAssessToBeFalse):
+async def post_assess_to_be_false(ass:IesAssessToBeFalse):
     mint_uri(ass)
     if ass.inPeriod == None:
         ass.inPeriod = datetime.datetime.now().isoformat()
@@ -767,14 +1716,33 @@ def post_assess_to_be_false(ass:IesAssessToBeFalse):
                 <{ass.uri}> ies:assessor <{ass.assessor}> .
                 <{ass.uri}> ies:inPeriod "{ass.inPeriod}"
             }}'''
-    run_sparql_update(query=query,securityLabel=ass.securityLabel)
+    await run_sparql_update(query=query,securityLabel=ass.securityLabel)
 
     return ass.uri
 
+def update_setting(key:str, value, apply):
+    #settings changed through the API apply to all the workers on this host, not just the one that got the request
+    if shared_state is not None:
+        shared_state.set(key, value)
+    apply(value)
+
+def apply_data_uri_stub(uri:str):
+    global data_uri_stub, prefixes
+    data_uri_stub = uri
+    #the data: prefix is the stub, as it is at startup
+    add_prefix("data", uri)
+    prefixes = format_prefixes()
+
+def apply_default_security_label(label:dict):
+    global default_security_label
+    default_security_label = EDH.model_validate(label)
+    #the old default is no longer one of the handful of labels nearly every write uses
+    clear_label_caches()
+
 @app.post("/uri-stub",
           description="Sets the default uri stub used by the API when generating data uris - it will append a UUID to the stub for every URI it creates", status_code=204)
 def post_uri_stub(uri:str):
-    data_uri_stub = uri
+    update_setting("data_uri_stub", uri, apply_data_uri_stub)
     return 
 
 @app.get("/uri-stub",
@@ -787,8 +1755,7 @@ def get_uri_stub():
 @app.post("/default-security-label",
           description="Sets the default security label used when writing data",  status_code=204)
 def post_default_security_label(label:EDH):
-    global default_security_label
-    default_security_label = label
+    update_setting("default_security_label", label.model_dump(mode="json"), apply_default_security_label)
     return
 
 @app.get("/default-security-label",
@@ -798,7 +1765,7 @@ def get_default_security_label():
     return default_security_label
 
 #@app.post("/assessments")
-def post_assessment(ass: IesAssessment, req:Request):
+async def post_assessment(ass: IesAssessment, req:Request):
     mint_uri(ass)
     state_uri = ""
     start_state=""
@@ -808,36 +1775,33 @@ def post_assessment(ass: IesAssessment, req:Request):
         raise HTTPException(status_code=400, detail="No assessed object provided")
     if ass.assessmentType == None or ass.assessmentType == "":
         raise HTTPException(status_code=400, detail="No assessment class provided")
-    if ass.assessmentType not in assessment_classes:
-        get_assessments()
-        if ass.assessmentType not in assessment_classes:
-            raise HTTPException(status_code=404, detail="Assessment Class: " + ass.assessmentType + " not found")
-        else:
-            if ass.userOverride:
-                user = ass.userOverride
-            else:
-                user = data_uri_stub+"JaneDoe" #DON'T KNOW HOW TO GET THE USER ID
-
-            start_date = "http://iso.org/iso8601#"+ass.startDate.isoformat().replace(" ","T")
-            end_date = "http://iso.org/iso8601#"+ass.endDate.isoformat().replace(" ","T")
-            query = f'''INSERT DATA 
-            {{
-                <{state_uri}> a <{state_type}> .
-                <{state_uri}> ies:isStateOf <{ass.assessedItem}>
-                <{start_state}> a ies:BoundingState .
-                <{start_state}> ies:isStartOf <{state_uri}> .
-                <{start_state}> ies:inPeriod <{start_date}> .
-                <{end_state}> a ies:BoundingState .
-                <{end_state}> ies:isEndOf <{state_uri}> .
-                <{end_state}> ies:inPeriod <{end_date}> .
-                <{ass.uri}> a <{ass.assessmentType}>  . 
-                <{ass.uri}> ies:assessed <{state_uri}> .
-                <{ass.uri}> ies:assessor <{user}> .
-            }}'''
-            run_sparql_update(query=query,securityLabel=ass.securityLabel)
+    await wait_for_ontology()
+    if not ontology_index.is_subclass(ass.assessmentType, ies+"Assessment"):
+        raise HTTPException(status_code=404, detail="Assessment Class: " + ass.assessmentType + " not found")
+    if ass.userOverride:
+        user = ass.userOverride
+    else:
+        user = data_uri_stub+"JaneDoe" #DON'T KNOW HOW TO GET THE USER ID
 
-            return ass.uri
-    raise HTTPException(status_code=400, detail="Could not create assessment")    
+    start_date = "http://iso.org/iso8601#"+ass.startDate.isoformat().replace(" ","T")
+    end_date = "http://iso.org/iso8601#"+ass.endDate.isoformat().replace(" ","T")
+    query = f'''INSERT DATA 
+    {{
+        <{state_uri}> a <{state_type}> .
+        <{state_uri}> ies:isStateOf <{ass.assessedItem}>
+        <{start_state}> a ies:BoundingState .
+        <{start_state}> ies:isStartOf <{state_uri}> .
+        <{start_state}> ies:inPeriod <{start_date}> .
+        <{end_state}> a ies:BoundingState .
+        <{end_state}> ies:isEndOf <{state_uri}> .
+        <{end_state}> ies:inPeriod <{end_date}> .
+        <{ass.uri}> a <{ass.assessmentType}>  . 
+        <{ass.uri}> ies:assessed <{state_uri}> .
+        <{ass.uri}> ies:assessor <{user}> .
+    }}'''
+    await run_sparql_update(query=query,securityLabel=ass.securityLabel)
+
+    return ass.uri
 
 # #Create a temporary person for this demo...until we can do something else...
 # person = IesPerson(uri=test_person_uri,givenName = "Test",surname = "User")
@@ -846,4 +1810,5 @@ def post_assessment(ass: IesAssessment, req:Request):
 
 
 if __name__ == "__main__":
+   import uvicorn
    uvicorn.run(app, host="0.0.0.0", port=int(port))
\ No newline at end of file
@@ -0,0 +1,65 @@
+#Benchmark of the security label work done for each write on one core: rendering the label with a new
+#SecurityLabelBuilder and building its Kafka and SCG headers every time, against the memoized rendering and headers.
+#The writes use a handful of labels, mostly the default, as they do in use.
+#Run from the repo root: python benchmarks/bench_labels.py [seconds]
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ["UPDATE_MODE"] = "KAFKA"
+import api
+from maplib import RecordUtils
+from maplib.access import SecurityLabelBuilder, EDHSecurityLabelsV2
+
+labels = [api.default_security_label] * 6 + [
+    api.EDH(permitted_organisations=["NDTP"], classification="OS"),
+    api.EDH(permitted_organisations=["NDTP", "Telicent"], permitted_nationalities=["GBR"], classification="OS"),
+    api.EDH(permitted_nationalities=["GBR"], classification="O"),
+    api.EDH(permitted_organisations=["Telicent"], classification="S"),
+]
+
+def unmemoized_to_string(label):
+    builder = SecurityLabelBuilder()
+    if len(label.permitted_organisations) > 0:
+        builder.add_multiple(EDHSecurityLabelsV2.PERMITTED_ORGANISATIONS.value, *label.permitted_organisations)
+    if len(label.permitted_nationalities) > 0:
+        builder.add_multiple(EDHSecurityLabelsV2.PERMITTED_NATIONALITIES.value, *label.permitted_nationalities)
+    if label.classification:
+        builder.add(EDHSecurityLabelsV2.CLASSIFICATION.value, api.ClassificationEmum(label.classification).value)
+    return builder.build()
+
+def unmemoized_write(label):
+    #a write renders the label for the known persons check and again to send it, then builds the headers for Kafka or SCG
+    unmemoized_to_string(label)
+    label_string = unmemoized_to_string(label)
+    RecordUtils.to_headers({"Security-Label":label_string, "Content-Type": "application/n-triples"})
+    return {'Accept': '*/*', 'Security-Label':label_string, 'Content-Type': 'application/sparql-update', "Authorization": "Bearer x"}
+
+def memoized_write(label):
+    label.to_string()
+    label_string = label.to_string()
+    api.get_headers(label_string)
+    return {**api.build_scg_headers(label_string), "Authorization": "Bearer x"}
+
+def run(name, write, seconds):
+    rng = random.Random(1)
+    picks = [rng.choice(labels) for _ in range(4096)]
+    count = 0
+    start = time.process_time()
+    while time.process_time() - start < seconds:
+        for label in picks:
+            write(label)
+        count = count + len(picks)
+    elapsed = time.process_time() - start
+    print(f"{name:<12}{count / elapsed:>12,.0f} writes/s per core  {elapsed / count * 1e6:>8.2f} us/write")
+    return count / elapsed
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    for label in labels:
+        assert memoized_write(label)["Security-Label"] == unmemoized_write(label)["Security-Label"]
+    before = run("unmemoized", unmemoized_write, seconds)
+    after = run("memoized", memoized_write, seconds)
+    print(f"speedup: {after / before:.1f}x")
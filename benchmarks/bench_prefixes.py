@@ -0,0 +1,59 @@
+#Microbenchmark of URI shortening on a /buildings-sized result set: the old loop of str.replace calls over every
+#prefix, against the PrefixCodec. Run from the repo root: python benchmarks/bench_prefixes.py [rows]
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from prefixes import PrefixCodec
+
+prefix_dict = {
+    "xsd": "http://www.w3.org/2001/XMLSchema#",
+    "dc": "http://purl.org/dc/elements/1.1/",
+    "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+    "rdfs": "http://www.w3.org/2000/01/rdf-schema#",
+    "owl": "http://www.w3.org/2002/07/owl#",
+    "telicent": "http://telicent.io/ontology/",
+    "ies": "http://ies.data.gov.uk/ontology/ies4#",
+    "data": "http://nationaldigitaltwin.gov.uk/data#",
+    "ndt_ont": "http://nationaldigitaltwin.gov.uk/ontology#",
+    "ndt": "http://nationaldigitaltwin.gov.uk/data#",
+    "gp": "https://www.geoplace.co.uk/addresses-streets/location-data/the-uprn#",
+    "epc": "http://gov.uk/government/organisations/department-for-levelling-up-housing-and-communities/ontology/epc#",
+}
+
+def replace_loop_shorten(uri):
+    for prefix in prefix_dict:
+        uri = uri.replace(prefix_dict[prefix], prefix + ":")
+    return uri
+
+def make_rows(count):
+    #each row carries the four URIs that get_buildings_in_geohash shortens: building, type, flag and flag type
+    types = [prefix_dict["ndt_ont"] + t for t in ["House", "SemiDetached", "Detached", "Terrace", "Flat"]]
+    flag_types = [prefix_dict["ndt"] + t for t in ["InterestedInVisiting", "InterestedInInvestigating"]]
+    buildings = [prefix_dict["data"] + "building_" + str(100060000000 + i) for i in range(count // 6 + 1)]
+    flags = [prefix_dict["data"] + str(uuid.uuid4()) for i in range(count // 3 + 1)]
+    return [(buildings[i // 6], types[i % len(types)], flags[i // 3], flag_types[i % 2]) for i in range(count)]
+
+def run(label, shorten, rows):
+    start = time.perf_counter()
+    for row in rows:
+        for uri in row:
+            shorten(uri)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24}{elapsed * 1000:>10.1f} ms  {len(rows) / elapsed:>12,.0f} rows/s")
+    return elapsed
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    rows = make_rows(count)
+    codec = PrefixCodec(prefix_dict)
+    for row in rows[:1000]:
+        for uri in row:
+            assert codec.shorten(uri) == replace_loop_shorten(uri), uri
+    print(f"Shortening {count:,} rows x 4 URIs")
+    baseline = run("str.replace loop", replace_loop_shorten, rows)
+    uncached = run("codec (no cache)", codec._shorten, rows)
+    cached = run("codec (LRU)", PrefixCodec(prefix_dict).shorten, rows)
+    print(f"speedup: {baseline / uncached:.1f}x uncached, {baseline / cached:.1f}x with the LRU")
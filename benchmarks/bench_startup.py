@@ -0,0 +1,127 @@
+#Benchmark of how quickly a worker starts: the time to import api.py (in a fresh interpreter each time, so nothing is
+#already imported), and, running the API with benchmarks/serve.py against the SPARQL stand-in, the time from starting
+#it to its first 200 (from /version-info) and to it being warm (/buildings/states/classes answered from a loaded ontology).
+#The slowest imports are listed too. Results can be saved as the baseline in baselines.json and later runs compared
+#against it, as with run_load.py. Baselines are only comparable on the same machine.
+#Run from the repo root: python benchmarks/bench_startup.py [--runs 5] [--save-baseline] [--check]
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+from run_load import free_port, wait_for, ontology_files, benchmarks, repo
+
+import_script = "import time; started = time.perf_counter(); import api; print(time.perf_counter() - started)"
+
+def import_time(env):
+    output = subprocess.run([sys.executable, "-c", import_script], env=env, cwd=repo, capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+def slowest_imports(env, count=8):
+    #the modules api.py imports directly, by their cumulative import time
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import api"], env=env, cwd=repo, capture_output=True, text=True, check=True).stderr
+    imports = []
+    for line in stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].startswith("   ") and not parts[2].startswith("    "):
+            imports.append((int(parts[1]) / 1e6, parts[2].strip()))
+    return sorted(imports, reverse=True)[:count]
+
+def poll(client, url, until, timeout=120):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            r = client.get(url)
+            if until(r):
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.005)
+    raise RuntimeError(f"{url} was not ready after {timeout}s")
+
+def time_to_serve(env, tmp, run):
+    #each run gets its own state files, so nothing is picked up from an earlier run
+    env = dict(env, KNOWN_PERSONS_DB=os.path.join(tmp, f"known_persons_{run}.db"), SHARED_STATE_DB=os.path.join(tmp, f"shared_state_{run}.db"),
+               BUILDINGS_CACHE_DB=os.path.join(tmp, f"buildings_cache_{run}.db"), IDEMPOTENCY_DB=os.path.join(tmp, f"idempotency_{run}.db"))
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    api = subprocess.Popen([sys.executable, os.path.join(benchmarks, "serve.py"), "--port", str(port)], env=env, cwd=repo)
+    try:
+        with httpx.Client(base_url=base_url, timeout=5) as client:
+            poll(client, "/version-info", lambda r: r.status_code == 200)
+            first_200 = time.perf_counter() - started
+            poll(client, "/buildings/states/classes", lambda r: r.status_code == 200 and len(r.json()) > 0)
+            warm = time.perf_counter() - started
+    finally:
+        api.terminate()
+        api.wait()
+    return first_200, warm
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the import time of the API, and the time it takes to serve its first requests")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--artefact", default="", help="the ontology artefact for the API to load at startup - by default it loads the ontology from the stand-in")
+    parser.add_argument("--baseline", default=os.path.join(benchmarks, "baselines.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the startup baseline")
+    parser.add_argument("--check", action="store_true", help="exit with 1 if startup has regressed against the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="how much slower than the baseline startup can be before it counts as a regression")
+    args = parser.parse_args()
+
+    env = dict(os.environ, UPDATE_MODE="SCG", DEV="True", ONTOLOGY_ARTEFACT=args.artefact)
+    imports = [import_time(env) for _ in range(args.runs)]
+    print(f"import api                {statistics.median(imports) * 1000:>9.1f}ms (median of {args.runs})")
+    for seconds, module in slowest_imports(env):
+        print(f"  {module:<24}{seconds * 1000:>9.1f}ms")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        jena_port = free_port()
+        loads = []
+        for filename in ontology_files:
+            loads += ["--load", f"ontology={os.path.join(repo, filename)}"]
+        jena = subprocess.Popen([sys.executable, os.path.join(benchmarks, "sparql_standin.py"), "--port", str(jena_port)] + loads)
+        try:
+            wait_for(f"http://127.0.0.1:{jena_port}/$/stats", jena, timeout=600)
+            env.update(JENA_URL="127.0.0.1", JENA_PORT=str(jena_port), JENA_PROTOCOL="http")
+            timings = [time_to_serve(env, tmp, run) for run in range(args.runs)]
+        finally:
+            jena.terminate()
+            jena.wait()
+    results = {
+        "import_ms": round(statistics.median(imports) * 1000, 1),
+        "first_200_ms": round(statistics.median(first_200 for first_200, warm in timings) * 1000, 1),
+        "warm_ms": round(statistics.median(warm for first_200, warm in timings) * 1000, 1),
+    }
+    print(f"first 200                 {results['first_200_ms']:>9.1f}ms (median of {args.runs})")
+    print(f"warm                      {results['warm_ms']:>9.1f}ms (median of {args.runs})")
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    regressions = []
+    if "startup" in baselines and not args.save_baseline:
+        print("Against the startup baseline:")
+        for name, value in results.items():
+            base = baselines["startup"]["results"][name]
+            change = (value - base) / base if base else 0
+            regressed = change > args.tolerance
+            if regressed:
+                regressions.append(name)
+            print(f"  {name:<14} {base:>9.1f}ms -> {value:>9.1f}ms ({change:+.0%}){'  REGRESSION' if regressed else ''}")
+    if args.save_baseline:
+        baselines["startup"] = {"runs": args.runs, "machine": {"cpus": os.cpu_count(), "python": platform.python_version(), "platform": platform.platform()}, "results": results}
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("Saved as the startup baseline")
+    if args.check and regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
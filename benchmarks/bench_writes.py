@@ -0,0 +1,84 @@
+#Benchmark of producing the N-Triples payload for a flag write (flag plus person triples) on one core: the old path of
+#parsing an INSERT DATA with rdflib and serialising it back, against the TripleBuilder.
+#Run from the repo root: python benchmarks/bench_writes.py [seconds]
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from ntriples import TripleBuilder
+
+ies = "http://ies.data.gov.uk/ontology/ies4#"
+ndt = "http://nationaldigitaltwin.gov.uk/data#"
+data = "http://nationaldigitaltwin.gov.uk/data#"
+prefixes = f"PREFIX ies: <{ies}>\nPREFIX ndt: <{ndt}>\n"
+
+user_id = "1234-5678-99ab-cdef"
+given_name, surname = "Test", "User1"
+person = data + user_id
+
+def rdflib_write():
+    from rdflib import Graph
+    flag_state = data + str(uuid.uuid4())
+    flag_time = "http://iso.org/iso8601#" + datetime.now().isoformat()
+    query = f"""
+        {prefixes}
+        INSERT DATA {{
+            <{flag_state}> ies:interestedIn <{data}building_100060748037> .
+            <{flag_state}> ies:isStateOf <{person}> .
+            <{flag_state}> ies:inPeriod <{flag_time}> .
+            <{flag_state}> a ndt:InterestedInVisiting .
+            <{person}> a ies:Person .
+            <{person}> ies:hasName <{person}_NAME> .
+            <{person}_NAME> a ies:PersonName .
+            <{person}_SURNAME> a ies:Surname .
+            <{person}_SURNAME> ies:inRepresentation <{person}_NAME> .
+            <{person}_SURNAME> ies:representationValue "{surname}" .
+            <{person}_GIVENNAME> a ies:GivenName .
+            <{person}_GIVENNAME> ies:inRepresentation <{person}_NAME> .
+            <{person}_GIVENNAME> ies:representationValue "{given_name}" .
+        }}"""
+    g = Graph()
+    g.update(query)
+    return g.serialize(format='nt')
+
+def builder_write():
+    flag_state = data + str(uuid.uuid4())
+    flag_time = "http://iso.org/iso8601#" + datetime.now().isoformat()
+    triples = TripleBuilder()
+    triples.add(flag_state, ies + "interestedIn", data + "building_100060748037")
+    triples.add(flag_state, ies + "isStateOf", person)
+    triples.add(flag_state, ies + "inPeriod", flag_time)
+    triples.add_type(flag_state, ndt + "InterestedInVisiting")
+    triples.add_type(person, ies + "Person")
+    triples.add(person, ies + "hasName", person + "_NAME")
+    triples.add_type(person + "_NAME", ies + "PersonName")
+    triples.add_type(person + "_SURNAME", ies + "Surname")
+    triples.add(person + "_SURNAME", ies + "inRepresentation", person + "_NAME")
+    triples.add_literal(person + "_SURNAME", ies + "representationValue", surname)
+    triples.add_type(person + "_GIVENNAME", ies + "GivenName")
+    triples.add(person + "_GIVENNAME", ies + "inRepresentation", person + "_NAME")
+    triples.add_literal(person + "_GIVENNAME", ies + "representationValue", given_name)
+    return triples.to_ntriples()
+
+def run(label, write, seconds):
+    write()
+    count = 0
+    start = time.process_time()
+    while time.process_time() - start < seconds:
+        write()
+        count = count + 1
+    elapsed = time.process_time() - start
+    print(f"{label:<16}{count / elapsed:>12,.0f} writes/s per core  {elapsed / count * 1e6:>10.1f} us/write")
+    return count / elapsed
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    builder_rate = run("TripleBuilder", builder_write, seconds)
+    try:
+        rdflib_rate = run("rdflib update", rdflib_write, seconds)
+        print(f"speedup: {builder_rate / rdflib_rate:.0f}x")
+    except ImportError:
+        print("rdflib is not installed - skipping the rdflib path")
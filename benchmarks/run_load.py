@@ -0,0 +1,219 @@
+#Load test of the API against a local stand-in for Jena (benchmarks/sparql_standin.py) loaded with synthetic buildings
+#(benchmarks/synthetic.py), with writes going to an in-memory sink instead of Kafka (benchmarks/serve.py).
+#Each endpoint is driven at a fixed concurrency for a fixed time, and the p50/p95/p99 latency, throughput, errors and
+#peak RSS of the API process are reported. Results can be saved as the baseline for that scale in baselines.json, and
+#later runs are compared against it, so regressions show up as numbers. Baselines are only comparable on the same machine.
+#To test against a real Fuseki instead of the stand-in, load the output of benchmarks/synthetic.py (with the same size
+#and seed) into it and pass --jena.
+#Run from the repo root: python benchmarks/run_load.py [--buildings 10000] [--concurrency 16] [--duration 10] [--save-baseline] [--check]
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlparse
+import httpx
+
+benchmarks = os.path.dirname(os.path.abspath(__file__))
+repo = os.path.join(benchmarks, "..")
+sys.path.insert(0, benchmarks)
+import synthetic
+
+ontology_files = ["ies4.ttl", "iesExtensions.ttl", "ndt_retrofit_buildings_extensions.ttl"]
+
+#each scenario picks a request to make from the sample of the synthetic data
+scenarios = {
+    "buildings": lambda rng, sample: ("GET", "/buildings?geohash=" + rng.choice(sample["geohashes"]), None),
+    "viewport": lambda rng, sample: ("GET", "/buildings/viewport?" + "&".join("geohash=" + gh for gh in rng.sample(sample["geohashes"], min(20, len(sample["geohashes"])))), None),
+    "building_by_uprn": lambda rng, sample: ("GET", "/buildings/" + rng.choice(sample["uprns"]), None),
+    "buildings_by_uprn": lambda rng, sample: ("POST", "/buildings/by-uprn", [rng.choice(sample["uprns"]) for _ in range(100)]),
+    "flag_to_visit": lambda rng, sample: ("POST", "/flag-to-visit", {"uri": rng.choice(sample["building_uris"])}),
+    "flag_to_investigate": lambda rng, sample: ("POST", "/flag-to-investigate", {"uri": rng.choice(sample["building_uris"])}),
+    "invalidate_flag": lambda rng, sample: ("POST", "/invalidate-flag", {"flagUri": rng.choice(sample["flags"])}),
+}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def rss_mb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0
+
+def wait_for(url, process, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args} exited with {process.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.25)
+    raise RuntimeError(f"{url} was not up after {timeout}s")
+
+async def drive(base_url, scenario, sample, concurrency, duration, pid, seed):
+    latencies = []
+    errors = 0
+    peak_rss = rss_mb(pid)
+    deadline = time.perf_counter() + duration
+    async with httpx.AsyncClient(base_url=base_url, timeout=60, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def worker(i):
+            nonlocal errors
+            rng = random.Random(seed * 1000 + i)
+            while time.perf_counter() < deadline:
+                method, path, body = scenario(rng, sample)
+                started = time.perf_counter()
+                try:
+                    r = await client.request(method, path, json=body)
+                    if r.status_code >= 400:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+        async def sample_rss():
+            nonlocal peak_rss
+            while time.perf_counter() < deadline:
+                peak_rss = max(peak_rss, rss_mb(pid))
+                await asyncio.sleep(0.25)
+        await asyncio.gather(sample_rss(), *[worker(i) for i in range(concurrency)])
+    return latencies, errors, peak_rss
+
+def summarise(latencies, errors, peak_rss, duration):
+    if len(latencies) < 2:
+        latencies = latencies * 2 or [0, 0]
+    q = statistics.quantiles(latencies, n=100)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / duration, 1),
+        "p50_ms": round(q[49] * 1000, 2),
+        "p95_ms": round(q[94] * 1000, 2),
+        "p99_ms": round(q[98] * 1000, 2),
+        "rss_mb": round(peak_rss, 1),
+    }
+
+def compare(results, baseline, tolerance):
+    """
+    Prints each endpoint's change against the baseline, and returns the endpoints whose p95 latency or throughput
+    is worse than the baseline by more than the tolerance
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        p95 = result["p95_ms"] / max(base["p95_ms"], 0.001) - 1
+        throughput = result["throughput"] / max(base["throughput"], 0.001) - 1
+        regressed = p95 > tolerance or throughput < -tolerance or result["errors"] > base["errors"]
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<22} p95 {p95:+7.1%}  throughput {throughput:+7.1%}  {'REGRESSION' if regressed else 'ok'}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Load tests the API against a local Jena stand-in and an in-memory Kafka sink")
+    parser.add_argument("--buildings", type=int, default=10000, help="the number of synthetic buildings (10k to 5M - pyoxigraph is needed for the larger sizes)")
+    parser.add_argument("--per-cell", type=int, default=50, help="roughly how many buildings are in each 5 character geohash")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10, help="seconds each endpoint is driven for")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds each endpoint is driven for before it is measured")
+    parser.add_argument("--scenarios", default=",".join(scenarios))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", default=os.path.join(benchmarks, "baselines.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the baseline for this scale")
+    parser.add_argument("--check", action="store_true", help="exit with 1 if any endpoint has regressed against the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="how much worse than the baseline an endpoint can be before it counts as a regression")
+    parser.add_argument("--jena", help="the URL of a Jena already loaded with the synthetic data, instead of starting the stand-in")
+    parser.add_argument("--out", help="also write the results to this file as JSON")
+    args = parser.parse_args()
+
+    processes = []
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            started = time.time()
+            data_file = os.path.join(tmp, "buildings.nt")
+            sample = synthetic.generate(args.buildings, data_file, per_cell=args.per_cell, seed=args.seed)
+            print(f"Generated {args.buildings} buildings in {time.time() - started:.1f}s")
+
+            if args.jena:
+                jena_url = urlparse(args.jena)
+            else:
+                jena_url = urlparse(f"http://127.0.0.1:{free_port()}")
+                loads = ["--load", f"knowledge={data_file}"]
+                for filename in ontology_files:
+                    loads += ["--load", f"ontology={os.path.join(repo, filename)}"]
+                jena = subprocess.Popen([sys.executable, os.path.join(benchmarks, "sparql_standin.py"), "--port", str(jena_url.port)] + loads)
+                processes.append(jena)
+                wait_for(f"http://127.0.0.1:{jena_url.port}/$/stats", jena, timeout=3600)
+
+            api_port = free_port()
+            #the API's state files go in the temporary directory too, so no run picks up the caches or keys of an earlier one
+            #and the stand-in doesn't filter by label, so the geohash index doesn't need a service identity to load
+            env = dict(os.environ, JENA_PROTOCOL=jena_url.scheme, JENA_URL=jena_url.hostname, JENA_PORT=str(jena_url.port), DEV="True",
+                       KNOWN_PERSONS_DB=os.path.join(tmp, "known_persons.db"), SHARED_STATE_DB=os.path.join(tmp, "shared_state.db"),
+                       BUILDINGS_CACHE_DB=os.path.join(tmp, "buildings_cache.db"), IDEMPOTENCY_DB=os.path.join(tmp, "idempotency.db"),
+                       READ_MODEL_FILE=os.path.join(tmp, "read_model.pickle"), READ_MODEL_TOPIC_FILE=os.path.join(tmp, "read_model_writes.jsonl"),
+                       ONTOLOGY_ARTEFACT="", GEOHASH_INDEX=os.environ.get("GEOHASH_INDEX", "True"))
+            api = subprocess.Popen([sys.executable, os.path.join(benchmarks, "serve.py"), "--port", str(api_port)], env=env)
+            processes.append(api)
+            base_url = f"http://127.0.0.1:{api_port}"
+            wait_for(base_url + "/version-info", api, timeout=600)
+
+            results = {}
+            for name in args.scenarios.split(","):
+                scenario = scenarios[name]
+                if args.warmup > 0:
+                    asyncio.run(drive(base_url, scenario, sample, args.concurrency, args.warmup, api.pid, args.seed))
+                latencies, errors, peak_rss = asyncio.run(drive(base_url, scenario, sample, args.concurrency, args.duration, api.pid, args.seed))
+                results[name] = summarise(latencies, errors, peak_rss, args.duration)
+                r = results[name]
+                print(f"{name:<22} {r['throughput']:>8.1f} req/s  p50 {r['p50_ms']:>8.2f}ms  p95 {r['p95_ms']:>8.2f}ms  p99 {r['p99_ms']:>8.2f}ms  rss {r['rss_mb']:>7.1f}MB  errors {r['errors']}")
+        finally:
+            for process in reversed(processes):
+                process.terminate()
+                process.wait()
+
+    run = {
+        "buildings": args.buildings,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "jena": args.jena or "stand-in",
+        "machine": {"cpus": os.cpu_count(), "python": platform.python_version(), "platform": platform.platform()},
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(run, f, indent=2)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    key = f"{args.buildings}@{args.concurrency}"
+    regressions = []
+    if key in baselines and not args.save_baseline:
+        print(f"Against the baseline for {args.buildings} buildings at concurrency {args.concurrency}:")
+        regressions = compare(results, baselines[key]["results"], args.tolerance)
+    if args.save_baseline:
+        baselines[key] = run
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Saved as the baseline for {args.buildings} buildings at concurrency {args.concurrency}")
+    if args.check and regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
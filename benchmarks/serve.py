@@ -0,0 +1,41 @@
+#Runs the API for the load tests. Writes go through the same batching producer as in production, but into an in-memory
+#sink instead of Kafka, so no broker is needed. Point it at Jena (or benchmarks/sparql_standin.py) with the
+#usual environment variables. With --topic-file the writes go into a file of JSON lines instead, which stands in for the
+#knowledge topic that the read model (READ_MODEL=True and READ_MODEL_UNLABELLED=True) follows.
+#Run from the repo root: python benchmarks/serve.py [--port 5021] [--kafka-delay 0] [--topic-file writes.jsonl]
+import argparse
+import os
+import sys
+from collections import deque
+
+repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, repo)
+os.chdir(repo)
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the API with an in-memory sink in place of Kafka")
+    parser.add_argument("--port", type=int, default=5021)
+    parser.add_argument("--kafka-delay", type=float, default=0, help="seconds each send to the sink takes, to mimic a broker round trip")
+    parser.add_argument("--topic-file", help="a file to write the records to, for the read model to follow, instead of the in-memory sink")
+    args = parser.parse_args()
+
+    #api.py only creates the Kafka sink in KAFKA mode, so it is imported in SCG mode and switched over before it starts
+    os.environ["UPDATE_MODE"] = "SCG"
+    if args.topic_file:
+        os.environ["READ_MODEL_TOPIC_FILE"] = args.topic_file
+    import uvicorn
+    import api
+    from producer import MemorySink
+    sink = MemorySink(delay=args.kafka_delay)
+    #only the latest records are kept, so the sink doesn't inflate the memory use being measured
+    sink.records = deque(maxlen=1000)
+    api.update_mode = "KAFKA"
+    api.start_kafka = lambda: None
+    api.send_to_kafka = sink.send
+    if args.topic_file:
+        from read_model import FileTopic
+        api.send_to_kafka = FileTopic(args.topic_file).send
+    uvicorn.run(api.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
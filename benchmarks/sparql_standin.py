@@ -0,0 +1,165 @@
+#A stand-in for Jena Fuseki for the load tests: an in-memory SPARQL endpoint serving the query, update and graph store
+#routes the API and loaders use, for any number of datasets. It uses pyoxigraph if it is installed (pip install pyoxigraph,
+#needed for more than about 10k buildings) and falls back to the much slower rdflib.
+#Run from the repo root: python benchmarks/sparql_standin.py [--port 3030] [--load knowledge=buildings.nt] [--load ontology=ies4.ttl ...]
+import argparse
+import re
+import time
+from collections import defaultdict
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.routing import Route
+
+#Neither embedded engine plans the API's queries the way Jena does: they start an OPTIONAL at its most constant pattern,
+#so "?x rdf:type <Class>" inside an OPTIONAL scans every instance of the class for each row, and they plan the patterns
+#either side of a BIND separately. Without these two rewrites (which are equivalent for the API's queries) the stand-in,
+#not the API, would dominate the results
+type_pattern = re.compile(r"(\?\w+)\s+(?:rdf:type|a)\s+(\w*:\w+|<[^>]+>)\s*\.")
+bind_pattern = re.compile(r"BIND\s*\(.*?\s+as\s+\?\w+\s*\)\s*\.?", re.IGNORECASE | re.DOTALL)
+
+def plan_hints(query):
+    count = 0
+    def bind_type(match):
+        nonlocal count
+        count += 1
+        var = f"?standin_type_{count}"
+        return f"{match.group(1)} rdf:type {var} . FILTER({var} = {match.group(2)})"
+    query = type_pattern.sub(bind_type, query)
+    #move each BIND to the end of its group
+    pos = 0
+    while True:
+        match = bind_pattern.search(query, pos)
+        if match is None:
+            return query
+        depth = 0
+        end = match.end()
+        while end < len(query):
+            if query[end] == "{":
+                depth += 1
+            elif query[end] == "}":
+                if depth == 0:
+                    break
+                depth -= 1
+            end += 1
+        bind = match.group(0).rstrip(" .")
+        query = query[:match.start()] + query[match.end():end] + bind + "\n" + query[end:]
+        pos = end - (match.end() - match.start()) + len(bind) + 1
+
+def rdf_format(filename):
+    return "nt" if filename.endswith(".nt") else "turtle"
+
+class OxigraphStore():
+    def __init__(self):
+        import pyoxigraph
+        self.ox = pyoxigraph
+        self.store = pyoxigraph.Store()
+
+    def load(self, data, format, graph=None):
+        to_graph = self.ox.NamedNode(graph) if graph else self.ox.DefaultGraph()
+        self.store.bulk_load(data, format=self.ox.RdfFormat.N_TRIPLES if format == "nt" else self.ox.RdfFormat.TURTLE, to_graph=to_graph)
+
+    def clear(self, graph):
+        self.store.clear_graph(self.ox.NamedNode(graph))
+
+    def query(self, query):
+        results = self.store.query(plan_hints(query))
+        if isinstance(results, self.ox.QueryBoolean):
+            return b'{"head":{},"boolean":%s}' % (b"true" if bool(results) else b"false")
+        return results.serialize(format=self.ox.QueryResultsFormat.JSON)
+
+    def update(self, update):
+        self.store.update(update)
+
+class RdflibStore():
+    def __init__(self):
+        from rdflib import Dataset
+        self.ds = Dataset()
+
+    def load(self, data, format, graph=None):
+        from rdflib import URIRef
+        target = self.ds.graph(URIRef(graph)) if graph else self.ds.default_context
+        target.parse(data=data.decode("utf-8"), format=format)
+
+    def clear(self, graph):
+        from rdflib import URIRef
+        self.ds.remove_graph(URIRef(graph))
+
+    def query(self, query):
+        return self.ds.query(plan_hints(query)).serialize(format="json")
+
+    def update(self, update):
+        self.ds.update(update)
+
+def new_store():
+    try:
+        return OxigraphStore()
+    except ImportError:
+        return RdflibStore()
+
+stores = defaultdict(new_store)
+stats = defaultdict(int)
+
+async def query(request):
+    if request.method == "GET":
+        q = request.query_params["query"]
+    elif "form" in request.headers.get("content-type", ""):
+        q = (await request.form())["query"]
+    else:
+        q = (await request.body()).decode("utf-8")
+    stats["queries"] += 1
+    try:
+        body = await run_in_threadpool(stores[request.path_params["ds"]].query, q)
+    except Exception as e:
+        return Response(str(e), status_code=400)
+    return Response(body, media_type="application/sparql-results+json")
+
+async def update(request):
+    if "form" in request.headers.get("content-type", ""):
+        u = (await request.form())["update"]
+    else:
+        u = (await request.body()).decode("utf-8")
+    stats["updates"] += 1
+    try:
+        await run_in_threadpool(stores[request.path_params["ds"]].update, u)
+    except Exception as e:
+        return Response(str(e), status_code=400)
+    return Response(status_code=204)
+
+async def graph_store(request):
+    store = stores[request.path_params["ds"]]
+    graph = request.query_params.get("graph")
+    format = "nt" if "n-triples" in request.headers.get("content-type", "") else "turtle"
+    body = await request.body()
+    if request.method == "PUT" and graph:
+        await run_in_threadpool(store.clear, graph)
+    await run_in_threadpool(store.load, body, format, graph)
+    return Response(status_code=201 if request.method == "PUT" else 200)
+
+async def get_stats(request):
+    return Response(str(dict(stats)))
+
+app = Starlette(routes=[
+    Route("/{ds}/query", query, methods=["GET", "POST"]),
+    Route("/{ds}/sparql", query, methods=["GET", "POST"]),
+    Route("/{ds}/update", update, methods=["POST"]),
+    Route("/{ds}/data", graph_store, methods=["POST", "PUT"]),
+    Route("/$/stats", get_stats),
+])
+
+def main():
+    import uvicorn
+    parser = argparse.ArgumentParser(description="An in-memory stand-in for Jena Fuseki")
+    parser.add_argument("--port", type=int, default=3030)
+    parser.add_argument("--load", action="append", default=[], help="dataset=file to load into the dataset's default graph before starting")
+    args = parser.parse_args()
+    for load in args.load:
+        ds, filename = load.split("=", 1)
+        started = time.time()
+        with open(filename, "rb") as f:
+            stores[ds].load(f.read(), rdf_format(filename))
+        print(f"Loaded {filename} into {ds} in {time.time() - started:.1f}s ({type(stores[ds]).__name__})", flush=True)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#Generates a synthetic knowledge graph of buildings for the load tests, in the shape the API queries: every building has
+#a type and built form, a geohash location, a UPRN, a TOID (or a parent building with one) and an EPC energy rating state,
+#and some have flags, some of which have been invalidated. The same seed always gives the same data.
+#Run from the repo root: python benchmarks/synthetic.py <buildings> <out.nt> [--per-cell 50] [--seed 1]
+import argparse
+import json
+import random
+
+ies = "http://ies.data.gov.uk/ontology/ies4#"
+ndt_ont = "http://nationaldigitaltwin.gov.uk/ontology#"
+ndt = "http://nationaldigitaltwin.gov.uk/data#"
+data = "http://nationaldigitaltwin.gov.uk/data#"
+gp = "https://www.geoplace.co.uk/addresses-streets/location-data/the-uprn#"
+epc = "http://gov.uk/government/organisations/department-for-levelling-up-housing-and-communities/ontology/epc#"
+rdf_type = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+geohash_stub = "http://geohash.org/"
+base32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+building_types = ["House", "Flat", "Bungalow", "Maisonette"]
+built_forms = ["Detached", "SemiDetached", "MidTerrace", "EndTerrace"]
+ratings = "ABCDEFG"
+flag_types = [ndt + "InterestedInVisiting", ndt + "InterestedInInvestigating"]
+
+#how many of each thing are kept for the load test to pick from
+sample_size = 1000
+
+def encode(n, length):
+    chars = []
+    for _ in range(length):
+        n, i = divmod(n, 32)
+        chars.append(base32[i])
+    return "".join(reversed(chars))
+
+def generate(n, out, per_cell=50, seed=1, flag_ratio=0.1, invalidated_ratio=0.3, parent_ratio=0.1, people=100):
+    """
+    Writes n buildings as N-Triples to the file out, spread over 5 character geohash cells holding about per_cell
+    buildings each, and returns a sample of the cells, UPRNs, buildings and flags to drive the load test with
+    """
+    rng = random.Random(seed)
+    #the cells all start with "g", so up to a million distinct 5 character cells are available
+    cells = ["g" + encode(i, 4) for i in rng.sample(range(32 ** 4), max(1, min(n // per_cell, 32 ** 4)))]
+    persons = [data + f"person_{i}" for i in range(people)]
+    sample = {"buildings": n, "geohashes": cells[:sample_size], "uprns": [], "building_uris": [], "flags": []}
+    with open(out, "w", encoding="utf-8") as f:
+        for i in range(n):
+            building = data + f"building_{i}"
+            uprn_id = str(100000000000 + i)
+            lines = [
+                f"<{building}> <{rdf_type}> <{ndt_ont}{rng.choice(building_types)}> .",
+                f"<{building}> <{rdf_type}> <{ndt_ont}{rng.choice(built_forms)}> .",
+                f"<{building}> <{ies}inLocation> <{geohash_stub}{rng.choice(cells)}{encode(rng.randrange(32 ** 4), 4)}> .",
+                f"<{building}> <{ies}isIdentifiedBy> <{building}_UPRN> .",
+                f"<{building}_UPRN> <{rdf_type}> <{gp}UniquePropertyReferenceNumber> .",
+                f"<{building}_UPRN> <{ies}representationValue> \"{uprn_id}\" .",
+                f"<{building}_STATE> <{ies}isStateOf> <{building}> .",
+                f"<{building}_STATE> <{rdf_type}> <{epc}BuildingWithEnergyRatingOf{rng.choice(ratings)}> .",
+            ]
+            if rng.random() < parent_ratio:
+                parent = data + f"parent_{i}"
+                lines += [
+                    f"<{building}> <{ies}isPartOf> <{parent}> .",
+                    f"<{parent}> <{ies}isIdentifiedBy> <{parent}_TOID> .",
+                    f"<{parent}_TOID> <{rdf_type}> <{ies}TOID> .",
+                    f"<{parent}_TOID> <{ies}representationValue> \"osgb{5000000000000 + i}\" .",
+                ]
+            else:
+                lines += [
+                    f"<{building}> <{ies}isIdentifiedBy> <{building}_TOID> .",
+                    f"<{building}_TOID> <{rdf_type}> <{ies}TOID> .",
+                    f"<{building}_TOID> <{ies}representationValue> \"osgb{1000000000000 + i}\" .",
+                ]
+            if rng.random() < flag_ratio:
+                flag = data + f"flag_{i}"
+                person = rng.choice(persons)
+                lines += [
+                    f"<{flag}> <{ies}interestedIn> <{building}> .",
+                    f"<{flag}> <{ies}isStateOf> <{person}> .",
+                    f"<{flag}> <{rdf_type}> <{rng.choice(flag_types)}> .",
+                    f"<{flag}> <{ies}inPeriod> <http://iso.org/iso8601#2024-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}> .",
+                ]
+                if rng.random() < invalidated_ratio:
+                    lines += [
+                        f"<{flag}_ASSESSMENT> <{rdf_type}> <{ndt_ont}AssessToBeFalse> .",
+                        f"<{flag}_ASSESSMENT> <{ies}assessed> <{flag}> .",
+                        f"<{flag}_ASSESSMENT> <{ies}assessor> <{rng.choice(persons)}> .",
+                        f"<{flag}_ASSESSMENT> <{ies}inPeriod> <http://iso.org/iso8601#2024-1{rng.randint(0, 2)}-1{rng.randint(0, 9)}> .",
+                    ]
+                if len(sample["flags"]) < sample_size:
+                    sample["flags"].append(flag)
+            f.write("\n".join(lines) + "\n")
+            if len(sample["uprns"]) < sample_size:
+                sample["uprns"].append(uprn_id)
+                sample["building_uris"].append(building)
+    return sample
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates a synthetic knowledge graph of buildings for the load tests")
+    parser.add_argument("buildings", type=int)
+    parser.add_argument("out")
+    parser.add_argument("--per-cell", type=int, default=50, help="roughly how many buildings are in each 5 character geohash")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    sample = generate(args.buildings, args.out, per_cell=args.per_cell, seed=args.seed)
+    print(json.dumps({key: value[:5] if isinstance(value, list) else value for key, value in sample.items()}, indent=2))
+
+if __name__ == "__main__":
+    main()
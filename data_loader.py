@@ -1,28 +1,153 @@
 #This code is used to load turtle data files from folders (listed in the folders list) into Jena for local testing.
-#For the IoW housing data, this may take a while as they're lots of little files
+#For the IoW housing data there are lots of little files, so rather than posting them one at a time they are converted
+#to N-Triples (in parallel), coalesced into large chunks and uploaded concurrently over a pooled session.
+#Completed files are recorded in a checkpoint file, so a failed load can be re-run and will carry on where it stopped.
+#
+#   python data_loader.py [folders...] [--jena http://localhost:3030] [--dataset knowledge] [--chunk-mb 16] [--workers 4] [--gzip]
 
-import json
+import argparse
+import gzip
 import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import requests
-from urllib.parse import quote
+from requests.adapters import HTTPAdapter
 
 jena_host = 'http://localhost:3030'
 dataset = "knowledge"
 path = "data?default"
-jena_update = jena_host+"/"+dataset+"/"+path
 
 folders = ["address-epcs","uprn-latlon-toids"]
 
-for folder in folders:
-    directory = os.fsencode(folder)
-        
-    for file in os.listdir(directory):
-        filename = os.path.join(folder,os.fsdecode(file))
-        if filename.endswith(".ttl"): 
-            with open(filename) as f:
-                data = f.read()
-                headers = {'Content-Type': 'text/turtle;charset=utf-8'}
-                r = requests.post(jena_update, data=data, headers=headers)
-                print(filename)
+def to_ntriples(filename):
+    if filename.endswith(".nt"):
+        with open(filename, encoding="utf-8") as f:
+            return filename, f.read()
+    from rdflib import Graph
+    g = Graph()
+    g.parse(filename, format="turtle")
+    return filename, g.serialize(format="nt")
 
+def list_files(folders, done):
+    filenames = []
+    for folder in folders:
+        for file in sorted(os.listdir(folder)):
+            filename = os.path.join(folder, file)
+            if (filename.endswith(".ttl") or filename.endswith(".nt")) and filename not in done:
+                filenames.append(filename)
+    return filenames
 
+def convert_files(filenames, processes):
+    """
+    Converts the files in a process pool, yielding them in order. Only a bounded number of files are converted ahead
+    of the uploads, so memory doesn't grow with the size of the load
+    """
+    window = processes * 8
+    with ProcessPoolExecutor(processes) as pool:
+        pending = []
+        for filename in filenames:
+            pending.append(pool.submit(to_ntriples, filename))
+            if len(pending) >= window:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+def make_chunks(converted, chunk_bytes):
+    files = []
+    parts = []
+    size = 0
+    for filename, data in converted:
+        files.append(filename)
+        parts.append(data)
+        size = size + len(data)
+        if size >= chunk_bytes:
+            yield files, "".join(parts)
+            files, parts, size = [], [], 0
+    if files:
+        yield files, "".join(parts)
+
+class Loader():
+    def __init__(self, url, workers, use_gzip, retries, checkpoint):
+        self.url = url
+        self.use_gzip = use_gzip
+        self.retries = retries
+        self.checkpoint = checkpoint
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=workers))
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=workers))
+        self.lock = threading.Lock()
+        self.files_done = 0
+        self.bytes_done = 0
+        self.failed = []
+        self.started = time.time()
+
+    def upload(self, files, data):
+        body = data.encode("utf-8")
+        headers = {'Content-Type': 'application/n-triples'}
+        if self.use_gzip:
+            body = gzip.compress(body, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
+        for attempt in range(self.retries + 1):
+            try:
+                r = self.session.post(self.url, data=body, headers=headers, timeout=600)
+                r.raise_for_status()
+                break
+            except requests.RequestException as e:
+                if attempt == self.retries:
+                    print(f"Failed to load a chunk of {len(files)} files after {attempt + 1} attempts: {e}")
+                    with self.lock:
+                        self.failed.extend(files)
+                    return
+                time.sleep(2 ** attempt)
+        with self.lock:
+            if self.checkpoint:
+                with open(self.checkpoint, "a") as f:
+                    f.write("".join(filename + "\n" for filename in files))
+            self.files_done = self.files_done + len(files)
+            self.bytes_done = self.bytes_done + len(data)
+            elapsed = time.time() - self.started
+            print(f"{self.files_done} files, {self.bytes_done / 1e6:.1f} MB loaded in {elapsed:.0f}s ({self.bytes_done / 1e6 / max(elapsed, 0.001):.1f} MB/s)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk loads folders of turtle files into Jena")
+    parser.add_argument("folders", nargs="*", default=folders)
+    parser.add_argument("--jena", default=jena_host)
+    parser.add_argument("--dataset", default=dataset)
+    parser.add_argument("--chunk-mb", type=float, default=16, help="size of each upload, in MB of N-Triples")
+    parser.add_argument("--workers", type=int, default=4, help="number of concurrent uploads")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="number of processes converting turtle to N-Triples")
+    parser.add_argument("--gzip", action="store_true", help="gzip the uploads (the server must accept Content-Encoding: gzip)")
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--checkpoint", default="data_loader.checkpoint", help="file recording the files already loaded, empty to disable")
+    args = parser.parse_args()
+
+    done = set()
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        with open(args.checkpoint) as f:
+            done = set(line.strip() for line in f)
+        print(f"Resuming - skipping {len(done)} files already loaded")
+    filenames = list_files(args.folders, done)
+    print(f"Loading {len(filenames)} files")
+
+    loader = Loader(f"{args.jena}/{args.dataset}/{path}", args.workers, args.gzip, args.retries, args.checkpoint)
+    #a semaphore keeps the number of chunks held in memory bounded while uploads are in flight
+    slots = threading.Semaphore(args.workers * 2)
+    def upload(files, data):
+        try:
+            loader.upload(files, data)
+        finally:
+            slots.release()
+    with ThreadPoolExecutor(args.workers) as uploads:
+        for files, data in make_chunks(convert_files(filenames, args.processes), int(args.chunk_mb * 1e6)):
+            slots.acquire()
+            uploads.submit(upload, files, data)
+
+    if loader.failed:
+        print(f"{len(loader.failed)} files failed to load - re-run to retry them")
+        sys.exit(1)
+    print("Done")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+from bisect import bisect_left
+from datetime import datetime
+import pygeohash as pgh
+
+geohash_stub = "http://geohash.org/"
+
+#The query used to pull every building location out of Jena when the index is (re)built
+location_query = f"""
+    SELECT ?building ?geopoint WHERE {{
+        ?building ies:inLocation ?geopoint .
+        FILTER(STRSTARTS(STR(?geopoint), "{geohash_stub}"))
+    }}"""
+
+def covering_cells(min_lat: float, min_lon: float, max_lat: float, max_lon: float, precision: int, max_cells: int = None):
+    """
+    The geohashes (of the given precision) of every cell that overlaps the bounding box, sorted. Raises a ValueError if
+    there would be more than max_cells of them
+    """
+    #cells are the same size everywhere at a given precision, so the box is covered by stepping one cell at a time from the corner
+    lat, lon, lat_err, lon_err = pgh.decode_exactly(pgh.encode(min_lat, min_lon, precision))
+    rows = int((max_lat - (lat - lat_err)) // (lat_err * 2)) + 1
+    columns = int((max_lon - (lon - lon_err)) // (lon_err * 2)) + 1
+    if max_cells is not None and rows * columns > max_cells:
+        raise ValueError(f"The bounding box covers {rows * columns} geohashes of {precision} characters, the most allowed is {max_cells}")
+    cells = set()
+    for row in range(rows):
+        for column in range(columns):
+            cells.add(pgh.encode(min(lat + row * lat_err * 2, 90), lon + column * lon_err * 2, precision))
+    return sorted(cells)
+
+def minimal_cells(geohashes: list[str]):
+    """
+    The geohashes without any that are inside another of them, sorted
+    """
+    cells = []
+    #a geohash sorts just before all the geohashes inside it
+    for geohash in sorted(set(geohashes)):
+        if not cells or not geohash.startswith(cells[-1]):
+            cells.append(geohash)
+    return cells
+
+class GeohashIndex():
+    """
+    A sorted array of (geohash, building) pairs, so all the buildings inside a geohash can be found with two
+    binary searches instead of Jena stringifying and scanning every ies:inLocation point.
+    The arrays are rebuilt as a whole and swapped in on refresh. The buildings are only candidates - they are still
+    fetched with the caller's headers, so the index must be loaded by an identity that can see all of them.
+    """
+    def __init__(self):
+        #the geohashes and the building in each, swapped in together so a lookup never sees the arrays of two loads
+        self.arrays = ([], [])
+        self.loaded_at = None
+
+    def is_loaded(self):
+        return self.loaded_at is not None
+
+    def load(self, pairs: list[tuple[str, str]]):
+        pairs = sorted(pairs)
+        self.arrays = ([gh for gh, building in pairs], [building for gh, building in pairs])
+        self.loaded_at = datetime.now()
+
+    def load_sparql_results(self, results):
+        pairs = []
+        if results and results['results'] and results['results']['bindings']:
+            for row in results['results']['bindings']:
+                pairs.append((row['geopoint']['value'][len(geohash_stub):], row['building']['value']))
+        self.load(pairs)
+
+    def buildings_in(self, geohash: str):
+        """
+        The URIs of all the buildings located inside the geohash, sorted and de-duplicated
+        """
+        geohashes, buildings = self.arrays
+        start = bisect_left(geohashes, geohash)
+        end = bisect_left(geohashes, geohash + "\U0010ffff", lo=start)
+        return sorted(set(buildings[start:end]))
+
+    def __len__(self):
+        return len(self.arrays[0])
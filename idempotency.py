@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from starlette.concurrency import run_in_threadpool
+import metrics
+
+class IdempotencyConflict(Exception):
+    pass
+
+class IdempotencyInProgress(Exception):
+    pass
+
+class IdempotencyStore():
+    """
+    Remembers what each write made with an Idempotency-Key returned (the URIs it minted), so a retry of the write gets
+    the same answer without writing again. Concurrent duplicates wait for the first request rather than writing too.
+    It is backed by a SQLite file so it is shared by all the uvicorn workers on a host.
+        path - the SQLite file
+        ttl - how long, in seconds, a key is remembered for
+        max_size - the most keys remembered - the oldest are forgotten first
+        wait - how long, in seconds, a duplicate waits for a request with the same key in another worker to finish
+        pending_timeout - how long, in seconds, before a key whose request never finished (its worker died) can be used again
+    """
+    def __init__(self, path: str, ttl: float = 24 * 3600, max_size: int = 100000, wait: float = 10, pending_timeout: float = 60):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.wait = wait
+        self.pending_timeout = pending_timeout
+        self.local = threading.local()
+        self.in_flight = {}
+        self.claims = 0
+
+    def get_connection(self):
+        #sqlite connections can't be shared between threads
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS idempotency_keys (key TEXT PRIMARY KEY, fingerprint TEXT, response TEXT, created_at REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idempotency_keys_created_at ON idempotency_keys (created_at)")
+            self.local.conn = conn
+        return conn
+
+    def begin(self, key: str, fingerprint: str):
+        """
+        Returns None if the key is now this request's - call complete or abandon once the write is done. Otherwise
+        returns the fingerprint and response of the request that has it, the response being None while it is unfinished
+        """
+        now = time.time()
+        conn = self.get_connection()
+        cur = conn.execute("""
+            INSERT INTO idempotency_keys (key, fingerprint, response, created_at) VALUES (?, ?, NULL, ?)
+            ON CONFLICT (key) DO UPDATE SET fingerprint = excluded.fingerprint, response = NULL, created_at = excluded.created_at
+            WHERE idempotency_keys.created_at < ? OR (idempotency_keys.response IS NULL AND idempotency_keys.created_at < ?)
+        """, (key, fingerprint, now, now - self.ttl, now - self.pending_timeout))
+        if cur.rowcount > 0:
+            self.claims += 1
+            if self.claims % 1000 == 0:
+                self.prune()
+            return None
+        return conn.execute("SELECT fingerprint, response FROM idempotency_keys WHERE key = ?", (key,)).fetchone()
+
+    def complete(self, key: str, response):
+        self.get_connection().execute("UPDATE idempotency_keys SET response = ? WHERE key = ?", (json.dumps(response), key))
+
+    def abandon(self, key: str):
+        #the write failed, so a retry should make it again
+        self.get_connection().execute("DELETE FROM idempotency_keys WHERE key = ? AND response IS NULL", (key,))
+
+    def forget(self, key: str):
+        #the write was made but was never sent on, so a retry should make it again
+        self.get_connection().execute("DELETE FROM idempotency_keys WHERE key = ?", (key,))
+
+    def prune(self):
+        conn = self.get_connection()
+        conn.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (time.time() - self.ttl,))
+        conn.execute("""
+            DELETE FROM idempotency_keys WHERE key IN (
+                SELECT key FROM idempotency_keys ORDER BY created_at DESC LIMIT -1 OFFSET ?
+            )""", (self.max_size,))
+
+    async def run(self, key: str, fingerprint: str, write):
+        """
+        Runs write (a coroutine function) the first time key is seen, and returns what it returned then every time.
+        Raises IdempotencyConflict if the key was used for a different request, or IdempotencyInProgress if the
+        request that has it is still running in another worker after waiting for it
+        """
+        in_flight = self.in_flight.get(key)
+        if in_flight is not None:
+            #the same request is already being made in this worker - wait for its answer (or its error)
+            if in_flight[0] != fingerprint:
+                raise IdempotencyConflict()
+            metrics.idempotent_writes.labels("coalesced").inc()
+            return await asyncio.shield(in_flight[1])
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = (fingerprint, future)
+        try:
+            response = await self.run_once(key, fingerprint, write)
+        except BaseException as e:
+            future.set_exception(e)
+            #nobody may be waiting for it
+            future.exception()
+            raise
+        finally:
+            del self.in_flight[key]
+        future.set_result(response)
+        return response
+
+    async def run_once(self, key: str, fingerprint: str, write):
+        deadline = time.monotonic() + self.wait
+        while True:
+            #the store is shared with the other workers, so waiting for their locks is kept off the event loop
+            existing = await run_in_threadpool(self.begin, key, fingerprint)
+            if existing is None:
+                break
+            if existing[0] != fingerprint:
+                raise IdempotencyConflict()
+            if existing[1] is not None:
+                metrics.idempotent_writes.labels("replayed").inc()
+                return json.loads(existing[1])
+            if time.monotonic() > deadline:
+                raise IdempotencyInProgress()
+            #another worker is making the write
+            await asyncio.sleep(0.05)
+        metrics.idempotent_writes.labels("new").inc()
+        try:
+            response = await write()
+        except BaseException:
+            await run_in_threadpool(self.abandon, key)
+            raise
+        await run_in_threadpool(self.complete, key, response)
+        return response
+
+def request_key(user_id: str, endpoint: str, idempotency_key: str):
+    #keys are chosen by clients, so they are only unique per user and endpoint
+    return hashlib.sha256(f"{user_id}\n{endpoint}\n{idempotency_key}".encode('utf-8')).hexdigest()
+
+def fingerprint(body: str):
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
@@ -0,0 +1,63 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+class KnownPersons():
+    """
+    Remembers which people (per security label) have already had their person triples written, so they only need
+    sending the first time a user is seen, and again after ttl seconds or if their name changes.
+    It is backed by a SQLite file so it survives restarts and is shared by all the uvicorn workers on a host.
+        path - the SQLite file
+        ttl - how long, in seconds, before a person's triples are written again
+        max_size - the most people remembered - the least recently written are forgotten first
+    """
+    def __init__(self, path: str, ttl: float = 30 * 24 * 3600, max_size: int = 100000):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.local = threading.local()
+        self.claims = 0
+
+    def get_connection(self):
+        #sqlite connections can't be shared between threads
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS known_persons (person TEXT PRIMARY KEY, username TEXT, written_at REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS known_persons_written_at ON known_persons (written_at)")
+            self.local.conn = conn
+        return conn
+
+    def claim(self, user_id: str, username: str, security_label: str):
+        """
+        Returns True if the person's triples need to be written with this write. The person is recorded as written
+        straight away, so concurrent writes (from any worker) don't all send them - call forget if the write fails.
+        """
+        now = time.time()
+        cur = self.get_connection().execute("""
+            INSERT INTO known_persons (person, username, written_at) VALUES (?, ?, ?)
+            ON CONFLICT (person) DO UPDATE SET username = excluded.username, written_at = excluded.written_at
+            WHERE known_persons.username != excluded.username OR known_persons.written_at < ?
+        """, (person_key(user_id, security_label), username, now, now - self.ttl))
+        claimed = cur.rowcount > 0
+        if claimed:
+            self.claims += 1
+            if self.claims % 1000 == 0:
+                self.prune()
+        return claimed
+
+    def forget(self, user_id: str, security_label: str):
+        self.get_connection().execute("DELETE FROM known_persons WHERE person = ?", (person_key(user_id, security_label),))
+
+    def prune(self):
+        self.get_connection().execute("""
+            DELETE FROM known_persons WHERE person IN (
+                SELECT person FROM known_persons ORDER BY written_at DESC LIMIT -1 OFFSET ?
+            )""", (self.max_size,))
+
+def person_key(user_id: str, security_label: str):
+    #a person written under one label may not be visible to readers of another, so they are tracked per label
+    return hashlib.sha256(f"{user_id}\n{security_label}".encode('utf-8')).hexdigest()
@@ -0,0 +1,109 @@
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+import anyio.to_thread
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+
+#When PROMETHEUS_MULTIPROC_DIR is set (start.sh sets it) every uvicorn worker writes its metrics to files in that
+#directory, and whichever worker serves /metrics adds them all up. Without it (e.g. run-api.sh) they are per process.
+multiprocess_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+#finer buckets than the default for steps that take well under a millisecond per request
+fast_buckets = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+
+request_latency = Histogram("ndt_http_request_duration_seconds", "Time taken to respond to a request, by route", ["method", "route", "status"])
+requests_in_flight = Gauge("ndt_http_requests_in_flight", "Requests currently being handled", multiprocess_mode="livesum")
+
+sparql_latency = Histogram("ndt_sparql_duration_seconds", "Round trip time of calls to Jena (to the first byte, for streamed queries)", ["operation", "dataset"])
+sparql_rows = Counter("ndt_sparql_rows", "Result rows received from Jena", ["dataset"])
+sparql_bytes = Counter("ndt_sparql_bytes", "Bytes of results received from Jena", ["dataset"])
+
+fold_latency = Histogram("ndt_buildings_fold_duration_seconds", "Time taken to fold the rows of a buildings query into buildings", buckets=fast_buckets)
+
+kafka_latency = Histogram("ndt_kafka_send_duration_seconds", "Time taken to send a record to Kafka")
+kafka_bytes = Counter("ndt_kafka_sent_bytes", "Bytes of N-Triples sent to Kafka")
+kafka_writes = Counter("ndt_kafka_writes", "Writes handled by the batching producer, by what happened to them", ["result"])
+kafka_queue = Gauge("ndt_kafka_queue_depth", "Writes waiting to be sent to Kafka", multiprocess_mode="livesum")
+
+access_latency = Histogram("ndt_access_lookup_duration_seconds", "Time taken to look up a user in Access (cache misses only)")
+access_cache = Counter("ndt_access_cache", "Access user lookups, by whether they were answered from the cache", ["result"])
+
+idempotent_writes = Counter("ndt_idempotent_writes", "Writes made with an Idempotency-Key, by whether they were written, replayed or waited for a concurrent duplicate", ["result"])
+
+threadpool_busy = Gauge("ndt_threadpool_busy_threads", "Threads in use in the worker threadpool", multiprocess_mode="livesum")
+threadpool_size = Gauge("ndt_threadpool_size", "Threads available in the worker threadpool", multiprocess_mode="livesum")
+threadpool_waiting = Gauge("ndt_threadpool_waiting_tasks", "Tasks waiting for a thread in the worker threadpool", multiprocess_mode="livesum")
+
+@contextmanager
+def timed(histogram):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started)
+
+def render():
+    if multiprocess_dir:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+async def sample_periodically(get_producer, interval: float = 1):
+    """
+    Samples the gauges that can't be updated where they change - the threadpool is owned by anyio, and updating the
+    queue depth on every write would put a file write on the hot path in multiprocess mode
+    """
+    while True:
+        limiter = anyio.to_thread.current_default_thread_limiter()
+        statistics = limiter.statistics()
+        threadpool_busy.set(statistics.borrowed_tokens)
+        threadpool_size.set(statistics.total_tokens)
+        threadpool_waiting.set(statistics.tasks_waiting)
+        producer = get_producer()
+        if producer is not None and producer.queue is not None:
+            kafka_queue.set(producer.queue.qsize())
+        await asyncio.sleep(interval)
+
+def mark_process_dead():
+    #the live gauges of a worker that has exited must stop counting towards the totals
+    if multiprocess_dir:
+        multiprocess.mark_process_dead(os.getpid())
+
+class MetricsMiddleware():
+    """
+    Times every request by the route it matched (so /buildings/{uprn} is one series, not one per UPRN) and counts
+    the requests in flight. It is plain ASGI, so streamed responses are timed to their last byte.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.routes = None
+
+    def route_name(self, scope):
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if self.routes is None:
+            self.routes = {route.endpoint: route.path for route in scope["app"].routes if hasattr(route, "endpoint")}
+        return self.routes.get(endpoint, endpoint.__name__)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+        requests_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            requests_in_flight.dec()
+            request_latency.labels(scope["method"], self.route_name(scope), str(status)).observe(time.perf_counter() - started)
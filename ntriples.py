@@ -0,0 +1,48 @@
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+
+#Characters that aren't allowed in an N-Triples IRI are written as \u escapes
+iri_escapes = {c: f"\\u{c:04X}" for c in list(range(0x21)) + [ord(c) for c in '<>"{}|^`\\']}
+literal_escapes = {c: f"\\u{c:04X}" for c in range(0x20)}
+literal_escapes.update({ord("\\"): "\\\\", ord('"'): '\\"', ord("\n"): "\\n", ord("\r"): "\\r", ord("\t"): "\\t"})
+
+def format_iri(iri: str):
+    return "<" + iri.translate(iri_escapes) + ">"
+
+def format_literal(value: str, datatype: str = None, language: str = None):
+    literal = '"' + str(value).translate(literal_escapes) + '"'
+    if language:
+        return literal + "@" + language
+    if datatype:
+        return literal + "^^" + format_iri(datatype)
+    return literal
+
+class TripleBuilder():
+    """
+    Collects triples as already-escaped N-Triples lines, so writes can be sent to Kafka (or wrapped in an
+    INSERT DATA for Jena) without parsing and re-serialising SPARQL.
+    All IRIs must be full IRIs - expand any prefixed names before adding them.
+    """
+    def __init__(self):
+        self.lines = []
+
+    def add(self, subject: str, predicate: str, obj: str):
+        self.lines.append(f"{format_iri(subject)} {format_iri(predicate)} {format_iri(obj)} .\n")
+
+    def add_type(self, subject: str, typ: str):
+        self.add(subject, RDF_TYPE, typ)
+
+    def add_literal(self, subject: str, predicate: str, value: str, datatype: str = None, language: str = None):
+        self.lines.append(f"{format_iri(subject)} {format_iri(predicate)} {format_literal(value, datatype, language)} .\n")
+
+    def extend(self, other: "TripleBuilder"):
+        self.lines.extend(other.lines)
+
+    def to_ntriples(self):
+        return "".join(self.lines)
+
+    def to_sparql_insert(self):
+        #N-Triples is valid SPARQL triple syntax, so no prefixes are needed
+        return "INSERT DATA {\n" + self.to_ntriples() + "}"
+
+    def __len__(self):
+        return len(self.lines)
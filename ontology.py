@@ -0,0 +1,117 @@
+import pickle
+from datetime import datetime
+
+RDFS_SUBCLASS_OF = "http://www.w3.org/2000/01/rdf-schema#subClassOf"
+RDFS_COMMENT = "http://www.w3.org/2000/01/rdf-schema#comment"
+
+#The query used to pull the class hierarchy out of Jena - only named classes are kept, OWL restrictions (blank nodes) are ignored.
+#The ontologies may be in the default graph or (if loaded with ontology_loader.py) in a named graph per file
+hierarchy_query = """
+    SELECT ?sub ?parent ?comment WHERE {
+        { ?sub rdfs:subClassOf ?parent } UNION { GRAPH ?g { ?sub rdfs:subClassOf ?parent } }
+        FILTER(isIRI(?sub) && isIRI(?parent))
+        OPTIONAL { { ?sub rdfs:comment ?comment } UNION { GRAPH ?cg { ?sub rdfs:comment ?comment } } }
+    }"""
+
+artefact_version = 1
+
+class OntologyIndex():
+    """
+    An in-process copy of the ontology class hierarchy, with the transitive subclass closure precomputed so that
+    "is X a subclass of Y" is a set lookup rather than a rdfs:subClassOf* query against Jena.
+    The index is rebuilt as a whole and swapped in, so readers never see a half-built hierarchy.
+    """
+    def __init__(self):
+        self.parents = {}
+        self.comments = {}
+        self.ancestors = {}
+        self.descendants = {}
+        self.source = None
+        self.loaded_at = None
+
+    def is_loaded(self):
+        return self.loaded_at is not None
+
+    def load(self, parents: dict[str, list[str]], comments: dict[str, list[str]], source: str):
+        ancestors = {}
+        for cls in parents:
+            #iterative walk up the hierarchy - the ontologies are not guaranteed to be acyclic
+            seen = {cls}
+            stack = list(parents[cls])
+            while stack:
+                parent = stack.pop()
+                if parent not in seen:
+                    seen.add(parent)
+                    stack.extend(parents.get(parent, []))
+            ancestors[cls] = frozenset(seen)
+        self.parents, self.comments, self.ancestors, self.descendants = parents, comments, ancestors, {}
+        self.source = source
+        self.loaded_at = datetime.now()
+
+    def load_sparql_results(self, results, source: str):
+        parents = {}
+        comments = {}
+        if results and results['results'] and results['results']['bindings']:
+            for row in results['results']['bindings']:
+                add_hierarchy_row(parents, comments, row['sub']['value'], row['parent']['value'], row['comment']['value'] if 'comment' in row else None)
+        self.load(parents, comments, source)
+
+    def load_files(self, filenames: list[str]):
+        #rdflib is only needed when falling back to the bundled ontology files
+        from rdflib import Graph, URIRef
+        from rdflib.namespace import RDFS
+        g = Graph()
+        for filename in filenames:
+            g.parse(filename, format='turtle')
+        parents = {}
+        comments = {}
+        for sub, parent in g.subject_objects(RDFS.subClassOf):
+            if isinstance(sub, URIRef) and isinstance(parent, URIRef):
+                add_hierarchy_row(parents, comments, str(sub), str(parent), None)
+        for sub, comment in g.subject_objects(RDFS.comment):
+            if str(sub) in parents:
+                add_hierarchy_row(parents, comments, str(sub), None, str(comment))
+        self.load(parents, comments, ",".join(filenames))
+
+    def to_artefact(self):
+        """
+        The hierarchy, with its precomputed closure, in a form that load_from_artefact can take back without any parsing
+        """
+        return {"version":artefact_version, "parents":self.parents, "comments":self.comments, "ancestors":self.ancestors, "source":self.source}
+
+    def load_from_artefact(self, artefact: dict, source: str = None):
+        if artefact.get("version") != artefact_version:
+            raise ValueError(f"{source or 'The artefact'} was written by a different version of the ontology index")
+        self.parents, self.comments, self.ancestors, self.descendants = artefact["parents"], artefact["comments"], artefact["ancestors"], {}
+        self.source = source or artefact["source"]
+        self.loaded_at = datetime.now()
+
+    def save(self, filename: str):
+        with open(filename, "wb") as f:
+            pickle.dump(self.to_artefact(), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load_artefact(self, filename: str):
+        with open(filename, "rb") as f:
+            self.load_from_artefact(pickle.load(f), filename)
+
+    def is_subclass(self, sub: str, super_class: str):
+        return sub == super_class or super_class in self.ancestors.get(sub, ())
+
+    def subclasses(self, super_class: str):
+        """
+        All the classes that are (transitively) a subclass of super_class. As with rdfs:subClassOf*, this
+        includes super_class itself if it has a parent.
+        """
+        subs = self.descendants.get(super_class)
+        if subs is None:
+            subs = frozenset(cls for cls, ancestors in self.ancestors.items() if super_class in ancestors)
+            self.descendants[super_class] = subs
+        return subs
+
+def add_hierarchy_row(parents, comments, sub, parent, comment):
+    sub_parents = parents.setdefault(sub, [])
+    if parent is not None and parent not in sub_parents:
+        sub_parents.append(parent)
+    sub_comments = comments.setdefault(sub, [])
+    if comment is not None and comment not in sub_comments:
+        sub_comments.append(comment)
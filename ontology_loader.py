@@ -1,24 +1,104 @@
+#Syncs the ontology files in this repo into the Jena ontology dataset. Each file is loaded into its own named graph, and
+#the sha256 of each loaded file is recorded in Jena, so only the files that have changed since the last sync are
+#reloaded (in parallel). It also writes a precompiled copy of the class hierarchy (ontology_index.pickle) that the API
+#loads at startup instead of querying Jena.
+#
+#   python ontology_loader.py [--jena http://localhost:3030] [--dataset ontology] [--force] [--clear-default] [--artefact-only]
 
-import json
+import argparse
+import hashlib
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from urllib.parse import quote
-
-with open('ies4.ttl') as file:
-    data = file.read()
-    headers = {'Content-Type': 'text/turtle;charset=utf-8'}
-    r = requests.post('http://localhost:3030/ontology/data?default', data=data, headers=headers)
-print("IES loaded")
-
-with open('iesExtensions.ttl') as file:
-    data = file.read()
-    headers = {'Content-Type': 'text/turtle;charset=utf-8'}
-    r = requests.post('http://localhost:3030/ontology/data?default', data=data, headers=headers)
-print("IES Extensions loaded")
-
-with open('ndt_retrofit_buildings_extensions.ttl') as file:
-    data = file.read()
-    headers = {'Content-Type': 'text/turtle;charset=utf-8'}
-    r = requests.post('http://localhost:3030/ontology/data?default', data=data, headers=headers)
-print("NDT ontology Extensions loaded")
+from ontology import OntologyIndex
 
+jena_host = 'http://localhost:3030'
+dataset = "ontology"
+ontology_files = ['ies4.ttl', 'iesExtensions.ttl', 'ndt_retrofit_buildings_extensions.ttl']
+artefact = "ontology_index.pickle"
+
+graph_stub = "urn:ndt:ontology:"
+sync_graph = graph_stub + "sync"
+hash_predicate = graph_stub + "sha256"
+
+def file_hash(filename):
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def graph_name(filename):
+    return graph_stub + os.path.basename(filename)
+
+def get_loaded_hashes(session, jena):
+    query = f"SELECT ?g ?hash WHERE {{ GRAPH <{sync_graph}> {{ ?g <{hash_predicate}> ?hash }} }}"
+    r = session.get(f"{jena}/query", params={'query': query}, headers={'Accept': 'application/sparql-results+json'})
+    r.raise_for_status()
+    return {row['g']['value']: row['hash']['value'] for row in r.json()['results']['bindings']}
+
+def load_file(session, jena, filename, sha256):
+    graph = graph_name(filename)
+    with open(filename, "rb") as f:
+        #PUT replaces the whole graph, so a changed file doesn't leave old triples behind
+        r = session.put(f"{jena}/data", params={'graph': graph}, data=f.read(), headers={'Content-Type': 'text/turtle;charset=utf-8'})
+    r.raise_for_status()
+    update = f"""
+        DELETE WHERE {{ GRAPH <{sync_graph}> {{ <{graph}> <{hash_predicate}> ?hash }} }} ;
+        INSERT DATA {{ GRAPH <{sync_graph}> {{ <{graph}> <{hash_predicate}> "{sha256}" }} }}
+    """
+    r = session.post(f"{jena}/update", data=update.encode('utf-8'), headers={'Content-Type': 'application/sparql-update'})
+    r.raise_for_status()
+    return filename
+
+def write_artefact(files, filename):
+    index = OntologyIndex()
+    index.load_files(files)
+    index.save(filename)
+    print(f"Class hierarchy of {len(index.parents)} classes written to {filename}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Syncs the ontology files into Jena, reloading only the files that have changed")
+    parser.add_argument("files", nargs="*", default=ontology_files)
+    parser.add_argument("--jena", default=jena_host)
+    parser.add_argument("--dataset", default=dataset)
+    parser.add_argument("--force", action="store_true", help="reload every file, even if it hasn't changed")
+    parser.add_argument("--clear-default", action="store_true", help="clear the default graph, which older versions of this script loaded the ontologies into")
+    parser.add_argument("--artefact", default=artefact, help="where to write the precompiled class hierarchy, empty to skip it")
+    parser.add_argument("--artefact-only", action="store_true", help="only write the precompiled class hierarchy, don't talk to Jena")
+    args = parser.parse_args()
+
+    if args.artefact:
+        write_artefact(args.files, args.artefact)
+    if args.artefact_only:
+        return
+
+    jena = f"{args.jena}/{args.dataset}"
+    session = requests.Session()
+    loaded = {} if args.force else get_loaded_hashes(session, jena)
+    changed = []
+    for filename in args.files:
+        sha256 = file_hash(filename)
+        if loaded.get(graph_name(filename)) == sha256:
+            print(f"{filename} is unchanged")
+        else:
+            changed.append((filename, sha256))
+
+    if args.clear_default:
+        r = session.post(f"{jena}/update", data=b"CLEAR DEFAULT", headers={'Content-Type': 'application/sparql-update'})
+        r.raise_for_status()
+        print("Default graph cleared")
+
+    failed = False
+    with ThreadPoolExecutor(max(len(changed), 1)) as pool:
+        futures = [(filename, pool.submit(load_file, session, jena, filename, sha256)) for filename, sha256 in changed]
+        for filename, future in futures:
+            try:
+                future.result()
+                print(f"{filename} loaded into <{graph_name(filename)}>")
+            except requests.RequestException as e:
+                failed = True
+                print(f"{filename} failed to load: {e}")
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+from functools import lru_cache
+
+class PrefixCodec():
+    """
+    Converts full URIs to compact (prefixed) URIs and back in a single pass.
+    Shortening finds the longest namespace that starts the URI by probing a dict with the URI cut at each of the
+    (few) distinct namespace lengths, longest first - so one namespace being a stub of another can't mangle a URI.
+    Where two prefixes share a namespace, the first one registered is used. Hot URIs are kept in an LRU cache.
+        prefix_dict - the prefix to namespace mapping
+        cache_size - the number of URIs kept in each LRU cache
+    """
+    def __init__(self, prefix_dict: dict[str, str], cache_size: int = 65536):
+        self.namespaces = {}
+        for prefix, namespace in prefix_dict.items():
+            self.namespaces.setdefault(namespace, prefix)
+        self.stubs = dict(prefix_dict)
+        self.lengths = sorted({len(namespace) for namespace in self.namespaces}, reverse=True)
+        self.shorten = lru_cache(maxsize=cache_size)(self._shorten)
+        self.lengthen = lru_cache(maxsize=cache_size)(self._lengthen)
+
+    def _shorten(self, uri: str):
+        namespaces = self.namespaces
+        for length in self.lengths:
+            prefix = namespaces.get(uri[:length])
+            if prefix is not None:
+                return prefix + ":" + uri[length:]
+        return uri
+
+    def _lengthen(self, uri: str):
+        prefix, sep, local_name = uri.partition(":")
+        if sep:
+            namespace = self.stubs.get(prefix)
+            if namespace is not None:
+                return namespace + local_name
+        return uri
+
+    def shorten_many(self, uris):
+        shorten = self.shorten
+        return [shorten(uri) for uri in uris]
+
+    def lengthen_many(self, uris):
+        lengthen = self.lengthen
+        return [lengthen(uri) for uri in uris]
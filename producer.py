@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import time
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class ProducerFull(Exception):
+    pass
+
+class BatchingProducer():
+    """
+    Groups writes that share a security label into batches and sends them from a background task, so requests only
+    wait to be queued, not for the broker. A batch is sent when it reaches max_batch_bytes or when linger_ms has passed
+    since the first write in it. When the queue is full, submit waits up to enqueue_timeout seconds for space and then
+    raises ProducerFull. A batch that fails to send is retried, and if it still can't be sent the on_dropped callbacks
+    of its writes are called, so whatever was recorded about them when their requests returned can be undone.
+        send - a blocking function taking a security label and an N-Triples payload, called in a worker thread
+        linger_ms - how long to wait for more writes before sending a batch
+        max_batch_bytes - the largest payload sent in one record
+        max_queue - the number of writes that can be waiting to be sent
+        enqueue_timeout - how long submit waits for space in a full queue
+        retries - how many times a batch that fails to send is retried before it is dropped
+        retry_backoff - how long, in seconds, before the first retry - it doubles with each retry
+    """
+    def __init__(self, send, linger_ms: int = 20, max_batch_bytes: int = 900000, max_queue: int = 10000, enqueue_timeout: float = 1.0,
+                 retries: int = 3, retry_backoff: float = 0.5):
+        self.send = send
+        self.linger = linger_ms / 1000
+        self.max_batch_bytes = max_batch_bytes
+        self.max_queue = max_queue
+        self.enqueue_timeout = enqueue_timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.queue = None
+        self.task = None
+        self.stats = {"submitted": 0, "batches": 0, "sent": 0, "retried": 0, "failed": 0, "rejected": 0}
+
+    def start(self):
+        self.queue = asyncio.Queue(self.max_queue)
+        self.task = asyncio.create_task(self.run())
+
+    async def submit(self, security_label: str, payload: str, on_dropped: list = ()):
+        """
+        Queues the write. on_dropped are blocking functions (called in a worker thread) to undo what was recorded
+        about the write if it is never sent
+        """
+        if self.task is None or self.task.done():
+            raise ProducerFull("producer is not running")
+        item = (security_label, payload, list(on_dropped))
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self.queue.put(item), self.enqueue_timeout)
+            except asyncio.TimeoutError:
+                self.stats["rejected"] += 1
+                metrics.kafka_writes.labels("rejected").inc()
+                raise ProducerFull("write queue is full")
+        self.stats["submitted"] += 1
+        metrics.kafka_writes.labels("submitted").inc()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batches = {}
+            deadline = loop.time() + self.linger
+            while item is not None:
+                label, payload, on_dropped = item
+                batch = batches.get(label)
+                if batch is not None and batch[1] + len(payload) > self.max_batch_bytes:
+                    await self.send_batch(label, *batches.pop(label))
+                    batch = None
+                if batch is None:
+                    batch = batches[label] = [[], 0, []]
+                batch[0].append(payload)
+                batch[1] += len(payload)
+                batch[2].extend(on_dropped)
+                item = self.next_item_nowait()
+                if item is None:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                    if item is None:
+                        stopping = True
+            for label, batch in batches.items():
+                await self.send_batch(label, *batch)
+
+    def next_item_nowait(self):
+        try:
+            item = self.queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return None
+        if item is None:
+            #put the stop marker back so the outer loop sees it once this batch is sent
+            self.queue.put_nowait(None)
+        return item
+
+    async def send_batch(self, label: str, payloads: list[str], size: int, on_dropped: list):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            try:
+                await loop.run_in_executor(None, self.send, label, "".join(payloads))
+                self.stats["batches"] += 1
+                self.stats["sent"] += len(payloads)
+                metrics.kafka_writes.labels("sent").inc(len(payloads))
+                return
+            except Exception as e:
+                error = e
+            if attempt < self.retries:
+                self.stats["retried"] += len(payloads)
+                metrics.kafka_writes.labels("retried").inc(len(payloads))
+                logger.warning("Failed to send %d writes to Kafka, retrying: %s", len(payloads), error)
+                await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+        self.stats["failed"] += len(payloads)
+        metrics.kafka_writes.labels("failed").inc(len(payloads))
+        logger.error("Dropped %d writes after failing to send them to Kafka %d times: %s", len(payloads), self.retries + 1, error)
+        for undo in on_dropped:
+            try:
+                await loop.run_in_executor(None, undo)
+            except Exception:
+                logger.exception("Could not undo a dropped write")
+
+    async def stop(self):
+        """
+        Sends everything that is still queued, then stops the background task
+        """
+        if self.task is None:
+            return
+        if not self.task.done():
+            await self.queue.put(None)
+            await self.task
+        self.task = None
+
+class MemorySink():
+    """
+    An in-memory stand-in for the Kafka sink, for tests and benchmarks - keeps every record it is sent
+    """
+    def __init__(self, delay: float = 0):
+        self.records = []
+        self.delay = delay
+
+    def send(self, security_label: str, payload: str):
+        if self.delay:
+            time.sleep(self.delay)
+        self.records.append((security_label, payload))
@@ -0,0 +1,322 @@
+import fcntl
+import json
+import os
+import pickle
+import re
+from bisect import bisect_left
+from datetime import datetime
+
+snapshot_version = 1
+
+ies = "http://ies.data.gov.uk/ontology/ies4#"
+rdf_type = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+
+#only the triples with an IRI object are needed to pick flags and invalidations out of a write
+triple_pattern = re.compile(r'<([^>]*)>\s+<([^>]*)>\s+<([^>]*)>\s*\.')
+iri_escape_pattern = re.compile(r'\\u([0-9A-Fa-f]{4})|\\U([0-9A-Fa-f]{8})')
+
+def unescape_iri(iri: str):
+    if "\\" not in iri:
+        return iri
+    return iri_escape_pattern.sub(lambda m: chr(int(m.group(1) or m.group(2), 16)), iri)
+
+def parse_writes(payload: str):
+    """
+    The subjects of the IRI triples in an N-Triples payload, with their objects by predicate
+    """
+    subjects = {}
+    for s, p, o in triple_pattern.findall(payload):
+        subjects.setdefault(unescape_iri(s), {}).setdefault(p, []).append(unescape_iri(o))
+    return subjects
+
+class ReadModel():
+    """
+    An in-process, column-oriented copy of the buildings /buildings and /buildings/{uprn} return, indexed by geohash
+    and UPRN, so they can be answered without Jena. It is loaded (in one go) from the rows of the split buildings
+    queries, and then kept current by applying writes - the API's own, and those read from the knowledge topic - so
+    flags show up as soon as they are written, rather than once Jena has ingested them. Only flags and their
+    invalidations are picked out of writes; anything else only appears when the model is next loaded.
+    Every column is a list indexed by building, in order of building URI. A new copy is built (with build_columns and
+    index_columns, or read_snapshot) off the event loop and swapped in; the methods are meant to be called from the
+    event loop thread.
+        shorten - the function the API uses to turn full URIs into prefixed names
+        lengthen - the function the API uses to turn prefixed names back into full URIs
+    """
+    def __init__(self, shorten, lengthen):
+        self.shorten = shorten
+        self.lengthen = lengthen
+        self.loaded_at = None
+        self.offset = None
+        self.changes = 0
+        self.loading = False
+        self.replay = []
+        self.set_columns(index_columns(empty_columns()))
+
+    def is_loaded(self):
+        return self.loaded_at is not None
+
+    def set_columns(self, columns: dict):
+        self.uris = columns["uris"]
+        self.short_uris = columns["short_uris"]
+        self.uprns = columns["uprns"]
+        self.ratings = columns["ratings"]
+        self.types = columns["types"]
+        self.toids = columns["toids"]
+        self.parent_toids = columns["parent_toids"]
+        self.states = columns["states"]
+        self.flags = columns["flags"]
+        self.pending_invalidations = columns["pending_invalidations"]
+        self.geohashes = columns["geohashes"]
+        self.located = columns["located"]
+        self.by_uri = columns["by_uri"]
+        self.by_uprn = columns["by_uprn"]
+        self.flag_index = columns["flag_index"]
+
+    def start_loading(self):
+        #writes applied while a new copy is being built are applied again once it is swapped in
+        self.loading = True
+        self.replay = []
+
+    def swap(self, columns: dict, offset=None):
+        """
+        Swaps in a new copy of the buildings, and applies any writes made while it was being built
+            columns - the new copy, from index_columns or read_snapshot
+            offset - how far through the knowledge topic the copy is up to
+        """
+        self.set_columns(columns)
+        self.offset = offset
+        self.loaded_at = datetime.now()
+        self.changes = 0
+        replay, self.replay, self.loading = self.replay, [], False
+        for payload in replay:
+            self.apply_ntriples(payload)
+
+    def snapshot(self):
+        """
+        A copy of the model that write_snapshot can save in another thread while writes carry on being applied -
+        only the flags change after loading, so only they are copied
+        """
+        columns = {"uris":self.uris, "short_uris":self.short_uris, "uprns":self.uprns, "ratings":self.ratings, "types":self.types,
+                   "toids":self.toids, "parent_toids":self.parent_toids, "states":self.states, "geohashes":self.geohashes, "located":self.located,
+                   "flags":{i: {flag: dict(flag_obj) for flag, flag_obj in flags.items()} for i, flags in self.flags.items()},
+                   "pending_invalidations":dict(self.pending_invalidations)}
+        self.changes = 0
+        return {"version":snapshot_version, "columns":columns, "offset":self.offset}
+
+    def ids_in(self, geohash: str):
+        start = bisect_left(self.geohashes, geohash)
+        end = bisect_left(self.geohashes, geohash + "\U0010ffff", lo=start)
+        #the ids are in order of building URI
+        return sorted(set(self.located[start:end]))
+
+    def building(self, i: int):
+        building_obj = {"uri":self.short_uris[i], "uprn":self.uprns[i], "currentEnergyRating":self.ratings[i], "types":list(self.types[i]),
+                        "flags":dict(self.flags.get(i, {})), "invalidatedFlags":[]}
+        if self.toids[i] is not None:
+            building_obj["buildingTOID"] = self.toids[i]
+        elif self.parent_toids[i] is not None:
+            building_obj["parentBuildingTOID"] = self.parent_toids[i]
+        return building_obj
+
+    def buildings_in(self, geohash: str):
+        return [self.building(i) for i in self.ids_in(geohash)]
+
+    def building_uris(self, geohash: str):
+        return [self.uris[i] for i in self.ids_in(geohash)]
+
+    def buildings(self, uris: list[str]):
+        return [self.building(self.by_uri[uri]) for uri in uris if uri in self.by_uri]
+
+    def building_by_uprn(self, uprn: str):
+        """
+        The building with the UPRN and its states, as /buildings/{uprn} returns them, or None if it isn't in the model
+        """
+        i = self.by_uprn.get(uprn)
+        if i is None:
+            return None
+        uri = self.uris[i]
+        return {
+            "entity":{"uri":uri, "types":[self.lengthen(typ) for typ in self.types[i]]},
+            "states":[{"uri":state, "types":list(types), "stateOf":uri} for state, types in self.states[i]],
+        }
+
+    def add_flag(self, building: str, flag: str, flag_type: str, flagged_by: str, date: str):
+        i = self.by_uri.get(building)
+        if i is None:
+            return False
+        flag = self.shorten(flag)
+        flags = self.flags.setdefault(i, {})
+        if flag not in flags:
+            flags[flag] = {"flagType":self.shorten(flag_type), "flaggedBy":flagged_by, "date":date}
+            self.flag_index[flag] = i
+            invalidation = self.pending_invalidations.pop(flag, None)
+            if invalidation is not None:
+                flags[flag]["invalidated"], flags[flag]["invalidatedBy"] = invalidation
+            self.changes += 1
+            return True
+        return False
+
+    def invalidate_flag(self, flag: str, date: str, assessor: str):
+        flag = self.shorten(flag)
+        i = self.flag_index.get(flag)
+        if i is None:
+            #the invalidation was read before the flag
+            self.pending_invalidations[flag] = (date, assessor)
+            return False
+        flag_obj = self.flags[i][flag]
+        if flag_obj.get("invalidated") == date and flag_obj.get("invalidatedBy") == assessor:
+            return False
+        flag_obj["invalidated"] = date
+        flag_obj["invalidatedBy"] = assessor
+        self.changes += 1
+        return True
+
+    def apply_ntriples(self, payload: str):
+        """
+        Applies the flags and invalidations in a write, and returns the URIs (of buildings and flags) that changed.
+        Applying the same write twice changes nothing, so the API's own writes can be applied straight away and
+        again when they are read back from the topic
+        """
+        if self.loading:
+            self.replay.append(payload)
+        changed = set()
+        for subject, objects in parse_writes(payload).items():
+            if ies+"interestedIn" in objects and ies+"isStateOf" in objects and ies+"inPeriod" in objects and rdf_type in objects:
+                for building in objects[ies+"interestedIn"]:
+                    if self.add_flag(building, subject, objects[rdf_type][0], objects[ies+"isStateOf"][0], objects[ies+"inPeriod"][0]):
+                        changed.add(building)
+            elif ies+"assessed" in objects and ies+"inPeriod" in objects and ies+"assessor" in objects:
+                for flag in objects[ies+"assessed"]:
+                    if self.invalidate_flag(flag, objects[ies+"inPeriod"][0], objects[ies+"assessor"][0]):
+                        changed.add(flag)
+        return changed
+
+    def __len__(self):
+        return len(self.uris)
+
+def empty_columns():
+    return {"uris":[], "short_uris":[], "uprns":[], "ratings":[], "types":[], "toids":[], "parent_toids":[], "states":[],
+            "flags":{}, "pending_invalidations":{}, "geohashes":[], "located":[]}
+
+def build_columns(buildings: list[dict], locations: list[tuple[str, str]], states: dict, lengthen):
+    columns = empty_columns()
+    #the same few combinations of types are shared by nearly every building, so they are only held once
+    interned = {}
+    for building_obj in sorted(buildings, key=lambda building_obj: lengthen(building_obj["uri"])):
+        uri = lengthen(building_obj["uri"])
+        types = tuple(building_obj["types"])
+        i = len(columns["uris"])
+        columns["uris"].append(uri)
+        columns["short_uris"].append(building_obj["uri"])
+        columns["uprns"].append(building_obj["uprn"])
+        columns["ratings"].append(building_obj["currentEnergyRating"])
+        columns["types"].append(interned.setdefault(types, types))
+        columns["toids"].append(building_obj.get("buildingTOID"))
+        columns["parent_toids"].append(building_obj.get("parentBuildingTOID"))
+        columns["states"].append(tuple((state, tuple(state_types)) for state, state_types in states.get(uri, ())))
+        if building_obj["flags"]:
+            columns["flags"][i] = building_obj["flags"]
+    ids = {uri: i for i, uri in enumerate(columns["uris"])}
+    for geohash, building in sorted((geohash, ids[building]) for geohash, building in locations if building in ids):
+        columns["geohashes"].append(geohash)
+        columns["located"].append(building)
+    return columns
+
+def index_columns(columns: dict):
+    columns["by_uri"] = {uri: i for i, uri in enumerate(columns["uris"])}
+    columns["by_uprn"] = {uprn: i for i, uprn in enumerate(columns["uprns"])}
+    columns["flag_index"] = {flag: i for i, flags in columns["flags"].items() for flag in flags}
+    return columns
+
+def read_snapshot(filename: str):
+    with open(filename, "rb") as f:
+        snapshot = pickle.load(f)
+    if snapshot.get("version") != snapshot_version:
+        raise ValueError(f"{filename} was written by a different version of the read model")
+    index_columns(snapshot["columns"])
+    return snapshot
+
+def write_snapshot(snapshot: dict, filename: str):
+    #written to one side and moved into place, so a worker loading it never sees half a file
+    temp = f"{filename}.{os.getpid()}.tmp"
+    with open(temp, "wb") as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp, filename)
+
+class FileTopic():
+    """
+    A stand-in for the knowledge topic in a file of JSON lines, for running the read model without a broker. It can
+    be written to in place of the Kafka sink, and read from in place of the topic. The offset is a byte offset.
+        path - the file
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def send(self, security_label: str, payload: str):
+        record = (json.dumps({"headers":{"Security-Label":security_label}, "value":payload}) + "\n").encode("utf-8")
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            #several workers can append to the same file
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, record)
+        finally:
+            os.close(fd)
+
+    def end_offset(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def poll(self, offset, timeout: float = 1, max_records: int = 500):
+        """
+        The payloads of up to max_records records after offset, and the offset after them
+        """
+        offset = offset or 0
+        if not os.path.exists(self.path):
+            return [], offset
+        if offset > os.path.getsize(self.path):
+            #the file has been replaced, so start it again
+            offset = 0
+        payloads = []
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while len(payloads) < max_records:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    #not all written yet
+                    break
+                offset += len(line)
+                payloads.append(json.loads(line)["value"])
+        return payloads, offset
+
+class KafkaTopic():
+    """
+    Reads the knowledge topic from Kafka, from an offset (per partition) kept by the read model rather than by a
+    consumer group, so every worker reads every record. It needs confluent-kafka.
+        topic - the topic
+        broker - the bootstrap servers
+    """
+    def __init__(self, topic: str, broker: str):
+        from confluent_kafka import Consumer
+        self.topic = topic
+        self.consumer = Consumer({"bootstrap.servers":broker, "group.id":"ndt-write-api-read-model", "enable.auto.commit":False})
+        metadata = self.consumer.list_topics(topic, timeout=10)
+        self.partitions = sorted(metadata.topics[topic].partitions)
+        self.assigned = None
+
+    def end_offset(self):
+        from confluent_kafka import TopicPartition
+        return {p: self.consumer.get_watermark_offsets(TopicPartition(self.topic, p), timeout=10)[1] for p in self.partitions}
+
+    def poll(self, offset, timeout: float = 1, max_records: int = 500):
+        from confluent_kafka import TopicPartition, OFFSET_BEGINNING
+        offset = dict(offset or {})
+        if self.assigned != offset:
+            self.consumer.assign([TopicPartition(self.topic, p, offset.get(p, OFFSET_BEGINNING)) for p in self.partitions])
+        payloads = []
+        for message in self.consumer.consume(max_records, timeout):
+            if message.error():
+                continue
+            offset[message.partition()] = message.offset() + 1
+            value = message.value()
+            payloads.append(value.decode("utf-8") if isinstance(value, bytes) else value)
+        self.assigned = dict(offset)
+        return payloads, offset
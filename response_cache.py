@@ -0,0 +1,202 @@
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from starlette.concurrency import run_in_threadpool
+
+class ResponseCache():
+    """
+    An LRU cache of rendered responses, bounded by their total size and by age. Each entry records the URIs that appear
+    in it, so a write can evict every entry that shows the thing it wrote to. Evictions are also logged to a SQLite file
+    shared by the workers on a host, and each worker replays the others' evictions before it serves from its cache.
+    Writes reach Jena some time after they are accepted (e.g. through Kafka), so a read racing a write could cache the
+    old data. A write can say what a response will show once it has reached Jena (e.g. the URI of a new flag), and
+    responses containing what it wrote to aren't cached until they show it, or for write_timeout seconds if they never
+    do. Responses containing anything else written to aren't cached for write_grace seconds.
+    The methods are meant to be called from the event loop thread - sync and evict, which use the SQLite file, are
+    coroutines that do so in the threadpool.
+        path - the SQLite file evictions are shared through, or None to only evict within this process
+        max_bytes - the most bytes of responses held
+        ttl - how long, in seconds, a response is cached for
+        write_grace - how long, in seconds, responses containing a URI aren't cached after it is written to
+        write_timeout - the longest, in seconds, responses containing a URI aren't cached while waiting for a write to it to show
+    """
+    def __init__(self, path: str = None, max_bytes: int = 64 * 1024 * 1024, ttl: float = 60, write_grace: float = 5, write_timeout: float = 300):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.write_grace = write_grace
+        self.write_timeout = write_timeout
+        self.entries = OrderedDict()
+        self.uri_index = {}
+        self.recent_writes = {}
+        #what responses containing each URI must show before they are cached, and until when
+        self.awaited_writes = {}
+        self.size = 0
+        self.generation = 0
+        self.origin = uuid.uuid4().hex
+        self.local = threading.local()
+        #the last eviction read from the file, and the lock that keeps threads from reading the same ones
+        self.last_seq = None
+        self.log_lock = threading.Lock()
+        self.logged = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_connection(self):
+        #sqlite connections can't be shared between threads
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS evictions (seq INTEGER PRIMARY KEY AUTOINCREMENT, uri TEXT, origin TEXT, evicted_at REAL, shown TEXT)")
+            if "shown" not in [column[1] for column in conn.execute("PRAGMA table_info(evictions)")]:
+                #a file written before writes could be awaited
+                try:
+                    conn.execute("ALTER TABLE evictions ADD COLUMN shown TEXT")
+                except sqlite3.OperationalError:
+                    #another worker has just added it
+                    pass
+            self.local.conn = conn
+            #data_version is per connection, so what it was last seen as is kept per connection too
+            self.local.data_version = None
+        return conn
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.remove(key)
+        self.misses += 1
+        return None
+
+    def put(self, key, body: bytes, uris, generation: int, shown=frozenset()):
+        """
+        Caches body, unless something was evicted since generation (from get_generation) was read before the
+        response was fetched, a write to one of its uris is still within write_grace, or it doesn't show (in shown)
+        a write to one of its uris that is still awaited. Call sync first, to see the other workers' evictions
+        """
+        if generation != self.generation or len(body) > self.max_bytes:
+            return
+        now = time.monotonic()
+        if self.recent_writes:
+            for uri, written_at in list(self.recent_writes.items()):
+                if written_at + self.write_grace < now:
+                    del self.recent_writes[uri]
+            if any(uri in self.recent_writes for uri in uris):
+                return
+        if self.awaited_writes:
+            awaiting = False
+            for uri in uris:
+                awaited = self.awaited_writes.get(uri)
+                if awaited is None:
+                    continue
+                for write, expires_at in list(awaited.items()):
+                    #once a response shows the write, it has reached Jena
+                    if write in shown or expires_at < now:
+                        del awaited[write]
+                    else:
+                        awaiting = True
+                if not awaited:
+                    del self.awaited_writes[uri]
+            if awaiting:
+                return
+        if key in self.entries:
+            self.remove(key)
+        uris = frozenset(uris)
+        self.entries[key] = (time.monotonic() + self.ttl, body, uris)
+        self.size += len(body)
+        for uri in uris:
+            self.uri_index.setdefault(uri, set()).add(key)
+        while self.size > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+
+    def get_generation(self):
+        return self.generation
+
+    def remove(self, key):
+        expires, body, uris = self.entries.pop(key)
+        self.size -= len(body)
+        for uri in uris:
+            keys = self.uri_index.get(uri)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.uri_index[uri]
+
+    def evict_local(self, uris, awaited=()):
+        now = time.monotonic()
+        for uri in uris:
+            self.recent_writes[uri] = now
+            for key in list(self.uri_index.get(uri, ())):
+                self.remove(key)
+        for uri, write in awaited:
+            self.awaited_writes.setdefault(uri, {})[write] = now + self.write_timeout
+        if len(self.awaited_writes) > 10000:
+            #writes to URIs that are never read again would otherwise be kept for ever
+            for uri, writes in list(self.awaited_writes.items()):
+                if max(writes.values()) < now:
+                    del self.awaited_writes[uri]
+        self.generation += 1
+
+    async def evict(self, uris, awaited=()):
+        """
+        Evicts every cached response containing any of the uris, in this worker and (through the SQLite file) the others.
+        awaited are pairs of a URI and what a response containing it will show once the write has reached Jena
+        """
+        uris = list(uris)
+        awaited = list(awaited)
+        self.evict_local(uris, awaited)
+        if self.path is None:
+            return
+        now = time.time()
+        rows = [(uri, self.origin, now, None) for uri in uris] + [(uri, self.origin, now, write) for uri, write in awaited]
+        await run_in_threadpool(self.write_log, rows)
+
+    def write_log(self, rows):
+        conn = self.get_connection()
+        now = time.time()
+        conn.execute("BEGIN")
+        conn.executemany("INSERT INTO evictions (uri, origin, evicted_at, shown) VALUES (?, ?, ?, ?)", rows)
+        conn.execute("COMMIT")
+        self.logged += len(rows)
+        if self.logged >= 1000:
+            #once every cached response from before an eviction has expired, and its write is no longer awaited, it can't matter any more
+            conn.execute("DELETE FROM evictions WHERE evicted_at < ?", (now - self.ttl - max(self.write_grace, self.write_timeout),))
+            self.logged = 0
+
+    async def sync(self):
+        """
+        Evicts what the other workers have evicted since the last sync
+        """
+        if self.path is None:
+            return
+        uris, awaited = await run_in_threadpool(self.read_log)
+        if uris or awaited:
+            self.evict_local(uris, awaited)
+
+    def read_log(self):
+        conn = self.get_connection()
+        with self.log_lock:
+            if self.last_seq is None:
+                #evictions from before this worker started can't be in its cache
+                self.last_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM evictions").fetchone()[0]
+            #data_version only changes when another connection has written to the file, so this is cheap when nothing has
+            version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == self.local.data_version:
+                return [], []
+            self.local.data_version = version
+            rows = conn.execute("SELECT seq, uri, origin, shown FROM evictions WHERE seq > ? ORDER BY seq", (self.last_seq,)).fetchall()
+            if rows:
+                self.last_seq = rows[-1][0]
+        uris = [uri for seq, uri, origin, shown in rows if origin != self.origin and shown is None]
+        awaited = [(uri, shown) for seq, uri, origin, shown in rows if origin != self.origin and shown is not None]
+        return uris, awaited
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.size}
@@ -0,0 +1,120 @@
+import pickle
+import sqlite3
+import threading
+import time
+from starlette.concurrency import run_in_threadpool
+
+class SharedState():
+    """
+    Settings and warm caches shared by all the uvicorn workers on a host, in a SQLite file. Values are pickled.
+    Settings changed by one worker reach the others through watch - each worker calls sync at the start of a request,
+    which checks PRAGMA data_version (which only changes when another connection has written to the file, so this is
+    one cheap query when nothing has) and calls the watchers of any settings that changed. Cached values expire.
+    Every method blocks on SQLite, so call them from a worker thread rather than the event loop.
+        path - the SQLite file
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self.watchers = {}
+        self.seen = {}
+        self.puts = 0
+        #so a request doesn't go ahead while another thread is still applying the settings it found changed
+        self.sync_lock = threading.Lock()
+
+    def get_connection(self):
+        #sqlite connections can't be shared between threads
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value BLOB, seq INTEGER, updated_at REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, value BLOB, expires_at REAL, PRIMARY KEY (namespace, key))")
+            self.local.conn = conn
+            #data_version is per connection, so what it was last seen as is kept per connection too
+            self.local.data_version = None
+        return conn
+
+    def set(self, key: str, value):
+        """
+        Sets a setting for every worker - the watchers of the other workers are called when they next sync, but
+        not this worker's, so apply the value here as well
+        """
+        conn = self.get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            seq = conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM settings").fetchone()[0]
+            conn.execute("INSERT OR REPLACE INTO settings (key, value, seq, updated_at) VALUES (?, ?, ?, ?)",
+                         (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), seq, time.time()))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self.seen[key] = seq
+
+    def get(self, key: str, default=None):
+        row = self.get_connection().execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return pickle.loads(row[0]) if row is not None else default
+
+    def updated_at(self, key: str):
+        row = self.get_connection().execute("SELECT updated_at FROM settings WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def watch(self, key: str, callback):
+        """
+        Calls callback with the new value whenever another worker sets key, and on the next sync if it is already set
+        """
+        self.watchers[key] = callback
+
+    def sync(self):
+        conn = self.get_connection()
+        with self.sync_lock:
+            version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == self.local.data_version:
+                return
+            self.local.data_version = version
+            for key, callback in self.watchers.items():
+                row = conn.execute("SELECT seq, value FROM settings WHERE key = ? AND seq > ?", (key, self.seen.get(key, 0))).fetchone()
+                if row is not None:
+                    self.seen[key] = row[0]
+                    callback(pickle.loads(row[1]))
+
+    def cache_get(self, namespace: str, key: str):
+        row = self.get_connection().execute("SELECT value FROM cache WHERE namespace = ? AND key = ? AND expires_at > ?", (namespace, key, time.time())).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def cache_put(self, namespace: str, key: str, value, ttl: float):
+        conn = self.get_connection()
+        now = time.time()
+        conn.execute("INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                     (namespace, key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), now + ttl))
+        self.puts += 1
+        if self.puts % 1000 == 0:
+            conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+
+    def claim(self, name: str, ttl: float):
+        """
+        Returns True to only one of the workers calling it within ttl seconds of each other - for work (like
+        refreshing from Jena) that only needs doing once per host
+        """
+        now = time.time()
+        cur = self.get_connection().execute("""
+            INSERT INTO cache (namespace, key, value, expires_at) VALUES ('claims', ?, NULL, ?)
+            ON CONFLICT (namespace, key) DO UPDATE SET expires_at = excluded.expires_at
+            WHERE cache.expires_at <= ?
+        """, (name, now + ttl, now))
+        return cur.rowcount > 0
+
+class SharedStateMiddleware():
+    """
+    Picks up the settings other workers have changed before each request is handled
+    """
+    def __init__(self, app, state: SharedState):
+        self.app = app
+        self.state = state
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            await run_in_threadpool(self.state.sync)
+        await self.app(scope, receive, send)
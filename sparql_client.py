@@ -0,0 +1,129 @@
+import httpx
+import json
+import metrics
+
+try:
+    import h2
+    http2_available = True
+except ImportError:
+    http2_available = False
+
+max_get_query_length = 2048
+
+class SparqlClient():
+    """
+    A shared, connection-pooled async client for talking to Jena. One of these is created per worker and reused
+    for every query and update, so connections (and TLS sessions) are kept alive between requests.
+        jena_url - the protocol, host and port of the Jena instance
+        pool_size - the maximum number of connections open to Jena at once
+        keepalive - the number of idle connections kept open for reuse
+        timeout - the read/write/pool timeout in seconds
+        connect_timeout - the connection timeout in seconds
+        http2 - use HTTP/2 where the server supports it (requires the h2 package)
+    """
+    def __init__(self, jena_url: str, pool_size: int = 100, keepalive: int = 20, timeout: float = 30.0, connect_timeout: float = 5.0, http2: bool = True):
+        self.jena_url = jena_url
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=keepalive)
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.http2 = http2 and http2_available
+        self.client = None
+
+    def get_client(self):
+        #The client is created lazily so that it is bound to the event loop of the worker that uses it
+        if self.client is None:
+            self.client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout, http2=self.http2)
+        return self.client
+
+    async def query(self, query: str, headers: dict[str, str], dataset: str):
+        with metrics.timed(metrics.sparql_latency.labels("query", dataset)):
+            #long queries (e.g. with big VALUES blocks) are posted as a form, as they won't fit in a URL
+            if len(query) > max_get_query_length:
+                response = await self.get_client().post(f"{self.jena_url}/{dataset}/query", data={'query': query}, headers=headers)
+            else:
+                response = await self.get_client().get(f"{self.jena_url}/{dataset}/query", params={'query': query}, headers=headers)
+        response.raise_for_status()
+        results = response.json()
+        metrics.sparql_bytes.labels(dataset).inc(len(response.content))
+        if 'results' in results:
+            metrics.sparql_rows.labels(dataset).inc(len(results['results']['bindings']))
+        return results
+
+    async def query_stream(self, query: str, headers: dict[str, str], dataset: str):
+        """
+        Sends a query and returns the response as soon as the status is known, without reading the body -
+        use iter_bindings to read the results from it
+        """
+        request = self.get_client().build_request("POST", f"{self.jena_url}/{dataset}/query", data={'query': query}, headers={'Accept': 'application/sparql-results+json', **headers})
+        with metrics.timed(metrics.sparql_latency.labels("stream", dataset)):
+            response = await self.get_client().send(request, stream=True)
+        if response.is_error:
+            await response.aclose()
+            response.raise_for_status()
+        return response
+
+    async def iter_bindings(self, response: httpx.Response):
+        parser = BindingsParser()
+        rows = 0
+        try:
+            async for text in response.aiter_text():
+                for row in parser.feed(text):
+                    rows += 1
+                    yield row
+        finally:
+            await response.aclose()
+            #the dataset is the path segment before /query
+            dataset = response.request.url.path.split("/")[-2]
+            metrics.sparql_rows.labels(dataset).inc(rows)
+            metrics.sparql_bytes.labels(dataset).inc(response.num_bytes_downloaded)
+
+    async def update(self, query: str, headers: dict[str, str], dataset: str):
+        with metrics.timed(metrics.sparql_latency.labels("update", dataset)):
+            response = await self.get_client().post(f"{self.jena_url}/{dataset}/update", content=query.encode('utf-8'), headers=headers)
+        response.raise_for_status()
+        return response
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+class BindingsParser():
+    """
+    Incrementally parses the bindings array of a SPARQL JSON result as it arrives, returning each row as soon as
+    it is complete, so the whole result never has to be held in memory.
+    """
+    def __init__(self):
+        self.buffer = ""
+        self.in_bindings = False
+        self.done = False
+        self.decoder = json.JSONDecoder()
+
+    def feed(self, text: str):
+        rows = []
+        if self.done:
+            return rows
+        buffer = self.buffer + text
+        pos = 0
+        if not self.in_bindings:
+            start = buffer.find('"bindings"')
+            if start < 0 or buffer.find("[", start) < 0:
+                self.buffer = buffer
+                return rows
+            pos = buffer.find("[", start) + 1
+            self.in_bindings = True
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == "]":
+                self.done = True
+                break
+            try:
+                row, pos = self.decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                #the row is incomplete - wait for the rest of it
+                break
+            rows.append(row)
+        self.buffer = "" if self.done else buffer[pos:]
+        return rows
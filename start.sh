@@ -1,2 +1,8 @@
 #!/bin/bash
-uvicorn api:app --host 0.0.0.0 --port $PORT --workers 4
\ No newline at end of file
+#the workers share their metrics through files in this directory, which has to be emptied before they start
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/ndt-write-api-metrics}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+#settings changed through the API last as long as the server, so the shared state starts empty like the workers do
+rm -f "${SHARED_STATE_DB:-shared_state.db}" "${SHARED_STATE_DB:-shared_state.db}-wal" "${SHARED_STATE_DB:-shared_state.db}-shm"
+uvicorn api:app --host 0.0.0.0 --port $PORT --workers 4
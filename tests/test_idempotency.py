@@ -0,0 +1,133 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from idempotency import IdempotencyStore, IdempotencyConflict, IdempotencyInProgress
+from producer import BatchingProducer
+
+class CountingWrite():
+    """
+    A write that mints a new URI every time it is made
+    """
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.made = 0
+
+    async def __call__(self):
+        self.made += 1
+        await asyncio.sleep(self.delay)
+        return {"uri": f"http://nationaldigitaltwin.gov.uk/data#flag{self.made}"}
+
+def test_a_retry_is_replayed(tmp_path):
+    async def run():
+        store = IdempotencyStore(str(tmp_path / "idempotency.db"))
+        write = CountingWrite()
+        first = await store.run("key", "body", write)
+        assert await store.run("key", "body", write) == first
+        assert write.made == 1
+    asyncio.run(run())
+
+def test_a_key_reused_for_another_request_conflicts(tmp_path):
+    async def run():
+        store = IdempotencyStore(str(tmp_path / "idempotency.db"))
+        write = CountingWrite()
+        await store.run("key", "body", write)
+        try:
+            await store.run("key", "another body", write)
+            assert False, "the key was reused"
+        except IdempotencyConflict:
+            pass
+        assert write.made == 1
+    asyncio.run(run())
+
+def test_concurrent_duplicates_wait_for_the_first(tmp_path):
+    async def run():
+        store = IdempotencyStore(str(tmp_path / "idempotency.db"))
+        write = CountingWrite(delay=0.1)
+        responses = await asyncio.gather(*[store.run("key", "body", write) for i in range(5)])
+        assert write.made == 1
+        assert all(response == responses[0] for response in responses)
+    asyncio.run(run())
+
+def test_concurrent_duplicates_in_another_worker_wait_for_the_first(tmp_path):
+    async def run():
+        path = str(tmp_path / "idempotency.db")
+        worker_1 = IdempotencyStore(path)
+        worker_2 = IdempotencyStore(path)
+        write = CountingWrite(delay=0.2)
+        responses = await asyncio.gather(worker_1.run("key", "body", write), worker_2.run("key", "body", write))
+        assert write.made == 1
+        assert responses[0] == responses[1]
+    asyncio.run(run())
+
+def test_a_duplicate_only_waits_so_long(tmp_path):
+    async def run():
+        path = str(tmp_path / "idempotency.db")
+        worker_1 = IdempotencyStore(path)
+        worker_2 = IdempotencyStore(path, wait=0.1)
+        first = asyncio.create_task(worker_1.run("key", "body", CountingWrite(delay=0.5)))
+        await asyncio.sleep(0.05)
+        try:
+            await worker_2.run("key", "body", CountingWrite())
+            assert False, "the duplicate didn't wait for the first request"
+        except IdempotencyInProgress:
+            pass
+        await first
+    asyncio.run(run())
+
+def test_a_failed_write_can_be_retried(tmp_path):
+    async def run():
+        store = IdempotencyStore(str(tmp_path / "idempotency.db"))
+        async def failing_write():
+            raise RuntimeError("jena down")
+        try:
+            await store.run("key", "body", failing_write)
+        except RuntimeError:
+            pass
+        write = CountingWrite()
+        await store.run("key", "body", write)
+        assert write.made == 1
+    asyncio.run(run())
+
+def test_keys_expire(tmp_path):
+    async def run():
+        store = IdempotencyStore(str(tmp_path / "idempotency.db"), ttl=0.1)
+        write = CountingWrite()
+        first = await store.run("key", "body", write)
+        await asyncio.sleep(0.15)
+        assert await store.run("key", "body", write) != first
+        assert write.made == 2
+    asyncio.run(run())
+
+def test_a_key_left_pending_by_a_dead_worker_is_taken_over(tmp_path):
+    async def run():
+        path = str(tmp_path / "idempotency.db")
+        assert IdempotencyStore(path).begin("key", "body") is None
+        store = IdempotencyStore(path, pending_timeout=0.1)
+        assert store.begin("key", "body") == ("body", None)
+        time.sleep(0.15)
+        write = CountingWrite()
+        await store.run("key", "body", write)
+        assert write.made == 1
+    asyncio.run(run())
+
+def test_a_key_is_forgotten_when_its_write_is_dropped(tmp_path):
+    async def run():
+        store = IdempotencyStore(str(tmp_path / "idempotency.db"))
+        def broken_sink(security_label: str, payload: str):
+            raise RuntimeError("broker down")
+        producer = BatchingProducer(broken_sink, linger_ms=10, retries=0)
+        producer.start()
+        write = CountingWrite()
+        async def write_and_send():
+            #as run_idempotently registers the key's undo with send_knowledge
+            response = await write()
+            await producer.submit("O", "<a> <b> <c> .\n", [lambda: store.forget("key")])
+            return response
+        await store.run("key", "body", write_and_send)
+        await producer.stop()
+        await store.run("key", "body", write)
+        assert write.made == 2
+    asyncio.run(run())
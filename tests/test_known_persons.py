@@ -0,0 +1,69 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from known_persons import KnownPersons
+from producer import BatchingProducer
+
+def test_a_person_is_only_claimed_once(tmp_path):
+    path = str(tmp_path / "known_persons.db")
+    assert KnownPersons(path).claim("user1", "User One", "O")
+    #including by another worker
+    assert not KnownPersons(path).claim("user1", "User One", "O")
+
+def test_a_person_is_claimed_per_label(tmp_path):
+    persons = KnownPersons(str(tmp_path / "known_persons.db"))
+    assert persons.claim("user1", "User One", "O")
+    assert persons.claim("user1", "User One", "S")
+    assert not persons.claim("user1", "User One", "S")
+
+def test_a_changed_name_is_claimed_again(tmp_path):
+    persons = KnownPersons(str(tmp_path / "known_persons.db"))
+    assert persons.claim("user1", "User One", "O")
+    assert persons.claim("user1", "User 1", "O")
+    assert not persons.claim("user1", "User 1", "O")
+
+def test_a_person_expires(tmp_path):
+    persons = KnownPersons(str(tmp_path / "known_persons.db"), ttl=0.1)
+    assert persons.claim("user1", "User One", "O")
+    assert not persons.claim("user1", "User One", "O")
+    time.sleep(0.15)
+    assert persons.claim("user1", "User One", "O")
+
+def test_the_oldest_persons_are_pruned(tmp_path):
+    persons = KnownPersons(str(tmp_path / "known_persons.db"), max_size=2)
+    for user_id in ["user1", "user2", "user3"]:
+        persons.claim(user_id, user_id, "O")
+        time.sleep(0.01)
+    persons.prune()
+    assert persons.claim("user1", "user1", "O")
+    assert not persons.claim("user3", "user3", "O")
+
+def test_a_person_is_forgotten_when_their_write_is_dropped(tmp_path):
+    async def run():
+        persons = KnownPersons(str(tmp_path / "known_persons.db"))
+        def broken_sink(security_label: str, payload: str):
+            raise RuntimeError("broker down")
+        producer = BatchingProducer(broken_sink, linger_ms=10, retries=0)
+        producer.start()
+        assert persons.claim("user1", "User One", "O")
+        #as run_person_update registers the person's undo with send_knowledge
+        await producer.submit("O", "<person> <name> \"User One\" .\n", [lambda: persons.forget("user1", "O")])
+        await producer.stop()
+        assert persons.claim("user1", "User One", "O")
+    asyncio.run(run())
+
+def test_a_person_is_kept_when_their_write_is_sent(tmp_path):
+    async def run():
+        persons = KnownPersons(str(tmp_path / "known_persons.db"))
+        sent = []
+        producer = BatchingProducer(lambda label, payload: sent.append(payload), linger_ms=10)
+        producer.start()
+        assert persons.claim("user1", "User One", "O")
+        await producer.submit("O", "<person> <name> \"User One\" .\n", [lambda: persons.forget("user1", "O")])
+        await producer.stop()
+        assert len(sent) == 1
+        assert not persons.claim("user1", "User One", "O")
+    asyncio.run(run())
@@ -0,0 +1,95 @@
+import base64
+import os
+import sys
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import api
+from api import encode_cursor, decode_cursor
+
+data = "http://nationaldigitaltwin.gov.uk/data#"
+#sorted by URI, with URIs that are prefixes of others and characters that sort around the digits
+buildings = sorted([data + name for name in ["b1", "b10", "b100", "b2", "b2-1", "b2.1", "b20", "b3", "b3~", "b3%20", "Tŷ", "b9", "c"]])
+
+def b64(text: str):
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii").rstrip("=")
+
+def invalid(cursor: str):
+    try:
+        decode_cursor(cursor)
+    except HTTPException as e:
+        return e.status_code == 422
+    return False
+
+def test_cursors_round_trip():
+    for building in buildings:
+        assert decode_cursor(encode_cursor(building)) == building
+
+def test_invalid_base64_is_rejected():
+    for cursor in ["!!!!", "a", "abc$", b64("http://a/b")[:-1] + "*"]:
+        assert invalid(cursor), cursor
+
+def test_cursors_that_are_not_utf8_are_rejected():
+    assert invalid(base64.urlsafe_b64encode(b"\xff\xfe\xfd").decode("ascii"))
+
+def test_cursors_that_are_unsafe_in_a_query_are_rejected():
+    for uri in ["", data + "b1>", data + "b 1", data + "b1}", data + "b1\"", data + "b1\\", data + "b1<", data + "b1\n", data + "b1|", data + "b1^", data + "b1`", data + "b1{"]:
+        assert invalid(b64(uri)), uri
+
+def fake_buildings(monkeypatch):
+    async def fetch_listed_buildings(listed, headers):
+        return [api.new_building(building, {"uprn_id": {"value": str(buildings.index(building))}, "current_energy_rating": {"value": "C"}}) for building in listed]
+    monkeypatch.setattr(api, "index_candidates", lambda geohash: buildings)
+    monkeypatch.setattr(api, "read_model_ready", lambda: False)
+    monkeypatch.setattr(api, "fetch_listed_buildings", fetch_listed_buildings)
+
+def all_pages(client: TestClient, page_size: int):
+    pages = []
+    after = None
+    while True:
+        params = {"geohash": "gcnhm", "page_size": page_size}
+        if after is not None:
+            params["after"] = after
+        response = client.get("/buildings", params=params)
+        assert response.status_code == 200
+        pages.append([building["uri"] for building in response.json()])
+        after = response.headers.get("X-Next-Cursor")
+        if after is None:
+            return pages
+
+def test_pages_neither_overlap_nor_skip(monkeypatch):
+    fake_buildings(monkeypatch)
+    client = TestClient(api.app)
+    for page_size in range(1, len(buildings) + 2):
+        pages = all_pages(client, page_size)
+        assert [uri for page in pages for uri in page] == buildings, page_size
+        assert all(len(page) == page_size for page in pages[:-1])
+        assert 0 < len(pages[-1]) <= page_size
+
+def test_a_page_ending_on_the_last_building_has_no_cursor(monkeypatch):
+    fake_buildings(monkeypatch)
+    client = TestClient(api.app)
+    response = client.get("/buildings", params={"geohash": "gcnhm", "page_size": len(buildings)})
+    assert len(response.json()) == len(buildings)
+    assert "X-Next-Cursor" not in response.headers
+
+def test_an_invalid_cursor_is_a_422(monkeypatch):
+    fake_buildings(monkeypatch)
+    client = TestClient(api.app)
+    for after in ["!!!!", b64(data + "b1> } ")]:
+        assert client.get("/buildings", params={"geohash": "gcnhm", "page_size": 2, "after": after}).status_code == 422
+
+def test_the_cursor_is_put_in_the_query_as_it_was_given(monkeypatch):
+    queries = []
+    async def run_sparql_query(query, headers):
+        queries.append(query)
+        return {"results": {"bindings": []}}
+    monkeypatch.setattr(api, "index_candidates", lambda geohash: None)
+    monkeypatch.setattr(api, "read_model_ready", lambda: False)
+    monkeypatch.setattr(api, "run_sparql_query", run_sparql_query)
+    client = TestClient(api.app)
+    response = client.get("/buildings", params={"geohash": "gcnhm", "page_size": 2, "after": encode_cursor(data + "b3%20")})
+    assert response.status_code == 200
+    assert f'FILTER (STR(?building) > "{data}b3%20")' in queries[0]
+    assert "LIMIT 3" in queries[0]
@@ -0,0 +1,115 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from producer import BatchingProducer, MemorySink, ProducerFull
+
+class FailingSink(MemorySink):
+    """
+    A sink that fails the first failures sends, then keeps what it is sent
+    """
+    def __init__(self, failures: int):
+        super().__init__()
+        self.failures = failures
+        self.attempts = 0
+
+    def send(self, security_label: str, payload: str):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise RuntimeError("broker down")
+        super().send(security_label, payload)
+
+def test_writes_with_the_same_label_are_batched():
+    async def run():
+        sink = MemorySink()
+        producer = BatchingProducer(sink.send, linger_ms=50)
+        producer.start()
+        for i in range(5):
+            await producer.submit("O", f"<a> <b> <c{i}> .\n")
+        await producer.submit("S", "<a> <b> <s> .\n")
+        await asyncio.sleep(0.2)
+        assert sorted(label for label, payload in sink.records) == ["O", "S"]
+        assert dict(sink.records)["O"] == "".join(f"<a> <b> <c{i}> .\n" for i in range(5))
+        await producer.stop()
+    asyncio.run(run())
+
+def test_a_batch_is_sent_when_it_is_full():
+    async def run():
+        sink = MemorySink()
+        producer = BatchingProducer(sink.send, linger_ms=10000, max_batch_bytes=30)
+        producer.start()
+        for i in range(4):
+            await producer.submit("O", "x" * 10)
+        await asyncio.sleep(0.1)
+        #the first three fill a batch, and the fourth is still lingering
+        assert [payload for label, payload in sink.records] == ["x" * 30]
+        await producer.stop()
+        assert [payload for label, payload in sink.records] == ["x" * 30, "x" * 10]
+    asyncio.run(run())
+
+def test_the_queue_is_sent_on_stop():
+    async def run():
+        sink = MemorySink(delay=0.01)
+        producer = BatchingProducer(sink.send, linger_ms=10000, max_batch_bytes=100)
+        producer.start()
+        for i in range(50):
+            await producer.submit("O" if i % 2 else "S", f"{i:09}\n")
+        await producer.stop()
+        assert sum(payload.count("\n") for label, payload in sink.records) == 50
+        assert producer.stats["sent"] == 50
+    asyncio.run(run())
+
+def test_a_full_queue_rejects_writes():
+    async def run():
+        producer = BatchingProducer(MemorySink(delay=1).send, linger_ms=0, max_queue=1, enqueue_timeout=0.05)
+        producer.start()
+        try:
+            for i in range(5):
+                await producer.submit("O", "x")
+            assert False, "the queue never filled"
+        except ProducerFull:
+            pass
+        assert producer.stats["rejected"] == 1
+    asyncio.run(run())
+
+def test_a_failed_batch_is_retried():
+    async def run():
+        sink = FailingSink(failures=2)
+        undone = []
+        producer = BatchingProducer(sink.send, linger_ms=10, retries=2, retry_backoff=0.01)
+        producer.start()
+        await producer.submit("O", "x\n", [lambda: undone.append("x")])
+        await producer.stop()
+        assert sink.records == [("O", "x\n")]
+        assert undone == []
+        assert producer.stats["retried"] == 2 and producer.stats["sent"] == 1
+    asyncio.run(run())
+
+def test_a_dropped_batch_undoes_its_writes():
+    async def run():
+        sink = FailingSink(failures=3)
+        undone = []
+        producer = BatchingProducer(sink.send, linger_ms=10, retries=2, retry_backoff=0.01)
+        producer.start()
+        await producer.submit("O", "x\n", [lambda: undone.append("x")])
+        await producer.submit("O", "y\n", [lambda: undone.append("y"), lambda: undone.append("key")])
+        await producer.stop()
+        assert sink.records == []
+        assert sorted(undone) == ["key", "x", "y"]
+        assert producer.stats["failed"] == 2
+    asyncio.run(run())
+
+def test_only_the_dropped_batch_is_undone():
+    async def run():
+        sink = FailingSink(failures=1)
+        undone = []
+        producer = BatchingProducer(sink.send, linger_ms=10, retries=0)
+        producer.start()
+        await producer.submit("O", "x\n", [lambda: undone.append("x")])
+        await asyncio.sleep(0.1)
+        await producer.submit("O", "y\n", [lambda: undone.append("y")])
+        await producer.stop()
+        assert undone == ["x"]
+        assert sink.records == [("O", "y\n")]
+    asyncio.run(run())
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from response_cache import ResponseCache
+
+building = "http://nationaldigitaltwin.gov.uk/data#b1"
+flag = "http://nationaldigitaltwin.gov.uk/data#f1"
+
+class SlowJena():
+    """
+    Stands in for Jena behind Kafka - a flag written to it only shows in reads once ingestion_delay has passed
+    """
+    def __init__(self, ingestion_delay: float):
+        self.ingestion_delay = ingestion_delay
+        self.flags = {}
+
+    def write_flag(self, flag: str):
+        self.flags[flag] = time.monotonic() + self.ingestion_delay
+
+    def read(self):
+        #a response for a geohash holding the one building, its uris and what it shows
+        flags = {f for f, visible_at in self.flags.items() if visible_at <= time.monotonic()}
+        return repr(sorted(flags)).encode(), {building, *flags}, flags
+
+async def read_through(cache: ResponseCache, jena: SlowJena):
+    #as get_cached_buildings does
+    await cache.sync()
+    body = cache.get("gcnhm")
+    if body is None:
+        generation = cache.get_generation()
+        body, uris, shown = jena.read()
+        await cache.sync()
+        cache.put("gcnhm", body, uris, generation, shown)
+    return body
+
+def test_flag_shows_when_ingestion_is_slower_than_the_grace():
+    async def run():
+        cache = ResponseCache(None, ttl=60, write_grace=0.05, write_timeout=30)
+        jena = SlowJena(ingestion_delay=0.3)
+        assert await read_through(cache, jena) == b"[]"
+        jena.write_flag(flag)
+        await cache.evict([building], [(building, flag)])
+        #well past the grace, but before the flag has reached Jena - the old response mustn't be cached
+        await asyncio.sleep(0.1)
+        assert await read_through(cache, jena) == b"[]"
+        await asyncio.sleep(0.3)
+        assert await read_through(cache, jena) == repr([flag]).encode()
+        #and now it shows, it is cached
+        jena.flags.clear()
+        assert await read_through(cache, jena) == repr([flag]).encode()
+    asyncio.run(run())
+
+def test_awaited_writes_are_shared_between_workers(tmp_path):
+    async def run():
+        path = str(tmp_path / "buildings_cache.db")
+        writer = ResponseCache(path, ttl=60, write_grace=0.05, write_timeout=30)
+        reader = ResponseCache(path, ttl=60, write_grace=0.05, write_timeout=30)
+        jena = SlowJena(ingestion_delay=0.3)
+        assert await read_through(reader, jena) == b"[]"
+        jena.write_flag(flag)
+        await writer.evict([building], [(building, flag)])
+        await asyncio.sleep(0.1)
+        assert await read_through(reader, jena) == b"[]"
+        await asyncio.sleep(0.3)
+        assert await read_through(reader, jena) == repr([flag]).encode()
+    asyncio.run(run())
+
+def test_evictions_reach_the_other_workers(tmp_path):
+    async def run():
+        path = str(tmp_path / "buildings_cache.db")
+        writer = ResponseCache(path, ttl=60, write_grace=0)
+        reader = ResponseCache(path, ttl=60, write_grace=0)
+        jena = SlowJena(ingestion_delay=0)
+        await read_through(reader, jena)
+        assert reader.get("gcnhm") == b"[]"
+        #many times, so the reader's syncs run on more than one of the threadpool's threads
+        for i in range(20):
+            await writer.evict([building])
+            await reader.sync()
+            assert reader.get("gcnhm") is None
+            await read_through(reader, jena)
+    asyncio.run(run())
+
+def test_writes_that_never_show_are_only_awaited_until_the_timeout():
+    async def run():
+        cache = ResponseCache(None, ttl=60, write_grace=0.05, write_timeout=0.2)
+        jena = SlowJena(ingestion_delay=0)
+        await cache.evict([building], [(building, flag)])
+        await asyncio.sleep(0.1)
+        await read_through(cache, jena)
+        assert cache.get("gcnhm") is None
+        await asyncio.sleep(0.2)
+        await read_through(cache, jena)
+        assert cache.get("gcnhm") == b"[]"
+    asyncio.run(run())
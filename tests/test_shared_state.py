@@ -0,0 +1,53 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from shared_state import SharedState
+
+def in_thread(function, *args):
+    #each call gets a new thread, so a new SQLite connection, as requests do in the threadpool
+    result = []
+    thread = threading.Thread(target=lambda: result.append(function(*args)))
+    thread.start()
+    thread.join()
+    return result[0] if result else None
+
+def test_settings_reach_a_worker_syncing_on_a_new_thread(tmp_path):
+    path = str(tmp_path / "shared_state.db")
+    worker_1 = SharedState(path)
+    worker_2 = SharedState(path)
+    seen = []
+    worker_1.watch("label", seen.append)
+    in_thread(worker_1.sync)
+    in_thread(worker_2.set, "label", "S")
+    in_thread(worker_1.sync)
+    assert seen == ["S"]
+
+def test_settings_reach_a_worker_syncing_on_the_same_thread(tmp_path):
+    path = str(tmp_path / "shared_state.db")
+    worker_1 = SharedState(path)
+    worker_2 = SharedState(path)
+    seen = []
+    worker_1.watch("label", seen.append)
+    worker_1.sync()
+    worker_2.set("label", "S")
+    worker_1.sync()
+    worker_1.sync()
+    worker_2.set("label", "O")
+    worker_1.sync()
+    assert seen == ["S", "O"]
+
+def test_a_workers_own_settings_are_not_applied_again(tmp_path):
+    worker = SharedState(str(tmp_path / "shared_state.db"))
+    seen = []
+    worker.watch("label", seen.append)
+    worker.set("label", "S")
+    in_thread(worker.sync)
+    worker.sync()
+    assert seen == []
+
+def test_claims_go_to_one_worker(tmp_path):
+    path = str(tmp_path / "shared_state.db")
+    assert SharedState(path).claim("refresh", 60)
+    assert not SharedState(path).claim("refresh", 60)
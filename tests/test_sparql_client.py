@@ -0,0 +1,78 @@
+import asyncio
+import json
+import os
+import sys
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from sparql_client import SparqlClient, BindingsParser
+
+result = {
+    "head": {"vars": ["building", "uprn_id", "name"]},
+    "results": {"bindings": [
+        {"building": {"type": "uri", "value": "http://nationaldigitaltwin.gov.uk/data#b1"}, "uprn_id": {"type": "literal", "value": "100"}},
+        {"building": {"type": "uri", "value": "http://nationaldigitaltwin.gov.uk/data#b2"}, "name": {"type": "literal", "value": "a \"quoted\" ] name, with {braces}\\ and\nlines"}},
+        {"building": {"type": "uri", "value": "http://nationaldigitaltwin.gov.uk/data#b3"}, "name": {"type": "literal", "xml:lang": "cy", "value": "Tŷ Bach – 家 🏠"}},
+        {"building": {"type": "uri", "value": "http://nationaldigitaltwin.gov.uk/data#b4"}, "name": {"type": "literal", "value": "é\\u00e9"}},
+    ]}
+}
+
+def documents():
+    #compact and pretty-printed, and with and without non-ASCII characters escaped
+    yield json.dumps(result, ensure_ascii=False)
+    yield json.dumps(result, ensure_ascii=True)
+    yield json.dumps(result, ensure_ascii=False, indent=2)
+
+def parse(chunks):
+    parser = BindingsParser()
+    rows = []
+    for chunk in chunks:
+        rows.extend(parser.feed(chunk))
+    return rows
+
+class ChunkedStream(httpx.AsyncByteStream):
+    def __init__(self, chunks: list[bytes]):
+        self.chunks = chunks
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+def stream_bindings(chunks: list[bytes]):
+    async def run():
+        response = httpx.Response(200, headers={"Content-Type": "application/sparql-results+json; charset=utf-8"}, stream=ChunkedStream(chunks),
+                                  request=httpx.Request("POST", "http://jena:3030/ds/query"))
+        return [row async for row in SparqlClient("http://jena:3030").iter_bindings(response)]
+    return asyncio.run(run())
+
+def test_text_split_at_every_offset():
+    for document in documents():
+        expected = json.loads(document)["results"]["bindings"]
+        for i in range(len(document) + 1):
+            assert parse([document[:i], document[i:]]) == expected, i
+
+def test_text_split_into_single_characters():
+    for document in documents():
+        assert parse(list(document)) == json.loads(document)["results"]["bindings"]
+
+def test_bytes_split_at_every_offset():
+    #splits inside multi-byte UTF-8 characters are left to the response's text decoding
+    for document in documents():
+        body = document.encode("utf-8")
+        expected = json.loads(document)["results"]["bindings"]
+        for i in range(len(body) + 1):
+            assert stream_bindings([body[:i], body[i:]]) == expected, i
+
+def test_no_bindings():
+    document = json.dumps({"head": {"vars": ["building"]}, "results": {"bindings": []}})
+    for i in range(len(document) + 1):
+        assert parse([document[:i], document[i:]]) == []
+
+def test_truncated_results_only_return_the_complete_rows():
+    document = json.dumps(result)
+    expected = result["results"]["bindings"]
+    for i in range(len(document)):
+        rows = parse([document[:i]])
+        assert rows == expected[:len(rows)]
+    second_row = document.index('{"building"', document.index('"bindings"') + 20)
+    assert parse([document[:second_row]]) == expected[:1]
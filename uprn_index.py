@@ -0,0 +1,61 @@
+import time
+from collections import OrderedDict
+from ntriples import format_literal
+
+class UprnIndex():
+    """
+    The building URI for each UPRN that has been looked up, so repeat lookups can go straight to the building instead
+    of Jena matching the UPRN against every representation value. UPRNs that weren't found aren't remembered, so
+    buildings loaded later are still found.
+        max_size - the most UPRNs remembered - the least recently used are forgotten first
+        ttl - how long, in seconds, a UPRN is remembered for
+    """
+    def __init__(self, max_size: int = 200000, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.buildings = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uprn: str):
+        entry = self.buildings.get(uprn)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.buildings.move_to_end(uprn)
+                self.hits += 1
+                return entry[1]
+            del self.buildings[uprn]
+        self.misses += 1
+        return None
+
+    def put(self, uprn: str, building: str):
+        self.buildings[uprn] = (time.monotonic() + self.ttl, building)
+        self.buildings.move_to_end(uprn)
+        while len(self.buildings) > self.max_size:
+            self.buildings.popitem(last=False)
+
+    def __len__(self):
+        return len(self.buildings)
+
+def uprn_buildings(results):
+    """
+    The building for each UPRN in the rows of uprn_query
+    """
+    found = {}
+    if results and results['results'] and results['results']['bindings']:
+        for row in results['results']['bindings']:
+            found[row['uprn_id']['value']] = row['building']['value']
+    return found
+
+def uprn_query(uprns: list[str]):
+    """
+    The query for the buildings with the UPRNs - the identifiers are typed, so Jena only looks at UPRNs
+    """
+    values = " ".join(format_literal(uprn) for uprn in uprns)
+    return f"""
+        SELECT ?uprn_id ?building WHERE {{
+            VALUES ?uprn_id {{ {values} }}
+            ?uprn ies:representationValue ?uprn_id .
+            ?uprn rdf:type gp:UniquePropertyReferenceNumber .
+            ?building ies:isIdentifiedBy ?uprn .
+        }}"""